@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Measures how much memory and time gattai needs per package for large recipes.
+
+Generates a recipe with the given number of packages, each with a few props
+and a platform block, loads it and creates a Dependency for every package,
+the way plan and build_deps do, and reports the resident memory each step
+added per package.
+
+    python benchmarks/recipe_memory.py [packages]
+"""
+
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import gattai
+
+def rss_kb():
+    page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+    return int(open('/proc/self/statm').read().split()[1]) * page_kb
+
+def make_recipe(filename, count):
+    packages = []
+    for i in range(count):
+        package = {
+            "name": "package%d" % i,
+            "version": "1.%d" % (i % 10),
+            "url": "http://example.com/package%d-1.%d.tar.gz" % (i, i % 10),
+            "configure_args": ["--enable-shared", "--disable-static"],
+            "env_vars": {"CFLAGS": "-O2"},
+            sys.platform: {"configure_args": ["--with-pic"]},
+        }
+        if i:
+            package["depends"] = ["package%d" % (i // 2)]
+        packages.append(package)
+    json.dump({"settings": {"env_vars": {"PATH": "$ROOTDIR/bin"}}, "packages": packages}, open(filename, 'w'))
+
+def measure(label, count, func):
+    gc.collect()
+    before = rss_kb()
+    start = time.time()
+    result = func()
+    seconds = time.time() - start
+    gc.collect()
+    used = rss_kb() - before
+    print "%-22s %8.0f bytes/package %8.1f us/package" % (label, used * 1024.0 / count, seconds * 1e6 / count)
+    return result
+
+def main():
+    count = 20000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if not os.path.exists('/proc/self/statm'):
+        sys.exit("Memory can only be measured on Linux.")
+
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+        filename = os.path.join(tmpdir, 'large.gattai')
+        make_recipe(filename, count)
+        print "%d packages" % count
+        recipe = measure("load recipe", count, lambda: gattai.GattaiRecipe(filename))
+        measure("build graph", count, recipe.build_graph)
+        deps = measure("create dependencies", count, lambda: [gattai.Dependency(recipe, dep) for dep in recipe.deps])
+        measure("resolve props", count, lambda: [dep.get_prop('configure_args') for dep in deps])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -27,16 +27,19 @@
 # of the authors and should not be interpreted as representing official policies, 
 # either expressed or implied, of the Gattai Project.
 
-import commands
+import contextlib
+import glob
 import distutils.sysconfig
+import hashlib
 import json as json_loader
 import logging
 import os
+import shutil
 import subprocess
 import sys
+import time
 import types
 import urllib
-import zipfile
 
 logging.basicConfig(level=logging.INFO)
 
@@ -55,13 +58,48 @@ def get_user_home_dir():
 
 from distutils.dep_util  import newer
 
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm%02ds" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
 script_dir = os.path.abspath(os.path.dirname(__file__))
 
 GATTAI_DIR = script_dir
 
+import artifacts
 import builder
+import buildlog
+import eventloop
+import extract
+import graph
+import history
+import inventory
+import lockfile
+import multiarch
+import progress
+import recipediff
+from props import PackageProps, load_json
+import resources
+import sandbox
+import scheduler
+import toolchain
+import versions
+import vcs
+import watch
     
+from builder import BuildError
+
 deps_builder = None
+
+# number of source archives downloaded at the same time
+DOWNLOAD_JOBS = 4
+
+# the gattai.log handler is shared by every recipe loaded in this process
+_log_handler = None
         
 # Dependency JSON format:
 # A liar of dependencies ordered in the proper order needed to build the project
@@ -69,8 +107,11 @@ deps_builder = None
 
 def perform_substitutions(value, subs=locals()):
     if isinstance(value, dict):
+        # the recipe's own dicts are shared, so substitute into a copy
+        result = {}
         for key in value:
-            value[key] = perform_substitutions(value[key], subs)
+            result[key] = perform_substitutions(value[key], subs)
+        return result
     elif isinstance(value, list):
         result = []
         for item in value:
@@ -80,6 +121,44 @@ def perform_substitutions(value, subs=locals()):
         return value % subs
     return value
 
+# Runs the postinstall script given as its first argument, substituting the
+# GATTAI_* environment variables into its text the way props are substituted.
+POSTINSTALL_BOOTSTRAP = (
+    "import os, sys\n"
+    "subs = dict((key[7:], value) for key, value in os.environ.items() if key.startswith('GATTAI_'))\n"
+    "sys.argv = sys.argv[1:]\n"
+    "script = open(sys.argv[0]).read() % subs\n"
+    "exec(compile(script, sys.argv[0], 'exec'))\n"
+)
+
+def fetch_url(url, filename, sha256=None, progress=None):
+    """
+    Downloads url to filename, going through a temporary file so that an
+    interrupted download is never mistaken for a complete one. If sha256 is
+    given, a download with a different digest is thrown away. progress is
+    called with the number of bytes of each block that arrives.
+    """
+    class GattaiURLopener(urllib.FancyURLopener):
+        def http_error_default(self, url, fp, errcode, errmsg, headers):
+            raise IOError("error %r: %s" % (errcode, errmsg))
+    tmp_filename = filename + '.part'
+    reporthook = None
+    if progress is not None:
+        received = [0]
+        def reporthook(blocks, block_size, total_size):
+            size = blocks * block_size
+            if total_size > 0:
+                size = min(size, total_size)
+            progress(size - received[0])
+            received[0] = size
+    GattaiURLopener().retrieve(url, filename=tmp_filename, reporthook=reporthook)
+    if sha256 is not None and extract.file_digest(tmp_filename) != sha256:
+        os.remove(tmp_filename)
+        raise IOError("%s doesn't match the digest in the lockfile" % url)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+
 def run_in_venv(venv_dir, cmd):
     activate_script = None
     if os.path.exists(venv_dir):
@@ -95,7 +174,7 @@ def run_in_venv(venv_dir, cmd):
             final_cmd = "source %s" % final_cmd
 
     logging.info("Running command: %s" % final_cmd)
-    return subprocess.call(final_cmd, shell=True)
+    return buildlog.run_command(final_cmd)
     
 class Dependency(object):
     def __init__(self, recipe, props):
@@ -109,17 +188,44 @@ class Dependency(object):
         
         self.recipe = recipe
         self.name = props['name']
+        if not isinstance(props, PackageProps):
+            props = PackageProps.resolve(props, sys.platform)
         self.props = props
         self.platform_props = {}
-        if sys.platform in self.props:
-            self.props.update(self.props[sys.platform])
-            
-        self.SRCDIR = self.source_dir().replace('\\', '/')
-        self.BLDDIR = self.build_dir().replace('\\', '/')
-        
+        # what the last call to build() did, see plan_action()
+        self.action = None
+        self.sandbox = None
+        # the build key the package is cached under, see restore_artifact()
+        self.artifact_key = None
+        # the one of its archs the package is built for on its own, see split_archs()
+        self.arch = None
+        # seconds spent in each phase of the last build
+        self.timings = {}
+        # the env_vars build() has set while it runs, see env_values()
+        self.env = None
+
+    def __getattr__(self, name):
+        # finding the source and build dirs means probing the filesystem, so
+        # it's only done for the packages that get looked at
+        if name == 'SRCDIR':
+            self.SRCDIR = self.source_dir().replace('\\', '/')
+            return self.SRCDIR
+        if name == 'BLDDIR':
+            self.BLDDIR = self.build_dir().replace('\\', '/')
+            return self.BLDDIR
+        raise AttributeError(name)
+
     def source_dir(self, dir=None):
         if dir is None:
             dir = self.recipe.ROOTDIR
+        entry = self.recipe.locked.get(self.name)
+        # the locked dir is only trusted while it is there, archives can unpack elsewhere
+        if entry is not None and dir == self.recipe.ROOTDIR and entry['source_dir'] and os.path.exists(entry['source_dir']):
+            return entry['source_dir']
+        cache = self.recipe.path_cache
+        key = (self.name, self.props['version'], dir)
+        if cache is not None and key in cache:
+            return cache[key]
         fullname = "%s-%s" % (self.name, self.props['version'])
         default = os.path.join(dir, fullname)
         result = self.get_prop('source_dir', default=default, perform_substitutions=False)
@@ -134,6 +240,9 @@ class Dependency(object):
             if os.path.exists(fullpath):
                 source = fullpath
         
+        # only remember paths that exist, the source may not be downloaded yet
+        if cache is not None and os.path.exists(source):
+            cache[key] = source
         return source
         
     def abs_path_for_path(self, filename, dir=None):
@@ -157,6 +266,9 @@ class Dependency(object):
     def build_dir(self, dir=None):
         if dir is None:
             dir = self.recipe.ROOTDIR
+        entry = self.recipe.locked.get(self.name)
+        if entry is not None and dir == self.recipe.ROOTDIR and entry['build_dir'] and os.path.exists(entry['build_dir']):
+            return entry['build_dir']
         result = self.get_prop('build_dir', default=self.source_dir(dir), perform_substitutions=False)
         abspath = os.path.abspath(result)
         if os.path.exists(abspath):
@@ -183,10 +295,20 @@ class Dependency(object):
         return filename
 
 
+    def archive_filename(self, url):
+        """
+        Returns the filename the file at url is downloaded to, as recorded in
+        the lockfile if the package is locked.
+        """
+        entry = self.recipe.locked.get(self.name)
+        if entry is not None and entry['url'] == url and entry['archive']:
+            return entry['archive']
+        return self.get_filename_from_url(url)
+
     def download_file(self, url, dir=None):
         if dir is None:
             dir = self.recipe.ROOTDIR
-        filename = self.get_filename_from_url(url)
+        filename = self.archive_filename(url)
 
         dirname = os.path.dirname(os.path.abspath(filename))
 
@@ -196,46 +318,94 @@ class Dependency(object):
         try:
             # FIXME: Write a download callback handler that shows progress
             logging.info("File for %s not found, downloading from %s, this may take time..." % (self.name, url))
-            class MyURLopener(urllib.FancyURLopener):
-                def http_error_default(self, url, fp, errcode, errmsg, headers):
-                    # handle errors the way you'd like to
-                    logging.error("Error downloading file.")
-                    logging.error("Error code: %r" % errcode)
-                    logging.error("Error message:")
-                    logging.error(errmsg)
-                    raise Exception("Unable to download file.")
-            MyURLopener().retrieve(url, filename=filename)
-        except:
-            logging.error("Unable to download file for dependency.")
-            sys.exit(1)
+            fetch_url(url, filename, self.locked_digest(url))
+        except Exception, e:
+            raise BuildError("Unable to download file for dependency: %s" % e)
         if not os.path.exists(filename):
-            logging.error("Unable to find downloaded file %s" % os.path.abspath(filename))
-            sys.exit(1)
+            raise BuildError("Unable to find downloaded file %s" % os.path.abspath(filename))
         return filename
 
+    def locked_digest(self, url):
+        """
+        Returns the digest the lockfile expects the archive downloaded from
+        url to have, or None.
+        """
+        entry = self.recipe.locked.get(self.name)
+        if entry is not None and entry['url'] == url:
+            return entry['sha256']
+        return None
+
+    def fingerprint(self):
+        """
+        Returns everything that decides how the package is built: its props
+        and the settings, the root dir and the versions of its build tools.
+        """
+        props = self.resolved_props()
+        props['ROOTDIR'] = self.recipe.ROOTDIR
+        props['TOOLS'] = self.tool_versions()
+        return props
+
+    def lock_digest(self):
+        """
+        Returns a digest of everything the package's lock entry is worked
+        out from, which changes when the entry has to be locked again.
+        """
+        return lockfile.props_digest(self.fingerprint())
+
+    def make_lock_entry(self):
+        """
+        Returns what the lockfile records about the package. The digest of
+        its source archive is only known if the archive has been downloaded,
+        and its source and build dirs only if they exist, since until the
+        archive is unpacked they are guesses.
+        """
+        source_dir = self.source_dir()
+        build_dir = self.build_dir()
+        entry = {
+            'digest': self.lock_digest(),
+            'url': self.get_prop('source'),
+            'archive': self.source_archive(),
+            'sha256': None,
+            'source_dir': source_dir if os.path.exists(source_dir) else None,
+            'build_dir': build_dir if os.path.exists(build_dir) else None,
+            'build_key': self.build_key(),
+        }
+        if entry['archive'] and os.path.exists(entry['archive']):
+            entry['sha256'] = extract.file_digest(entry['archive'])
+        return entry
+
+    def version_requirement(self):
+        """
+        Returns the versions.Requirement an installed copy of the package has
+        to meet to be used instead of building it, or None if its version
+        isn't one that can be compared.
+        """
+        spec = self.get_prop('version_range')
+        if not spec:
+            spec = versions.default_requirement(self.get_prop('version'), self.get_prop('exact_version_only'))
+            if spec is None:
+                return None
+        try:
+            return versions.parse_requirement(spec)
+        except ValueError, e:
+            raise BuildError("Invalid version_range for %s: %s" % (self.name, e))
+
     def valid_version(self, version_str):
-        valid = False
-        req_version = self.get_prop('version')
-        needs_exact_match = self.get_prop('exact_version_only')
-        if version_str == req_version or version_str.find(req_version) != -1:
-            valid = True
-        elif not needs_exact_match:
-            version_tuple = version_str.split('.')
-            req_version_tuple = req_version.split('.')
-            # Future major versions are sometimes not compatible, so we will only accept
-            # exact matches for the major version for now.
-            # Also, use a try block so that if the version isn't purely numbers,
-            # we will just gracefully fail the check.  
-            try:
-                if int(version_tuple[0]) == int(req_version_tuple[0]):
-                    if int(version_tuple[1]) > int(req_version_tuple[1]):
-                        valid = True
-                    elif int(version_tuple[1]) == int(req_version_tuple[1]):
-                        valid = (int(version_tuple[2] >= int(req_version_tuple[2])))
-            except:
-                logging.warning("Unable to compare versions for %r." % self.name)
-                logging.warning("Assuming incompatible version.")
-        return valid
+        """
+        Returns True if version_str, a version or the output of a program's
+        --version, meets the package's version requirement.
+        """
+        requirement = self.version_requirement()
+        if requirement is None:
+            if version_str.strip() == self.get_prop('version'):
+                return True
+            logging.warning("Unable to compare versions for %r, assuming %r is incompatible." % (self.name, version_str))
+            return False
+        version = versions.extract_version(version_str)
+        if version is None:
+            logging.warning("Unable to find a version in %r for %r, assuming it is incompatible." % (version_str, self.name))
+            return False
+        return requirement.matches(version)
     
     def is_newer(self, path1, path2):
         """
@@ -253,38 +423,45 @@ class Dependency(object):
 
 
     def installed(self):
-        is_installed = False
-        cmd_version = None
+        """
+        Returns True if the required version of the package is already
+        installed. Results are remembered when the recipe has a probe cache.
+        Packages that changed since the last run are never installed.
+        """
+        if self.name in self.recipe.changed:
+            return False
+        cache = self.recipe.probe_cache
+        if cache is not None and self.name in cache:
+            return cache[self.name]
+        is_installed = self.probe_installed()
+        if cache is not None:
+            cache[self.name] = is_installed
+        return is_installed
+
+    def probe_installed(self):
         check_cmd = self.get_prop('install_check_cmd')
         if check_cmd:
             return subprocess.call(check_cmd) == 0
+
+        name = self.get_prop('name')
+        if self.get_prop('program_name'):
+            name = self.get_prop('program_name')
+        index = self.recipe.install_index()
+        if self.get_prop('build_type') == 'python':
+            version = index.python_version(name)
         else:
-            name = self.get_prop('name')
-            if self.get_prop('program_name'):
-                name = self.get_prop('program_name')
-            version = self.get_prop('version')
-            if self.get_prop('build_type') == 'python':
-                try:
-                    cmd_version = subprocess.check_output('python -c "import %s; return %s.__VERSION__"')
-                except:
-                    pass
-            
-            cmds = [
-                        [name, '--version'],
-                        ['%s-config' % name, '--version'],
-                        ['pkg-config', '--version', name],
-                    ]
-            
-            for cmd in cmds:
-                try:
-                    cmd_version = subprocess.check_output(cmd)
-                    break
-                except:
-                    pass
-        
-        if cmd_version is not None:
-            is_installed = self.valid_version(cmd_version)
-        return is_installed
+            version = index.pkg_config_version(name, self.get_prop('install_dir'))
+            if version is None:
+                # packages without a .pc file may install a program that
+                # reports its version, the toolchain only asks each binary once
+                tools = toolchain.current()
+                for program in [name, '%s-config' % name]:
+                    if tools.find(program) is not None:
+                        version = tools.version(program)
+                        break
+                tools.save()
+
+        return version is not None and self.valid_version(version)
             
     def run_installer(self, dir=None):
         if dir == None:
@@ -300,9 +477,8 @@ class Dependency(object):
                 return False
             cmd = 'hdiutil mount %s' % os.path.abspath(filename)
             logging.info("Running %s" % cmd)
-            status, output = commands.getstatusoutput(cmd)
+            status, lines = buildlog.capture_command(cmd)
             if status == 0:
-                lines = output.split('\n')
                 last_line = lines[-1].split('\t')
                 logging.info(last_line)
                 mountpoint = last_line[0].strip()
@@ -316,7 +492,7 @@ class Dependency(object):
                 logging.info("Installer is %s" % installer)
             else:
                 logging.error("Unaable to mount disk image. Error message is:")
-                logging.error(output)
+                logging.error("\n".join(lines))
                 return False
         elif binary:
             filename = self.download_file(binary)
@@ -327,8 +503,7 @@ class Dependency(object):
                 if result != 0:
                     return False
             else:
-                status, output = commands.getstatusoutput(filename)
-                if status != 0:
+                if buildlog.run_command(filename) != 0:
                     return False
         else:
             logging.error("Could not find disk image or executable for binary package.")
@@ -339,7 +514,10 @@ class Dependency(object):
         if dir is None:
             dir = self.recipe.ROOTDIR
         if self.get_prop('source'):
-            filename = self.get_filename_from_url(self.get_prop('source'))
+            if vcs.is_git_url(self.get_prop('source')):
+                self.fetch_git()
+                return
+            filename = self.archive_filename(self.get_prop('source'))
             if not os.path.exists(filename):
                 filename = self.download_file(self.get_prop('source'))
             
@@ -347,41 +525,116 @@ class Dependency(object):
             if filename is None:
                 return
 
+    def prefetch_filename(self):
+        """
+        Returns where build() would download the package's source archive to,
+        or None if building it won't need a download.
+        """
+        source = self.get_prop('source')
+        if not source or vcs.is_git_url(source) or self.get_prop('ignore', False):
+            return None
+        if self.get_prop('installer') or self.get_prop('easy_install'):
+            return None
+        filename = os.path.join(self.recipe.ROOTDIR, self.archive_filename(source))
+        if os.path.exists(filename) or os.path.exists(self.source_dir()):
+            return None
+        # probe without the cache, since the package's env_vars aren't set yet
+        if self.probe_installed():
+            return None
+        return filename
+
     def extract_archive(self, filename):
         """
         extracts the given archive -- usually used for source archives.
 
-        supports zip, tar, gz, bz2
+        supports zip and tar, uncompressed or compressed with gz, bz2, xz or zst
 
         """
-        base, ext = os.path.splitext(filename)
-        format = 'zip'
-        if base.endswith('.tar') or ext == '.tgz':
-            if ext == '.gz' or ext == '.tgz':
-                format = 'tar.gz'
-            elif ext == '.bz2':
-                format = 'tar.bz2'
-            else:
-                format = 'tar'
-        else:
-            format = ext[1:]
-        
-        if format.startswith('tar'):
-            mode = 'r'
-            if format.endswith('gz'):
-                mode += ':gz'
-            elif format.endswith('bz2'):
-                mode += ':bz2'
-                            
-            import tarfile
-            tarball = tarfile.open(filename, mode=mode)
-            tarball.extractall()
-        elif format == 'git':
-            run_in_venv(self.recipe.ROOTDIR, 'git clone %s %s-%s' % (self.get_prop('source'), self.name, self.get_prop('version')))
-        elif format == 'zip':
-            zip = zipfile.ZipFile(filename)
-            zip.extractall()
+        if os.path.splitext(filename)[1] == '.git':
+            self.fetch_git()
+            return
+        if extract.archive_format(filename) is None:
+            logging.warning("Don't know how to extract %s" % filename)
+            return
+
+        threads = int(self.get_prop('extract_threads', default=extract.DEFAULT_THREADS))
+        include = self.get_prop('extract_include')
+        exclude = self.get_prop('extract_exclude')
+        # a partial tree left by an interrupted extraction is replaced, not merged with
+        replace = None
+        source = self.source_dir()
+        if os.path.dirname(source) == os.path.abspath('.'):
+            replace = source
+        try:
+            stats = extract.extract_atomically(filename, '.', replace=replace, threads=threads,
+                                               include=include, exclude=exclude)
+        except extract.ExtractError, e:
+            logging.error("Unable to extract %s: %s" % (filename, e))
+            return
+        source = self.source_dir()
+        if os.path.isdir(source):
+            extract.write_marker(source, filename, include, exclude)
+        megabytes = stats['bytes'] / (1024.0 * 1024.0)
+        rate = megabytes / max(stats['seconds'], 0.001)
+        logging.info("Extracted %.1f MB from %s in %.1fs (%.1f MB/s using %s)" % (megabytes, filename, stats['seconds'], rate, stats['tool']))
+        self.timings['extract'] = self.timings.get('extract', 0) + stats['seconds']
+        self.recipe.logs.emit('extract', package=self.name, archive=filename, bytes=stats['bytes'],
+                              seconds=round(stats['seconds'], 3), mb_per_s=round(rate, 1), tool=stats['tool'])
+
+
+    def fetch_git(self):
+        """
+        Checks out the commit given by the 'ref' prop of the package's git
+        source into name-version, going through the git mirror cache.
+        """
+        default_mirror_dir = os.path.join(self.recipe.state_dir, 'git')
+        if self.recipe.HOMEDIR:
+            default_mirror_dir = os.path.join(self.recipe.HOMEDIR, '.gattai', 'git')
+        mirror_dir = self.get_prop('git_mirror_dir', default=default_mirror_dir)
+        dest = os.path.abspath('%s-%s' % (self.name, self.get_prop('version')))
+        try:
+            vcs.fetch(self.get_prop('source'), dest,
+                      ref=self.get_prop('ref'),
+                      depth=int(self.get_prop('git_depth', default=1)),
+                      sparse_paths=self.get_prop('sparse_paths'),
+                      mirror_dir=mirror_dir)
+        except vcs.FetchError, e:
+            logging.error("Unable to fetch %s: %s" % (self.name, e))
 
+    def source_archive(self):
+        """
+        Returns the filename of the package's downloaded source archive, or
+        None if its source doesn't come from an archive.
+        """
+        source = self.get_prop('source')
+        if not source or vcs.is_git_url(source):
+            return None
+        filename = self.archive_filename(source)
+        if extract.archive_format(filename) is None:
+            return None
+        return filename
+
+    def source_intact(self, dirname):
+        """
+        Returns False if dirname is known not to have been completely
+        extracted from the current source archive: an earlier extraction was
+        interrupted, or the tree's marker is for another archive. Trees
+        without a marker, unpacked by hand or by older versions of gattai,
+        are kept.
+        """
+        filename = self.source_archive()
+        # without the archive there is nothing to check against
+        if filename is None or not os.path.exists(filename):
+            return True
+        if extract.interrupted_extractions(os.path.dirname(dirname), filename):
+            logging.warning("Extracting %s was interrupted, extracting it again" % filename)
+            return False
+        if not extract.has_marker(dirname):
+            return True
+        if extract.is_intact(dirname, filename, self.get_prop('extract_include'), self.get_prop('extract_exclude')):
+            return True
+        logging.warning("%s was not completely extracted from %s, extracting it again" % (dirname, filename))
+        return False
 
     def source_exists(self, dir=None):
         """
@@ -391,7 +644,7 @@ class Dependency(object):
         if dir is None:
             dir = self.recipe.ROOTDIR
         dirname = self.source_dir(dir)
-        if os.path.exists(dirname) and os.path.dirname(dirname):
+        if os.path.exists(dirname) and os.path.dirname(dirname) and self.source_intact(dirname):
             return True
         else:
             self.download_source(dir)
@@ -400,35 +653,195 @@ class Dependency(object):
         # run the test again after attempting to download
         if not os.path.exists(dirname) or not os.path.dirname(dirname):
             logging.error("Unable to locate directory %s" % dirname)
-            logging.error("Could not find or retrieve %s" % self.name)
             if 'optional' in self.props and self.props['optional'] == True:
                 return False
             else:
-                sys.exit(1)
+                raise BuildError("Could not find or retrieve %s" % self.name)
                 
         return True
 
-    def perform_substitutions(self, value, dir=None):
+    def substitution_vars(self, dir=None):
+        """
+        Returns the values available to %(NAME)s substitutions in props.
+        """
         if dir is None:
             dir = self.recipe.ROOTDIR
-        BLDDIR = self.BLDDIR
-        SRCDIR = self.SRCDIR
-        ROOTDIR = dir
-        HOMEDIR = get_user_home_dir()
-        PYTHON = self.recipe.PYTHON
+        return {
+            'BLDDIR': self.BLDDIR,
+            'SRCDIR': self.SRCDIR,
+            'ROOTDIR': dir,
+            'HOMEDIR': get_user_home_dir(),
+            'PYTHON': self.recipe.PYTHON,
+            'ARCH': self.arch or '',
+        }
 
-        return perform_substitutions(value, locals())
+    def perform_substitutions(self, value, dir=None):
+        return perform_substitutions(value, self.substitution_vars(dir))
 
-    def build(self, dir=None, args=[]):
+    def stages_install(self):
         """
-        Build the software, which is located in the specified base dir.
+        Returns True if the package can be installed into a staging dir.
+        """
+        return self.get_prop('build_type', 'cxx') == 'cxx' and self.cxx_format() in ['autoconf', 'gnumake', 'cmake', 'ninja']
+
+    def make_sandbox(self, dir=None):
+        """
+        Returns the Sandbox to build the package in if there is a scratch_dir
+        to build in, or None to build it in place.
+        """
+        scratch_dir = self.get_prop('scratch_dir')
+        if self.arch is not None:
+            # each arch is built in a copy of its own, so that they can build at the same time
+            if not scratch_dir:
+                scratch_dir = os.path.join(self.recipe.state_dir, 'archs')
+            root = os.path.join(os.path.abspath(scratch_dir), "%s-%s-%s" % (self.name, self.arch, self.build_key()[:8]))
+            return sandbox.Sandbox(root, self.source_dir(dir), self.build_dir(dir))
+        if not scratch_dir:
+            return None
+        if not self.stages_install():
+            logging.info("%s can't be installed through a staging dir, building it in place" % self.name)
+            return None
+        root = os.path.join(os.path.abspath(scratch_dir), "%s-%s" % (self.name, self.build_key()[:8]))
+        return sandbox.Sandbox(root, self.source_dir(dir), self.build_dir(dir))
+
+    def split_archs(self):
+        """
+        Returns the archs the package is built for in separate builds, or an
+        empty list if it is built once for all of its archs. Only packages
+        that set split_archs and can be installed through a staging dir are
+        split.
+        """
+        if self.arch is not None or not self.get_prop('split_archs', False) in [True, "TRUE"]:
+            return []
+        if not self.stages_install():
+            return []
+        return list(self.get_prop('archs', default=None) or [])
+
+    def prepare_source(self, dir=None):
+        """
+        Fetches and unpacks the source the builds for the package's archs
+        share, so that they don't all do it at the same time. Returns True if
+        the source is there or the package doesn't need building.
+        """
+        if self.installed():
+            self.action = 'installed'
+            return True
+        if self.get_prop('ignore', False):
+            self.action = 'ignored'
+            return True
+        self.action = 'fetched'
+        with self.phase('fetch'):
+            return self.source_exists(dir)
+
+    def arch_build(self, arch):
+        """
+        Returns the Dependency building the package for arch alone.
+        """
+        dep = Dependency(self.recipe, self.props.override({'archs': [arch]}))
+        dep.arch = arch
+        return dep
+
+    def arch_merge(self):
+        """
+        Returns how the separate builds for the package's archs are merged,
+        'lipo' or 'prefix', see the multiarch module.
+        """
+        default = 'prefix'
+        if sys.platform.startswith('darwin'):
+            default = 'lipo'
+        merge = self.get_prop('arch_merge', default)
+        if merge not in ['lipo', 'prefix']:
+            raise BuildError("Unknown arch_merge %r for %s" % (merge, self.name))
+        return merge
+
+    def install_prefix(self, dir=None):
+        """
+        Returns the dir the package installs into: its install_dir, or the
+        dir of its arch in it when its archs are installed side by side.
         """
         if dir is None:
             dir = self.recipe.ROOTDIR
-            
-        self.SRCDIR = self.source_dir(dir).replace('\\', '/')
-        self.BLDDIR = self.build_dir(dir).replace('\\', '/')
+        install_dir = os.path.abspath(self.get_prop('install_dir', default=os.path.abspath(dir)))
+        if self.arch is not None and self.arch_merge() == 'prefix':
+            install_dir = os.path.join(install_dir, self.arch)
+        return install_dir
+
+    def merge_archs(self, dir=None):
+        """
+        Installs the separate builds for the package's archs as one, combining
+        their binaries with lipo. Archs installed side by side are already in
+        place.
+        """
+        if self.arch_merge() != 'lipo':
+            return
+        install_dir = self.install_prefix(dir)
+        sandboxes = [self.arch_build(arch).make_sandbox(dir) for arch in self.split_archs()]
+        trees = [box.staged_path(install_dir) for box in sandboxes]
+        for arch, tree in zip(self.split_archs(), trees):
+            if not os.path.isdir(tree):
+                raise BuildError("The build of %s for %s installed nothing to merge" % (self.name, arch))
+        merged = os.path.join(os.path.dirname(sandboxes[0].root), "%s-merged" % os.path.basename(sandboxes[0].root))
+        shutil.rmtree(merged, ignore_errors=True)
+        try:
+            combined = multiarch.merge_trees(trees, merged)
+            copied = sandbox.sync_tree(merged, install_dir)
+        finally:
+            shutil.rmtree(merged, ignore_errors=True)
+        logging.info("Combined %d files of %d archs, copied %d installed files to %s" %
+                     (combined, len(trees), copied, install_dir))
+        if not self.get_prop('scratch_keep', False) in [True, "TRUE"]:
+            for box in sandboxes:
+                box.remove()
+
+    def build_mode(self, dir=None):
+        """
+        Returns 'incremental' if the source is already unpacked and was
+        configured by a previous build, so that only changed files need to be
+        rebuilt, and 'full' otherwise.
+        """
+        build_dir = self.build_dir(dir)
+        if self.props.get('build_type', 'cxx') == 'python':
+            marker = os.path.join(build_dir, 'build')
+        elif self.cxx_format() == 'cmake':
+            marker = os.path.join(build_dir, builder.CMakeBuilder.binaryDirName, 'CMakeCache.txt')
+        elif self.cxx_format() == 'ninja':
+            marker = os.path.join(build_dir, 'build.ninja')
+        else:
+            marker = os.path.join(build_dir, 'Makefile')
+        if os.path.exists(marker):
+            return 'incremental'
+        return 'full'
+
+    # settings and props that only change how gattai runs, not what gets built
+    RUN_PROPS = frozenset(['log_dir', 'log_tail_lines', 'log_events', 'compress_logs', 'state_dir',
+                           'download_jobs', 'extract_threads', 'cpu_budget', 'mem_budget_mb', 'mem_mb',
+                           'scratch_keep', 'artifact_dir', 'artifact_url', 'artifact_uploads',
+                           'metrics_port', 'status_line', 'git_mirror_dir'])
 
+    def resolved_props(self):
+        """
+        Returns every setting and property that applies to this package, with
+        platform overrides applied, leaving out the RUN_PROPS.
+        """
+        result = {}
+        for props in [self.recipe.settings, self.props]:
+            for key in props:
+                # skip the platform-specific blocks, they have already been applied
+                if isinstance(props[key], dict) and key != 'env_vars':
+                    continue
+                if key in self.RUN_PROPS:
+                    continue
+                result[key] = props[key]
+        return result
+
+    def env_values(self):
+        """
+        Returns the environment variables the package's env_vars set while it
+        builds, with the variables of the environment and the props they
+        refer to substituted. While build() runs, these are the ones it set.
+        """
+        if self.env is not None:
+            return self.env
         env_vars = {}
         if 'env_vars' in self.recipe.settings and self.recipe.settings['env_vars'] is not None:
             env_vars.update(self.recipe.settings['env_vars'])
@@ -436,85 +849,258 @@ class Dependency(object):
         if 'env_vars' in self.props:
             env_vars.update(self.props['env_vars'])
         
-        old_env = {}
+        # later variables see the values of earlier ones, as if they were set in turn
+        environ = dict(os.environ)
+        values = {}
         for env in env_vars:
             env_value = env_vars[env]
-            if env in os.environ:
-                old_env[env] = os.environ[env]
-                
-            for key in os.environ:
+            for key in environ:
                 # do env substitutions
                 if sys.platform.startswith('win'):
-                    env_value = env_value.replace('%' + key + '%', os.environ[key])
+                    env_value = env_value.replace('%' + key + '%', environ[key])
                 else:
-                    env_value = env_value.replace('$' + key, os.environ[key])
+                    env_value = env_value.replace('$' + key, environ[key])
             env_value = self.perform_substitutions(env_value)
-            
-            os.environ[env] = env_value
+            environ[env] = values[env] = env_value
+        return values
 
-        if not "clean" in args:
-            if self.installed(): # if we're already installed and using proper version, exit
-                logging.info("%s is installed and up-to-date, skipping..." % self.get_prop('name'))
-                return True
+    def tool_versions(self):
+        """
+        Returns a dict mapping the programs the package is built with to their
+        versions, found on the PATH the package builds with wherever this is
+        called from, so that build keys don't depend on it.
+        """
+        if self.get_prop('build_type', 'cxx') != 'cxx':
+            return {}
+        builder_class = builder.formats.get(self.cxx_format())
+        if builder_class is None:
+            return {}
+        path = self.env_values().get('PATH', os.environ.get('PATH', ''))
+        return toolchain.for_path(path).versions(builder_class.programs())
 
-        if self.get_prop('ignore', False):
-            logging.info("Ignoring %s"%self.props['name'])
-            return True
+    def build_key(self):
+        """
+        Returns a hex digest that identifies this exact build of the package:
+        packages with the same key build the same thing in the same place.
+        """
+        entry = self.recipe.locked.get(self.name)
+        if entry is not None:
+            return entry['build_key']
+        props = self.resolved_props()
+        # where a package sits in the build order doesn't change what gets built
+        props.pop('depends', None)
+        props['ROOTDIR'] = self.recipe.ROOTDIR
+        props['SRCDIR'] = self.SRCDIR
+        props['BLDDIR'] = self.BLDDIR
+        props['TOOLS'] = self.tool_versions()
+        return hashlib.sha1(json_loader.dumps(props, sort_keys=True)).hexdigest()
+
+    def artifact_cache(self):
+        """
+        Returns the ArtifactCache the package is shared through, or None if
+        it isn't cached. Only packages built in a sandbox are, since only
+        their installs are kept apart from other packages'.
+        """
+        if not self.get_prop('scratch_dir') or not self.stages_install():
+            return None
+        # only whole installs are shared, not the builds for single archs
+        if self.arch is not None or self.split_archs():
+            return None
+        return self.recipe.artifact_cache()
+
+    def cached(self):
+        """
+        Returns True if the artifact cache has a build of the package.
+        """
+        cache = self.artifact_cache()
+        return cache is not None and cache.has(self.build_key())
+
+    def restore_artifact(self, dir=None):
+        """
+        Installs the package from the artifact cache if it has a build with
+        the package's build key. Returns True if it did.
+        """
+        if dir is None:
+            dir = self.recipe.ROOTDIR
+        cache = self.artifact_cache()
+        if cache is None:
+            return False
+        # building in the sandbox changes SRCDIR and BLDDIR, so the key is taken first
+        self.artifact_key = self.build_key()
+        install_dir = self.install_prefix(dir)
+        with self.phase('fetch'):
+            stats = cache.restore(self.artifact_key, install_dir)
+        if stats is None:
+            return False
+        logging.info("Installed %s from the artifact cache (%d bytes)" % (self.name, stats['bytes']))
+        return True
+
+    def store_artifact(self, install_dir):
+        """
+        Adds the staged install of the package to the artifact cache.
+        """
+        cache = self.artifact_cache()
+        if cache is None or self.artifact_key is None:
+            return
+        staged = self.sandbox.staged_path(install_dir)
+        if os.path.isdir(staged):
+            cache.store(self.artifact_key, staged)
 
-        needs_built = True
-        success = True
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Adds the time spent in the with block to the timings of the given phase.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.time() - start
+
+    def plan_action(self, dir=None, args=[]):
+        """
+        Returns what build() would do, without building anything: 'installed',
+        'ignored', 'installer', 'easy_install', 'merged', 'cached',
+        'incremental' or 'full'.
+        """
+        if self.get_prop('ignore', False):
+            return 'ignored'
+        if not "clean" in args and self.installed():
+            return 'installed'
         if not 'clean' in args and self.get_prop('installer'):
-            logging.info("Running installer...")
-            success = self.run_installer(dir)
-            needs_built = False
-            
+            return 'installer'
         if self.get_prop('easy_install'):
-            logging.info("Running easy_install...")
-            success = self.run_easy_install(args)
-            needs_built = False
-        
-        if needs_built and not self.source_exists(dir):
-            logging.error("Source not found.")
-            return False
+            return 'easy_install'
+        if not 'clean' in args and self.split_archs():
+            return 'merged'
+        if not 'clean' in args and self.cached():
+            return 'cached'
+        return self.build_mode(dir)
+
+    def build(self, dir=None, args=[]):
+        """
+        Build the software, which is located in the specified base dir.
+        """
+        if dir is None:
+            dir = self.recipe.ROOTDIR
+            
+        self.SRCDIR = self.source_dir(dir).replace('\\', '/')
+        self.BLDDIR = self.build_dir(dir).replace('\\', '/')
+
+        self.env = self.env_values()
+        old_env = {}
+        for env in self.env:
+            if env in os.environ:
+                old_env[env] = os.environ[env]
+            os.environ[env] = self.env[env]
 
         olddir = os.getcwd()
-        if needs_built:
-            os.chdir(self.SRCDIR)
+        success = False
+        try:
+            if not "clean" in args:
+                if self.installed(): # if we're already installed and using proper version, exit
+                    logging.info("%s is installed and up-to-date, skipping..." % self.get_prop('name'))
+                    self.action = 'installed'
+                    return True
 
-        pre_cmds = []
-        if not "clean" in args: 
-            pre_cmds.extend(self.get_prop('prebuild_cmds', default=[]))
-        
-        for cmd in pre_cmds:
-            if sys.platform.startswith('win'):
-                cmd = cmd.replace('/', '\\\\')
-            if cmd.startswith('cd '):
-                os.chdir(cmd.replace('cd ', ''))
-            elif run_in_venv(self.recipe.ROOTDIR, cmd) != 0:
-                logging.error("pre-build command '%s' failed, exiting..." % cmd)
-                sys.exit(1)
+            if self.get_prop('ignore', False):
+                logging.info("Ignoring %s"%self.props['name'])
+                self.action = 'ignored'
+                return True
 
+            needs_built = True
+            success = True
+            if not 'clean' in args and self.get_prop('installer'):
+                logging.info("Running installer...")
+                self.action = 'installer'
+                with self.phase('installer'):
+                    success = self.run_installer(dir)
+                needs_built = False
 
-        if needs_built:
-            logging.info("Building %s" % self.get_prop('name'))
-            build_type = 'cxx'
-            if 'build_type' in self.props:
-                build_type = self.props['build_type']
+            if self.get_prop('easy_install'):
+                logging.info("Running easy_install...")
+                self.action = 'easy_install'
+                with self.phase('installer'):
+                    success = self.run_easy_install(args)
+                needs_built = False
+
+            if needs_built and not 'clean' in args and self.split_archs():
+                # the archs were built as packages of their own
+                self.action = 'merged'
+                with self.phase('merge'):
+                    self.merge_archs(dir)
+                needs_built = False
+
+            if needs_built and not 'clean' in args and self.restore_artifact(dir):
+                self.action = 'cached'
+                needs_built = False
+
+            if needs_built:
+                self.action = self.build_mode(dir)
+                with self.phase('fetch'):
+                    found = self.source_exists(dir)
+                if not found:
+                    logging.error("Source not found.")
+                    return False
+                if not 'clean' in args:
+                    self.sandbox = self.make_sandbox(dir)
+                if self.sandbox is not None:
+                    with self.phase('sandbox'):
+                        copied = self.sandbox.sync_in()
+                    logging.info("Building in %s (%d source files copied)" % (self.sandbox.root, copied))
+                    self.SRCDIR = self.sandbox.path(self.SRCDIR)
+                    self.BLDDIR = self.sandbox.path(self.BLDDIR)
 
-            success = eval("self.%s_build(dir, args=args)" % build_type)
-        
-        if success:
-            olddir2 = os.getcwd()
             if needs_built:
                 os.chdir(self.SRCDIR)
-            success = self.postinstall(dir, args)
-            os.chdir(olddir2)
-            
-        for env in old_env:
-            os.environ[env] = old_env[env]
 
-        os.chdir(olddir)
-        return success
+            pre_cmds = []
+            # a cached or merged package has no sources to prepare
+            if not "clean" in args and self.action not in ['cached', 'merged']:
+                pre_cmds.extend(self.get_prop('prebuild_cmds', default=[]))
+
+            with self.phase('prebuild'):
+                for cmd in pre_cmds:
+                    if sys.platform.startswith('win'):
+                        cmd = cmd.replace('/', '\\\\')
+                    if cmd.startswith('cd '):
+                        os.chdir(cmd.replace('cd ', ''))
+                    elif run_in_venv(self.recipe.ROOTDIR, cmd) != 0:
+                        raise BuildError("pre-build command '%s' failed" % cmd)
+
+
+            if needs_built:
+                logging.info("Building %s" % self.get_prop('name'))
+                build_type = 'cxx'
+                if 'build_type' in self.props:
+                    build_type = self.props['build_type']
+
+                with self.phase('build'):
+                    success = eval("self.%s_build(dir, args=args)" % build_type)
+
+            # the builds for single archs are set up once they are merged
+            if success and self.arch is None:
+                olddir2 = os.getcwd()
+                if needs_built:
+                    os.chdir(self.SRCDIR)
+                with self.phase('postinstall'):
+                    success = self.postinstall(dir, args)
+                os.chdir(olddir2)
+
+            return success
+        finally:
+            for env in old_env:
+                os.environ[env] = old_env[env]
+            self.env = None
+            os.chdir(olddir)
+            if self.sandbox is not None:
+                # builds to be merged with lipo are removed by the merge
+                merging = self.arch is not None and self.arch_merge() == 'lipo'
+                if success and not merging and not self.get_prop('scratch_keep', False) in [True, "TRUE"]:
+                    self.sandbox.remove()
+                elif not success:
+                    logging.info("Keeping %s to look into the failure" % self.sandbox.root)
+                self.sandbox = None
 
     def postinstall(self, dir=None, args=[]):
         if dir is None:
@@ -530,16 +1116,20 @@ class Dependency(object):
         if script_filename is not None:
             filename = self.abs_path_for_path(script_filename)
             if os.path.exists(filename):
-                script = open(filename, 'r').read()
-                script = self.perform_substitutions(script)
-                exec(script)
+                # run the script in its own interpreter, which substitutes the
+                # variables passed to it through the environment
+                env = dict(os.environ)
+                for name, value in self.substitution_vars(dir).items():
+                    env['GATTAI_' + name] = value or ''
+                cmd = [sys.executable, '-c', POSTINSTALL_BOOTSTRAP, filename]
+                if buildlog.run_command(cmd, env=env, shell=False) != 0:
+                    raise BuildError("postinstall script '%s' failed" % filename)
         
         for cmd in post_cmds:
             if cmd.startswith('cd '):
                 os.chdir(cmd.replace('cd ', ''))
             elif run_in_venv(self.recipe.ROOTDIR, cmd) != 0:
-                logging.error("'%s' failed, exiting..." % cmd)
-                sys.exit(1)
+                raise BuildError("'%s' failed" % cmd)
 
         return True
         
@@ -564,15 +1154,27 @@ class Dependency(object):
             result = self.perform_substitutions(result)
         return result
 
+    def cxx_format(self):
+        format = 'autoconf'
+        if sys.platform.startswith('win'):
+            format = 'msvc'
+        return self.get_prop('format', format)
+
+    def build_jobs(self):
+        """
+        Returns how many commands the package's own build may run at once,
+        the number of CPUs its cpu_weight reserves from the budget.
+        """
+        return max(1, int(float(self.get_prop('cpu_weight', default=1))))
+
     def cxx_build(self, dir=None, args=[]):
         if dir is None:
             dir = self.recipe.ROOTDIR
         
-        format = 'autoconf'
-        if sys.platform.startswith('win'):
-            format = 'msvc'
-            
-        format = self.get_prop('format', format)
+        format = self.cxx_format()
+        build_dir = self.build_dir(dir)
+        if self.sandbox is not None:
+            build_dir = self.sandbox.path(build_dir)
 
         import builder
         dep_builder = None
@@ -603,6 +1205,11 @@ class Dependency(object):
             dep_builder = builder.GNUMakeBuilder()
         elif format == 'autoconf':
             dep_builder = builder.AutoconfBuilder()
+        elif format == 'cmake':
+            dep_builder = builder.CMakeBuilder(generator=self.get_prop('cmake_generator', default=None), jobs=self.build_jobs())
+        elif format == 'ninja':
+            project_file = self.get_prop('project_file', default=None)
+            dep_builder = builder.NinjaBuilder(jobs=self.build_jobs())
     
         if format != 'msvc':
             for inc in include_dirs:
@@ -625,10 +1232,15 @@ class Dependency(object):
                 
         if 'clean' in args:
             logging.info("Cleaning %r" % self.name)
-            dep_builder.clean(self.build_dir(dir))
+            dep_builder.clean(build_dir)
         else:
-            install_dir = os.path.abspath(self.get_prop('install_dir', default=os.path.abspath(dir)))
-            configure_args = ['--prefix="%s"' % install_dir]
+            install_dir = self.install_prefix(dir)
+            # CMake and Ninja take the flags when the build files are generated,
+            # not as make variables
+            native = format in ['cmake', 'ninja']
+            configure_args = []
+            if not native:
+                configure_args.append('--prefix="%s"' % install_dir)
             configure_args.extend(self.get_prop('configure_args', default=[]))
             
             # Extra flags to be placed on CFLAGS and CXXFLAGS to be passed
@@ -643,7 +1255,8 @@ class Dependency(object):
             if sys.platform.startswith('darwin'):
                 archs = self.get_prop('archs', default=None)
                 if archs is not None:
-                    configure_args.append('--disable-dependency-tracking')
+                    if not native:
+                        configure_args.append('--disable-dependency-tracking')
                     for arch in archs:
                         archflag = ['-arch', arch]
                         extra_cflags.extend(archflag)
@@ -659,14 +1272,17 @@ class Dependency(object):
                     extra_cflags.append("-mmacosx-version-min=%s" % min_version)
                     extra_ldflags.append("-mmacosx-version-min=%s" % min_version)
 
-            if not sys.platform.startswith('win'):
+            if format == 'cmake':
+                configure_args = dep_builder.flagOptions(install_dir, extra_cflags, extra_ldflags) + configure_args
+            elif not native and not sys.platform.startswith('win'):
                 cxx_args.append('CFLAGS="%s"' % ' '.join(extra_cflags))
                 cxx_args.append('CXXFLAGS="%s"' % ' '.join(extra_cflags))
                 cxx_args.append('LDFLAGS="%s"' % ' '.join(extra_ldflags))
 
             result = 0
-            cxx_args.append('prefix="%s"' % install_dir)
-            sdir = self.build_dir(dir)
+            if not native:
+                cxx_args.append('prefix="%s"' % install_dir)
+            sdir = build_dir
             dependencies = [ os.path.join(sdir, 'Makefile.in'),
                 os.path.join(sdir, 'configure'),
             ]
@@ -678,22 +1294,37 @@ class Dependency(object):
                 final_args = []
                 for a in configure_args + cxx_args:
                     final_args.append(self.perform_substitutions(a))
-                result = dep_builder.configure(self.build_dir(dir), options=final_args)
+                result = dep_builder.configure(build_dir, options=final_args)
             
             if result == 0:
                 logging.debug("Project file: %r" % project_file)
-                result = dep_builder.build(self.build_dir(dir), projectFile=project_file, options=cxx_args)
+                result = dep_builder.build(build_dir, projectFile=project_file, options=cxx_args)
             if result == 0:
-                inst_result = dep_builder.install(self.build_dir(dir), projectFile=project_file, options=cxx_args)
+                install_args = cxx_args
+                install_options = {}
+                if self.sandbox is not None:
+                    if native:
+                        install_options['destdir'] = self.sandbox.stage
+                    else:
+                        install_args = cxx_args + ['DESTDIR="%s"' % self.sandbox.stage]
+                inst_result = dep_builder.install(build_dir, projectFile=project_file, options=install_args, **install_options)
                 # sometimes there are expected errors that can be ignored, so handle that case here.
                 if not self.get_prop('ignore_install_errors', default=False):
                     result = inst_result
+                if self.sandbox is not None:
+                    if result == 0:
+                        self.store_artifact(install_dir)
+                    if self.arch is not None and self.arch_merge() == 'lipo':
+                        logging.info("Keeping the install in %s to be merged" % self.sandbox.stage)
+                    else:
+                        copied = self.sandbox.sync_out(install_dir)
+                        logging.info("Copied %d installed files to %s" % (copied, install_dir))
             
             if result != 0:
                 if 'optional' in self.props and self.props['optional'] == True:
                     return False
                 else:
-                    sys.exit(1)
+                    raise BuildError("Building %s failed" % self.name)
         
         return True
     
@@ -721,25 +1352,72 @@ class Dependency(object):
         return run_in_venv(self.recipe.ROOTDIR, ' '.join(py_args)) == 0
 
 class GattaiRecipe(object):
+    # When set to dicts, installed() results and existing source dirs are
+    # remembered instead of being probed again. Used by long-running modes
+    # like watch, which invalidate entries themselves.
+    probe_cache = None
+    path_cache = None
+    # versions of the packages already installed, see install_index()
+    index = None
+    # the lockfile entries of the packages that still match it, see check_lock()
+    locked = {}
+    # where built packages are cached, see artifact_cache()
+    artifact_store = None
+    # packages that changed since the last run or depend on ones that did,
+    # see replan()
+    changed = frozenset()
+
     def __init__(self, filename):
-        self.json = json_loader.load(open(filename))
-        self.settings = self.json['settings']
-        if sys.platform in self.settings:
-            self.settings.update(self.settings[sys.platform])
-        self.deps = self.json['packages']
         self.filename = os.path.abspath(filename)
+        self.load()
         
         self.ROOTDIR = os.getcwd()
         self.PYTHON = 'python'
         self.HOMEDIR = get_user_home_dir()
         
         self.setup_venv()
-        fh = logging.FileHandler('gattai.log')
-        logging.getLogger().addHandler(fh)
-        
+        self.substitute_settings()
+
+        self.setup_logging()
+
+        self.state_dir = os.path.abspath(self.settings.get('state_dir', os.path.join(self.ROOTDIR, '.gattai')))
+        self.history = history.BuildHistory(os.path.join(self.state_dir, 'history.json'))
+        toolchain.use_cache(os.path.join(self.state_dir, 'toolchain.json'))
+
+    def load(self):
+        # the loaded JSON is never changed, settings and packages are
+        # read-only records referring to it
+        self.json = load_json(open(self.filename))
+        self.settings = PackageProps.resolve(self.json['settings'], sys.platform)
+        self.deps = [PackageProps.resolve(dep, sys.platform) for dep in self.json['packages']]
+        self.packages = dict((dep['name'], dep) for dep in self.deps)
+
+    def substitute_settings(self):
+        substituted = {}
         for setting in self.settings:
-            sub_value = self.perform_substitutions(self.settings[setting])
-            self.settings[setting] = sub_value
+            value = self.settings[setting]
+            sub_value = self.perform_substitutions(value)
+            if sub_value != value:
+                substituted[setting] = sub_value
+        self.settings = self.settings.override(substituted)
+
+    def reload(self):
+        """
+        Re-reads the recipe file and returns the names of the packages whose
+        definition changed, which is all of them if the settings changed.
+        """
+        old_json = self.json
+        self.load()
+        self.substitute_settings()
+        if self.path_cache is not None:
+            self.path_cache.clear()
+
+        old_packages = dict((dep['name'], dep) for dep in old_json['packages'])
+        changed = set()
+        for dep in self.json['packages']:
+            if old_json['settings'] != self.json['settings'] or old_packages.get(dep['name']) != dep:
+                changed.add(dep['name'])
+        return changed
 
     def perform_substitutions(self, value):
         ROOTDIR = self.ROOTDIR
@@ -773,37 +1451,719 @@ class GattaiRecipe(object):
         
         return venv
 
+    def setup_logging(self):
+        """
+        Sends orchestration messages to gattai.log and gives every package its
+        own log under log_dir for the output of its build.
+        """
+        global _log_handler
+        if _log_handler is None:
+            _log_handler = logging.FileHandler('gattai.log')
+            logging.getLogger().addHandler(_log_handler)
+
+        log_dir = self.settings.get('log_dir', os.path.join(self.ROOTDIR, 'gattai_logs'))
+        tail_lines = int(self.settings.get('log_tail_lines', buildlog.DEFAULT_TAIL_LINES))
+        self.logs = buildlog.LogManager(os.path.abspath(log_dir),
+                                        events_path=self.settings.get('log_events', None),
+                                        compress=self.settings.get('compress_logs', False) in [True, "TRUE"],
+                                        tail_lines=tail_lines)
+
     def list_targets(self):
         return ", ".join( [dep["name"] for dep in self.deps] )
-        
-    def build_deps(self, targets=["all"], arguments=[]):
-        if sys.platform.startswith("win"):
-            has_nmake = False
-            try:
-                has_nmake = subprocess.call(['nmake', '/?'], stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
-            except:
-                pass
-        
-            if not has_nmake:
-                logging.error('Cannot run nmake, have you run "%VS90COMNTOOLS%vsvars32.bat"?')
-                sys.exit(1)
-    
+
+    def build_graph(self):
+        depends = {}
         for dep in self.deps:
-            builder = Dependency(self, dep)
-            args = []
-            action = "Getting"
+            depends[dep['name']] = dep.get('depends')
+        return graph.BuildGraph([dep['name'] for dep in self.deps], depends)
+
+    def plan(self, targets=["all"], arguments=[], jobs=1, diff=True):
+        """
+        Returns a report of what build_deps would do for each package and how
+        long it is expected to take, without building anything.
+
+        diff = skip the packages that haven't changed since the last run
+        """
+        args = []
+        if 'clean' in arguments:
+            args.append('clean')
+
+        self.refresh_index()
+        self.check_lock()
+        build_graph = self.build_graph()
+        outdated = None
+        if diff and not 'clean' in args:
+            outdated = self.replan(build_graph)[2]
+            if not "all" in targets:
+                outdated = None
+        if not 'clean' in args:
+            packages = [(name, Dependency(self, self.package_props(name))) for name in build_graph.names]
+            build_graph = expand_archs(build_graph, packages, {}, {})[0]
+        durations = {}
+        unknown = []
+        lines = []
+        for node in build_graph.order:
+            name, arch = multiarch.split_node(node)
+            if arch == multiarch.SOURCE:
+                # unpacking the source is part of the build for the first arch
+                durations[node] = 0
+                continue
+            builder = Dependency(self, self.package_props(name))
             target_name = builder.name + '-' + builder.props['version']
-            if dep["name"] in targets or "all" in targets:
-                if 'clean' in arguments:
-                    args.append('clean')
-                    action = "Cleaning"
-            
-                logging.info(action + " %s" % target_name)
-                if not builder.build(args=args):
-                    logging.error("Build failed for %s. Exiting..." % builder.name)
-                    sys.exit(1)
+            if arch is not None:
+                builder = builder.arch_build(arch)
+                target_name += '-' + arch
+            if not name in targets and not "all" in targets:
+                action = 'not targeted'
+            elif outdated is not None and not name in outdated:
+                action = 'unchanged'
+            else:
+                action = builder.plan_action(args=args)
+            estimate = 0
+            if action not in ['installed', 'ignored', 'not targeted', 'unchanged', 'merged']:
+                estimate = self.history.estimate(name, action)
+                if estimate is None:
+                    unknown.append(node)
+                    estimate = 0
+            durations[node] = estimate
+            lines.append("%-40s %-14s %s" % (target_name, action, format_duration(estimate) if node not in unknown else '?'))
+
+        lines.append("")
+        priority = scheduler.Scheduler(build_graph, durations, jobs).priority
+        lines.append("Predicted wall time with %d job(s): %s" % (jobs, format_duration(build_graph.simulate(durations, jobs, priority))))
+        critical_path = [name for name in build_graph.critical_path(durations) if durations[name] > 0]
+        if critical_path:
+            lines.append("Critical path: %s" % " -> ".join(critical_path))
+        if unknown:
+            lines.append("No timing history for: %s" % ", ".join(unknown))
+        return "\n".join(lines)
+        
+    def watch(self, targets=["all"], arguments=[], jobs=1, interval=1.0):
+        """
+        Builds the targets, then keeps rebuilding whatever is affected by
+        changes to the recipe or package sources until interrupted.
+        """
+        watch.watch_recipe(self, targets, arguments, jobs, interval)
+
+    def build_package(self, name, args=[], arch=None):
+        """
+        Builds a single package, or only its build for arch if it is given
+        (or its source, if arch is multiarch.SOURCE), logging its output to its own log. Returns a (success, (action,
+        timings, peak memory in MB)) tuple as expected by the Scheduler.
+        """
+        builder = Dependency(self, self.package_props(name))
+        target_name = builder.name + '-' + builder.props['version']
+        if arch == multiarch.SOURCE:
+            target_name += '-source'
+        elif arch is not None:
+            builder = builder.arch_build(arch)
+            target_name += '-' + arch
+        action = "Getting"
+        if 'clean' in args:
+            action = "Cleaning"
+        logging.info(action + " %s" % target_name)
+
+        log = self.logs.open_package(target_name)
+        success = False
+        start = time.time()
+        olddir = os.getcwd()
+        # downloads and extraction happen relative to the current directory
+        os.chdir(self.ROOTDIR)
+        peak = resources.PeakMemory()
+        try:
+            with peak:
+                if arch == multiarch.SOURCE:
+                    success = builder.prepare_source()
+                else:
+                    success = builder.build(args=args)
+        except BuildError, e:
+            logging.error(str(e))
+        finally:
+            os.chdir(olddir)
+            self.logs.close_package(log, success)
+        builder.timings['total'] = time.time() - start
+        return bool(success), (builder.action, builder.timings, peak.peak_mb)
+
+    def package_weight(self, name):
+        """
+        Returns the (cpus, mem_mb) building the package needs, from its
+        cpu_weight and mem_mb props or else the memory its last builds used.
+        """
+        builder = Dependency(self, self.package_props(name))
+        cpus = float(builder.get_prop('cpu_weight', default=1))
+        mem_mb = builder.get_prop('mem_mb', default=None)
+        if mem_mb is None:
+            mem_mb = self.history.memory(name) or 0
+        return cpus, int(mem_mb)
+
+    def budget(self):
+        """
+        Returns the resources.Budget parallel builds have to fit into.
+        """
+        cpus = self.settings.get('cpu_budget', None)
+        mem_mb = self.settings.get('mem_budget_mb', None)
+        if cpus is not None:
+            cpus = float(cpus)
+        if mem_mb is not None:
+            mem_mb = int(mem_mb)
+        return resources.Budget(cpus, mem_mb)
+
+    def site_dirs(self):
+        """
+        Returns the site-packages dirs of the interpreter Python packages are
+        installed with.
+        """
+        if self.PYTHON == sys.executable:
+            return [dir for dir in sys.path if os.path.basename(dir) in ['site-packages', 'dist-packages']]
+        # a virtualenv in the root dir
+        return glob.glob(os.path.join(self.ROOTDIR, 'lib', 'python*', 'site-packages')) + \
+               glob.glob(os.path.join(self.ROOTDIR, 'Lib', 'site-packages'))
+
+    def install_index(self):
+        """
+        Returns the InstallIndex installed() looks packages up in.
+        """
+        if self.index is None:
+            self.refresh_index()
+        return self.index
+
+    def refresh_index(self):
+        """
+        Forgets what was installed before, and reads what is installed now.
+        Called at the start of each run, before build jobs are forked, so
+        they share what was read.
+        """
+        self.index = inventory.InstallIndex(self.site_dirs())
+        self.index.preload(self.settings.get('install_dir'))
+
+    def lock_filename(self):
+        return lockfile.lock_filename(self.filename)
+
+    def check_lock(self):
+        """
+        Trusts the lockfile's entries for the packages that still match it,
+        and warns about the ones that have drifted. Telling which match means
+        resolving every package's props and tool versions, but not probing
+        for their archives, dirs or build keys.
+        """
+        self.locked = {}
+        lock = lockfile.Lock(self.lock_filename())
+        if not lock.packages:
+            return
+        digests = dict((dep['name'], Dependency(self, dep).lock_digest()) for dep in self.deps)
+        added, removed, changed = lock.drift(digests)
+        for name in digests:
+            if name in lock.packages and not name in changed:
+                self.locked[name] = lock.packages[name]
+        if added or removed or changed:
+            logging.warning("The recipe no longer matches %s, run 'gattai lock' to update it" % lock.filename)
+            for label, names in [("Added", added), ("Removed", removed), ("Changed", changed)]:
+                if names:
+                    logging.warning("    %s: %s" % (label, ", ".join(names)))
+
+    def lock(self):
+        """
+        Writes the lockfile, downloading the source archives that aren't
+        there yet so that their digests can be recorded. Returns a report of
+        what changed since the last lock.
+        """
+        self.locked = {}
+        deps = [Dependency(self, dep) for dep in self.deps]
+        missing = {}
+        for dep in deps:
+            archive = dep.source_archive()
+            if archive and not os.path.exists(archive) and not dep.get_prop('ignore', False):
+                missing[archive] = dep.get_prop('source')
+
+        if missing:
+            logging.info("Downloading %d source archives to record their digests" % len(missing))
+            fetch_all(missing, self.download_jobs())
+
+        lock = lockfile.Lock(self.lock_filename())
+        old = lock.packages
+        lock.packages = dict((dep.name, dep.make_lock_entry()) for dep in deps)
+        lock.save()
+
+        lines = ["Locked %d packages in %s" % (len(deps), lock.filename)]
+        for dep in deps:
+            entry = lock.packages[dep.name]
+            if dep.name not in old:
+                lines.append("    added %s" % dep.name)
+            elif old[dep.name] != entry:
+                keys = sorted(key for key in entry if old[dep.name].get(key) != entry[key])
+                lines.append("    changed %s: %s" % (dep.name, ", ".join(keys)))
+            if entry['archive'] and entry['sha256'] is None:
+                lines.append("    %s has no digest, its archive could not be downloaded" % dep.name)
+        for name in sorted(old):
+            if name not in lock.packages:
+                lines.append("    removed %s" % name)
+        return "\n".join(lines)
+
+    def download_jobs(self):
+        return int(self.settings.get('download_jobs', DOWNLOAD_JOBS))
+
+    def artifact_cache(self):
+        """
+        Returns the ArtifactCache built packages are shared through, or None
+        if the recipe sets neither artifact_dir nor artifact_url.
+        """
+        if self.artifact_store is None:
+            url = self.settings.get('artifact_url')
+            local_dir = self.settings.get('artifact_dir')
+            if not url and not local_dir:
+                return None
+            if not local_dir:
+                local_dir = os.path.join(self.state_dir, 'artifacts')
+            self.artifact_store = artifacts.ArtifactCache(os.path.abspath(local_dir), url)
+        return self.artifact_store
+
+    def artifact_uploads(self):
+        return int(self.settings.get('artifact_uploads', artifacts.DEFAULT_UPLOADS))
+
+    def monitor(self, loop, total, jobs):
+        """
+        Returns the progress.Monitor showing how a run building total
+        packages with jobs job slots is going.
+        """
+        status = None
+        show_status = self.settings.get('status_line', None)
+        if show_status in [True, "TRUE"] or (show_status is None and sys.stderr.isatty()):
+            status = progress.StatusLine(sys.stderr)
+        port = self.settings.get('metrics_port', None)
+        if port is not None:
+            port = int(port)
+        return progress.Monitor(progress.BuildMetrics(total, jobs), loop, status, port)
+
+    def report_finish(self, monitor, node, name, result):
+        """
+        Counts the result of build_package in the run's metrics.
+        """
+        success, info = result
+        cached = Dependency(self, self.package_props(name)).artifact_cache() is not None
+        monitor.finished(node, success, info and info[0], cached)
+
+    def package_props(self, name):
+        return self.packages[name]
+
+    def resolved_recipe(self):
+        return recipediff.ResolvedRecipe(os.path.join(self.state_dir, 'resolved.json'), Dependency.RUN_PROPS)
+
+    def replan(self, build_graph):
+        """
+        Compares the recipe with what it resolved to in the last run, logging
+        the differences, and sets the packages that changed and the ones
+        depending on them to be rebuilt. Returns the ResolvedRecipe of the
+        last run, a dict mapping package names to what they resolve to now,
+        and the set of packages that have to be looked at, or None if all of
+        them have to be because there was no earlier run.
+        """
+        last = self.resolved_recipe()
+        resolved = dict((name, Dependency(self, props).fingerprint()) for name, props in self.packages.items())
+        if not last.exists:
+            self.changed = frozenset()
+            return last, resolved, None
+        added, removed, changed = last.diff(resolved)
+        lines = recipediff.format_diff(added, removed, changed)
+        if lines:
+            logging.info("The recipe changed since the last run:")
+            for line in lines:
+                logging.info(line)
+        # new packages may already be installed, but what depends on them is rebuilt
+        self.changed = frozenset(build_graph.transitive_dependents(added + changed.keys()) - set(added))
+        outdated = set(self.changed)
+        outdated.update(name for name in resolved if not last.built(name))
+        return last, resolved, outdated
+
+    def record_build(self, name, result, args=[]):
+        """
+        Records the result of build_package in the build history. Returns
+        False if the build failed.
+        """
+        success, info = result
+        if not success:
+            logging.error("Build failed for %s." % name)
+            return False
+        action, timings, mem_mb = info
+        # merging archs or unpacking their source takes little time next to building them
+        if not 'clean' in args and action not in [None, 'installed', 'ignored', 'merged', 'fetched']:
+            self.history.record(name, action, timings.pop('total'), timings, mem_mb)
+            self.history.save()
+        return True
+
+    def run_state(self):
+        return history.RunState(os.path.join(self.state_dir, 'last_run.json'))
+
+    def build_deps(self, targets=["all"], arguments=[], jobs=1, keep_going=False, resume=False, diff=True):
+        """
+        Builds the targets and the packages they depend on. Raises BuildError
+        if any of them failed to build.
+
+        keep_going = keep building the packages that don't depend on a failed one
+        resume = only build the packages the last run failed or didn't get to
+        diff = skip the packages that haven't changed since the last run
+        """
+        check_build_tools()
+        self.refresh_index()
+        self.check_lock()
+        args = []
+        if 'clean' in arguments:
+            args.append('clean')
+
+        build_graph = self.build_graph()
+        selected = []
+        for name in build_graph.order:
+            if name in targets or "all" in targets:
+                selected.append(name)
             else:
-                logging.info("Skipping %s" % target_name)
+                builder = Dependency(self, self.package_props(name))
+                logging.info("Skipping %s-%s" % (builder.name, builder.props['version']))
+
+        last = None
+        if diff and not 'clean' in args:
+            last, resolved, outdated = self.replan(build_graph)
+            # packages asked for by name are always looked at
+            if outdated is not None and "all" in targets:
+                unchanged = [name for name in selected if not name in outdated]
+                if unchanged:
+                    logging.info("Skipping %d package(s) unchanged since they were built" % len(unchanged))
+                selected = [name for name in selected if name in outdated]
+
+        # cleaning doesn't count as building anything
+        state = None
+        if not 'clean' in args:
+            state = self.run_state()
+            if resume:
+                if not state.exists:
+                    raise BuildError("There is no earlier run of %s to resume" % self.filename)
+                unfinished = state.unfinished(selected)
+                logging.info("Resuming: %d packages were already built, %d left to build" %
+                             (len(selected) - len(unfinished), len(unfinished)))
+                selected = unfinished
+            state.start(selected, resume)
+
+        durations = {}
+        weights = {}
+        for name in selected:
+            durations[name] = self.history.estimate(name) or 0
+            weights[name] = self.package_weight(name)
+        nodes = selected
+        if not 'clean' in args:
+            build_graph, nodes = expand_archs(build_graph, [(name, Dependency(self, self.package_props(name))) for name in selected],
+                                              durations, weights)
+
+        loop = eventloop.EventLoop()
+        cache = self.artifact_cache()
+        uploader = artifacts.Uploader(loop, self.artifact_uploads())
+        failed = []
+        finished = []
+        succeeded = []
+        def build(node):
+            name, arch = multiarch.split_node(node)
+            return self.build_package(name, args, arch)
+        def on_finish(node, result):
+            name, arch = multiarch.split_node(node)
+            self.report_finish(monitor, node, name, result)
+            success = self.record_build(name, result, args)
+            finished.append(node)
+            # a package split into archs is done once they are merged
+            if success and arch is None:
+                succeeded.append(name)
+            if state is not None and (arch is None or not success):
+                state.finish(name, success)
+            if cache is not None:
+                uploader.submit_pending(cache)
+            if not success:
+                failed.append(node)
+                return keep_going
+            return True
+
+        build_scheduler = scheduler.Scheduler(build_graph, durations, jobs, loop, weights, self.budget())
+        monitor = self.monitor(loop, len(nodes), build_scheduler.jobs)
+        downloads = []
+        if not 'clean' in args:
+            downloads = prefetched(source_builds(nodes, lambda name: Dependency(self, self.package_props(name))))
+        pool, held = start_downloads(loop, downloads, self.download_jobs(), build_scheduler.release,
+                                     monitor.metrics.downloaded)
+        try:
+            monitor.start()
+            if cache is not None:
+                # uploads an interrupted run didn't get to
+                uploader.submit_pending(cache)
+            build_scheduler.run(nodes, build, on_finish, held, monitor.started)
+            uploader.wait()
+        finally:
+            monitor.stop()
+            uploader.close()
+            pool.close()
+            loop.close()
+            if last is not None:
+                last.update(resolved, selected, succeeded, self.changed)
+                last.save()
+        check_failures(failed, [node for node in nodes if not node in finished], state is not None)
+
+class RecipeBatch(object):
+    def __init__(self, filenames):
+        """
+        Loads several recipes to be built together. Packages that resolve to
+        the same build in more than one recipe are built only once, and all
+        packages share one scheduler and job budget.
+        """
+        self.recipes = []
+        cwd = os.getcwd()
+        for filename in filenames:
+            # recipes using a virtualenv change to it while loading
+            os.chdir(cwd)
+            self.recipes.append(GattaiRecipe(filename))
+        os.chdir(cwd)
+
+    def build_graph(self):
+        """
+        Returns the combined graph of all the recipes' packages, along with a
+        dict mapping each of its node names to the (recipe, package name) that
+        builds it.
+        """
+        nodes = {}
+        node_names = []
+        recipe_nodes = []
+        for recipe in self.recipes:
+            names = {}
+            for dep in recipe.deps:
+                key = Dependency(recipe, dep).build_key()
+                node = "%s-%s" % (dep['name'], key[:8])
+                if node not in nodes:
+                    nodes[node] = (recipe, dep['name'])
+                    node_names.append(node)
+                names[dep['name']] = node
+            recipe_nodes.append(names)
+
+        depends = dict((node, []) for node in node_names)
+        for recipe, names in zip(self.recipes, recipe_nodes):
+            recipe_graph = recipe.build_graph()
+            for name in recipe_graph.names:
+                node_depends = depends[names[name]]
+                for dep in recipe_graph.dependencies(name):
+                    if names[dep] not in node_depends:
+                        node_depends.append(names[dep])
+        return graph.BuildGraph(node_names, depends), nodes
+
+    def build_deps(self, targets=["all"], arguments=[], jobs=1, keep_going=False):
+        """
+        Builds the targets of every recipe, raising BuildError if any package
+        failed to build.
+
+        keep_going = keep building the packages that don't depend on a failed one
+        """
+        check_build_tools()
+        for recipe in self.recipes:
+            recipe.refresh_index()
+            recipe.check_lock()
+        args = []
+        if 'clean' in arguments:
+            args.append('clean')
+
+        build_graph, nodes = self.build_graph()
+        selected = []
+        durations = {}
+        weights = {}
+        for node in build_graph.order:
+            recipe, name = nodes[node]
+            if name in targets or "all" in targets:
+                selected.append(node)
+                durations[node] = recipe.history.estimate(name) or 0
+                weights[node] = recipe.package_weight(name)
+        logging.info("Building %d distinct packages from %d recipes" % (len(selected), len(self.recipes)))
+        def package(node):
+            recipe, name = nodes[node]
+            return Dependency(recipe, recipe.package_props(name))
+        to_build = selected
+        if not 'clean' in args:
+            build_graph, to_build = expand_archs(build_graph, [(node, package(node)) for node in selected], durations, weights)
+
+        loop = eventloop.EventLoop()
+        uploader = artifacts.Uploader(loop, max([recipe.artifact_uploads() for recipe in self.recipes]))
+        failed = []
+        finished = []
+        def build(node):
+            node, arch = multiarch.split_node(node)
+            recipe, name = nodes[node]
+            return recipe.build_package(name, args, arch)
+        def on_finish(node, result):
+            recipe, name = nodes[multiarch.split_node(node)[0]]
+            recipe.report_finish(monitor, node, name, result)
+            finished.append(node)
+            if recipe.artifact_cache() is not None:
+                uploader.submit_pending(recipe.artifact_cache())
+            if not recipe.record_build(name, result, args):
+                failed.append(node)
+                return keep_going
+            return True
+
+        # the budget is the host's, so the first recipe's settings stand for all of them
+        build_scheduler = scheduler.Scheduler(build_graph, durations, jobs, loop, weights, self.recipes[0].budget())
+        monitor = self.recipes[0].monitor(loop, len(to_build), build_scheduler.jobs)
+        downloads = []
+        if not 'clean' in args:
+            downloads = prefetched(source_builds(to_build, package))
+        download_jobs = max([recipe.download_jobs() for recipe in self.recipes])
+        pool, held = start_downloads(loop, downloads, download_jobs, build_scheduler.release,
+                                     monitor.metrics.downloaded)
+        try:
+            monitor.start()
+            build_scheduler.run(to_build, build, on_finish, held, monitor.started)
+            uploader.wait()
+        finally:
+            monitor.stop()
+            uploader.close()
+            pool.close()
+            loop.close()
+        check_failures(failed, [node for node in to_build if not node in finished])
+
+def check_failures(failed, not_built, resumable=False):
+    """
+    Reports the packages of a run that failed or were never started because
+    of them, raising BuildError if there were any failures.
+    """
+    if not failed:
+        return
+    logging.error("Failed to build: %s" % ", ".join(failed))
+    if not_built:
+        logging.error("Not built because of the failures: %s" % ", ".join(not_built))
+    if resumable:
+        logging.error("Run again with --resume to build only these packages.")
+    raise BuildError("%d package(s) failed to build" % len(failed))
+
+def expand_archs(build_graph, packages, durations, weights):
+    """
+    Splits the packages that build their archs separately into a node
+    preparing their source, a node per arch and a node merging them, see
+    multiarch.expand. packages is a list of
+    (node, Dependency) tuples, the nodes of build_graph to build. Returns the
+    expanded graph and the nodes to build in it, adding the arch nodes to the
+    durations and weights dicts; the sources and merges take neither.
+    """
+    archs = {}
+    merged_first = set()
+    for node, dep in packages:
+        split = dep.split_archs()
+        if split:
+            archs[node] = split
+            if dep.arch_merge() == 'lipo':
+                merged_first.add(node)
+    if not archs:
+        return build_graph, [node for node, dep in packages]
+    nodes = []
+    for node, dep in packages:
+        if node in archs:
+            nodes.append(multiarch.source_node(node))
+            durations[multiarch.source_node(node)] = 0
+        for arch in archs.get(node, []):
+            arch_node = multiarch.arch_node(node, arch)
+            nodes.append(arch_node)
+            durations[arch_node] = durations.get(node, 0)
+            weights[arch_node] = weights.get(node, (1, 0))
+        nodes.append(node)
+        if node in archs:
+            durations[node] = 0
+            weights[node] = (1, 0)
+    return multiarch.expand(build_graph, archs, merged_first), nodes
+
+def source_builds(nodes, package):
+    """
+    Returns (node, Dependency) tuples for those of nodes that need the
+    source of their package: the packages that aren't split into archs, and
+    the nodes preparing the source of the ones that are. package(node)
+    returns the Dependency of a node that isn't an arch's.
+    """
+    split = set(multiarch.split_node(node)[0] for node in nodes if multiarch.split_node(node)[1] is not None)
+    builds = []
+    for node in nodes:
+        name, arch = multiarch.split_node(node)
+        if arch == multiarch.SOURCE or (arch is None and name not in split):
+            builds.append((node, package(name)))
+    return builds
+
+def prefetched(packages):
+    """
+    Returns those of packages, a list of (node, Dependency) tuples, whose
+    sources will be needed, leaving out the ones the artifact cache has.
+    """
+    return [(node, dep) for node, dep in packages if not dep.cached()]
+
+def start_downloads(loop, packages, threads, on_done, progress=None):
+    """
+    Starts downloading the source archives that the packages will need in
+    the background, on at most threads threads. packages is a list of
+    (node, Dependency) tuples. Returns the WorkerPool doing the downloads and
+    the nodes that have to wait for one; on_done(node) is called on the loop
+    once its download has finished, whether or not it succeeded. progress is
+    passed on to fetch_url.
+    """
+    pool = eventloop.WorkerPool(loop, threads)
+    # select can't wait for pipes on Windows, so packages download as they build there
+    if threads < 1 or not hasattr(os, 'fork'):
+        return pool, []
+    waiting = {}
+    for node, dep in packages:
+        filename = dep.prefetch_filename()
+        if filename is None:
+            continue
+        if filename in waiting:
+            waiting[filename].append(node)
+            continue
+        waiting[filename] = [node]
+        url = dep.get_prop('source')
+        def done(result, error, url=url, filename=filename):
+            if error is not None:
+                # the package's build will try again and report the error
+                logging.warning("Downloading %s failed: %s" % (url, error))
+            for node in waiting[filename]:
+                on_done(node)
+        pool.submit(fetch_url, done, url, filename, dep.locked_digest(url), progress)
+    held = []
+    for nodes in waiting.values():
+        held.extend(nodes)
+    if held:
+        logging.info("Downloading %d source archives in the background" % len(waiting))
+    return pool, held
+
+def fetch_all(downloads, threads):
+    """
+    Downloads downloads, a dict mapping filenames to the urls to download
+    them from, on at most threads threads. Failures are logged.
+    """
+    def fetch(filename, url):
+        try:
+            fetch_url(url, filename)
+        except Exception, e:
+            logging.warning("Downloading %s failed: %s" % (url, e))
+    # select can't wait for pipes on Windows, so download one at a time there
+    if not hasattr(os, 'fork'):
+        for filename, url in downloads.items():
+            fetch(filename, url)
+        return
+    loop = eventloop.EventLoop()
+    pool = eventloop.WorkerPool(loop, threads)
+    pending = set(downloads)
+    try:
+        for filename, url in downloads.items():
+            pool.submit(fetch, lambda result, error, filename=filename: pending.discard(filename), filename, url)
+        while pending:
+            loop.run_once()
+    finally:
+        pool.close()
+        loop.close()
+
+def check_build_tools():
+    if sys.platform.startswith("win"):
+        has_nmake = False
+        try:
+            has_nmake = subprocess.call(['nmake', '/?'], stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
+        except:
+            pass
+    
+        if not has_nmake:
+            logging.error('Cannot run nmake, have you run "%VS90COMNTOOLS%vsvars32.bat"?')
+            sys.exit(1)
 
 if __name__ == '__main__':
     main()
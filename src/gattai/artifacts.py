@@ -0,0 +1,397 @@
+"""
+Sharing built packages between machines.
+
+When a recipe sets artifact_dir or artifact_url, the install tree of every
+package built in a sandbox is packed into a tarball named after the
+package's build key and kept in artifact_dir. Before building a package,
+gattai looks for a tarball with its build key there, then at artifact_url,
+and if it finds one installs the package from it instead of building it.
+
+The remote cache is any HTTP server that answers, for /<build key>.tar.gz:
+
+    HEAD  200 if it has the tarball, 404 if not
+    GET   the tarball
+    PUT   stores the request body as the tarball
+
+Uploads send the SHA-256 of the tarball in an X-Gattai-SHA256 header, and
+downloads have to come with the same header. A tarball whose digest is
+missing or doesn't match is thrown away instead of being installed.
+
+Builds only mark what they added to the local cache as waiting to be
+uploaded. The uploads are done by the main process on a bounded pool of
+threads, so that builds never wait for them and a run doesn't saturate the
+uplink, and uploads left over by an interrupted run are done by the next
+one. A server that can't be reached is only reported once, and the run
+carries on as if there was no remote cache. 'gattai serve-cache <dir>' runs a reference
+server keeping the tarballs in dir, only listening on the loopback
+interface unless it is given another host.
+"""
+
+import BaseHTTPServer
+import hashlib
+import logging
+import os
+import re
+import shutil
+import socket
+import SocketServer
+import tarfile
+import urllib2
+
+import eventloop
+import extract
+import sandbox
+
+SUFFIX = '.tar.gz'
+DEFAULT_PORT = 8780
+DEFAULT_HOST = '127.0.0.1'
+DIGEST_HEADER = 'X-Gattai-SHA256'
+DEFAULT_UPLOADS = 2
+TIMEOUT = 30
+CHUNK_SIZE = 1024 * 1024
+
+# build keys are hex digests, so names that aren't can't be artifacts
+ARTIFACT_PATH = re.compile(r'^/([0-9a-f]+)' + re.escape(SUFFIX) + '$')
+
+def pack_tree(tree, filename):
+    """
+    Writes the contents of tree to the tarball filename, going through a
+    temporary file so that a partial tarball is never mistaken for a
+    complete one.
+    """
+    tmp_filename = filename + '.part'
+    tar = tarfile.open(tmp_filename, 'w:gz')
+    try:
+        for name in sorted(os.listdir(tree)):
+            tar.add(os.path.join(tree, name), arcname=name)
+    finally:
+        tar.close()
+    os.rename(tmp_filename, filename)
+
+class ArtifactCache(object):
+    def __init__(self, local_dir, remote_url=None):
+        """
+        local_dir = directory keeping tarballs of built packages
+        remote_url = base URL of the HTTP cache shared between machines, or None
+        """
+        self.local_dir = local_dir
+        self.remote_url = remote_url and remote_url.rstrip('/')
+        # set once the remote cache failed to answer
+        self.remote_down = False
+        self.uploads_dir = os.path.join(local_dir, 'uploads')
+
+    def filename(self, key):
+        return os.path.join(self.local_dir, key + SUFFIX)
+
+    def url(self, key):
+        return "%s/%s%s" % (self.remote_url, key, SUFFIX)
+
+    def request(self, method, key, data=None, headers={}):
+        request = urllib2.Request(self.url(key), data, headers)
+        request.get_method = lambda: method
+        return urllib2.urlopen(request, timeout=TIMEOUT)
+
+    def use_remote(self):
+        return bool(self.remote_url) and not self.remote_down
+
+    def remote_failed(self, error):
+        # don't wait for a server that's down once for every package
+        if not self.remote_down:
+            logging.warning("Not using the artifact cache at %s: %s" % (self.remote_url, error))
+        self.remote_down = True
+
+    def has(self, key):
+        """
+        Returns True if a build with the given key is in the local or the
+        remote cache.
+        """
+        if os.path.exists(self.filename(key)):
+            return True
+        if not self.use_remote():
+            return False
+        try:
+            self.request('HEAD', key).close()
+            return True
+        except urllib2.HTTPError, e:
+            if e.code != 404:
+                self.remote_failed(e)
+        except (urllib2.URLError, socket.error), e:
+            self.remote_failed(e)
+        return False
+
+    def fetch(self, key):
+        """
+        Returns the filename of the tarball for the build key, downloading
+        it from the remote cache if it isn't in the local one, or None if
+        neither has it.
+        """
+        filename = self.filename(key)
+        if os.path.exists(filename):
+            return filename
+        if not self.use_remote():
+            return None
+        if not os.path.isdir(self.local_dir):
+            os.makedirs(self.local_dir)
+        tmp_filename = filename + '.part'
+        try:
+            response = self.request('GET', key)
+            try:
+                expected = response.info().getheader(DIGEST_HEADER)
+                digest = copy_with_digest(response, tmp_filename)
+            finally:
+                response.close()
+        except urllib2.HTTPError, e:
+            if e.code != 404:
+                self.remote_failed(e)
+            return None
+        except (urllib2.URLError, socket.error), e:
+            self.remote_failed(e)
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            return None
+        if expected is None or expected.strip().lower() != digest:
+            logging.warning("Ignoring artifact %s from %s, its SHA-256 doesn't match" % (key, self.remote_url))
+            os.remove(tmp_filename)
+            return None
+        os.rename(tmp_filename, filename)
+        return filename
+
+    def restore(self, key, install_dir):
+        """
+        Installs the build with the given key into install_dir. Returns the
+        statistics of extracting it, or None if the cache doesn't have it.
+        The tarball is extracted next to the cache and its files are then
+        copied into install_dir one by one, like a staged install, since
+        other packages share install_dir.
+        """
+        filename = self.fetch(key)
+        if filename is None:
+            return None
+        tmp_dir = os.path.join(self.local_dir, 'restore-%d' % os.getpid())
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        try:
+            try:
+                stats = extract.extract(filename, tmp_dir)
+            except (extract.ExtractError, tarfile.TarError, IOError), e:
+                # a broken tarball is thrown away and the package built instead
+                logging.warning("Ignoring unusable artifact %s: %s" % (filename, e))
+                os.remove(filename)
+                return None
+            sandbox.sync_tree(tmp_dir, install_dir)
+            return stats
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def store(self, key, tree):
+        """
+        Packs tree, the staged install of the build with the given key, into
+        the local cache, marking it to be uploaded if there is a remote cache.
+        """
+        if not os.path.isdir(self.local_dir):
+            os.makedirs(self.local_dir)
+        pack_tree(tree, self.filename(key))
+        if self.remote_url:
+            if not os.path.isdir(self.uploads_dir):
+                os.makedirs(self.uploads_dir)
+            open(os.path.join(self.uploads_dir, key), 'w').close()
+
+    def pending_uploads(self):
+        """
+        Returns the build keys waiting to be uploaded.
+        """
+        if not self.use_remote() or not os.path.isdir(self.uploads_dir):
+            return []
+        return sorted(os.listdir(self.uploads_dir))
+
+    def upload(self, key):
+        """
+        Copies the build with the given key from the local cache to the
+        remote one, unless the remote one already has it.
+        """
+        if not self.use_remote():
+            return
+        filename = self.filename(key)
+        try:
+            try:
+                self.request('HEAD', key).close()
+                exists = True
+            except urllib2.HTTPError, e:
+                if e.code != 404:
+                    raise
+                exists = False
+            if not exists and os.path.exists(filename):
+                f = open(filename, 'rb')
+                try:
+                    headers = {'Content-Type': 'application/gzip',
+                               'Content-Length': str(os.path.getsize(filename)),
+                               DIGEST_HEADER: extract.file_digest(filename)}
+                    self.request('PUT', key, f, headers).close()
+                finally:
+                    f.close()
+        except (urllib2.URLError, socket.error), e:
+            self.remote_failed(e)
+            return
+        os.remove(os.path.join(self.uploads_dir, key))
+
+def copy_with_digest(stream, filename, length=None):
+    """
+    Writes what is read from stream to filename, stopping after length bytes
+    if it is given. Returns the SHA-256 of what was written.
+    """
+    digest = hashlib.sha256()
+    f = open(filename, 'wb')
+    try:
+        while length is None or length > 0:
+            data = stream.read(CHUNK_SIZE if length is None else min(length, CHUNK_SIZE))
+            if not data:
+                break
+            digest.update(data)
+            f.write(data)
+            if length is not None:
+                length -= len(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+class Uploader(object):
+    """
+    Uploads built packages to the remote cache in the background, on at most
+    threads threads, reporting back to the event loop.
+    """
+    def __init__(self, loop, threads=DEFAULT_UPLOADS):
+        self.loop = loop
+        self.pool = eventloop.WorkerPool(loop, threads)
+        self.pending = set()
+
+    def submit_pending(self, cache):
+        """
+        Starts uploading what the cache has waiting to be uploaded.
+        """
+        for key in cache.pending_uploads():
+            self.submit(cache, key)
+
+    def submit(self, cache, key):
+        if key in self.pending:
+            return
+        # select can't wait for pipes on Windows, so uploads happen as builds finish there
+        if not hasattr(os, 'fork'):
+            try:
+                cache.upload(key)
+            except Exception, e:
+                self.done(key, None, e)
+            return
+        self.pending.add(key)
+        self.pool.submit(cache.upload, lambda result, error: self.done(key, result, error), key)
+
+    def done(self, key, result, error):
+        self.pending.discard(key)
+        if error is not None:
+            logging.warning("Uploading artifact %s failed: %s" % (key, error))
+
+    def wait(self):
+        """
+        Runs the event loop until every upload has finished.
+        """
+        if self.pending:
+            logging.info("Waiting for %d artifact upload(s)" % len(self.pending))
+        while self.pending:
+            self.loop.run_once()
+
+    def close(self):
+        self.pool.close()
+
+class ArtifactHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def artifact_filename(self):
+        match = ARTIFACT_PATH.match(self.path)
+        if match is None:
+            self.send_error(404)
+            return None
+        return os.path.join(self.server.directory, match.group(1) + SUFFIX)
+
+    def send_artifact(self, with_body):
+        filename = self.artifact_filename()
+        if filename is None:
+            return
+        try:
+            digest = open(filename + '.sha256').read().strip()
+            f = open(filename, 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/gzip')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.send_header(DIGEST_HEADER, digest)
+            self.end_headers()
+            if with_body:
+                shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+        finally:
+            f.close()
+
+    def do_HEAD(self):
+        self.send_artifact(False)
+
+    def do_GET(self):
+        self.send_artifact(True)
+
+    def do_PUT(self):
+        filename = self.artifact_filename()
+        if filename is None:
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+        expected = self.headers.getheader(DIGEST_HEADER)
+        if not expected:
+            self.send_error(400, "Missing %s header" % DIGEST_HEADER)
+            return
+        # concurrent uploads of the same build each write their own file
+        tmp_filename = "%s.%d.part" % (filename, id(self))
+        digest = copy_with_digest(self.rfile, tmp_filename, length)
+        if os.path.getsize(tmp_filename) < length:
+            os.remove(tmp_filename)
+            self.send_error(400, "Incomplete upload")
+            return
+        if expected.strip().lower() != digest:
+            os.remove(tmp_filename)
+            self.send_error(400, "SHA-256 mismatch")
+            return
+        # the digest goes first, a tarball without one is never served
+        digest_file = open(tmp_filename + '.sha256', 'w')
+        digest_file.write(digest + '\n')
+        digest_file.close()
+        os.rename(tmp_filename + '.sha256', filename + '.sha256')
+        os.rename(tmp_filename, filename)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.info("%s %s" % (self.address_string(), format % args))
+
+class ArtifactServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A reference remote cache keeping the tarballs it is sent in directory.
+    """
+    daemon_threads = True
+
+    def __init__(self, directory, port=DEFAULT_PORT, host=DEFAULT_HOST):
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), ArtifactHandler)
+
+def serve(directory, port=DEFAULT_PORT, host=DEFAULT_HOST):
+    server = ArtifactServer(directory, port, host)
+    logging.info("Serving artifacts from %s on %s port %d" % (server.directory, host or "every interface", server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
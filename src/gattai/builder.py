@@ -3,6 +3,9 @@ import subprocess
 import sys
 import time
 
+import buildlog
+import toolchain
+
 class BuildError(Exception):
     def __init__(self, value):
         self.value = value
@@ -10,15 +13,29 @@ class BuildError(Exception):
     def __repr__(self):
         return repr(self.value)
 
-def runInDir(command, dir=None, verbose=True):
+    def __str__(self):
+        return str(self.value)
+
+def destdirEnv(destdir):
+    """
+    Returns the environment to install into destdir with, or None to install
+    normally.
+    """
+    if destdir is None:
+        return None
+    env = dict(os.environ)
+    env['DESTDIR'] = destdir
+    return env
+
+def runInDir(command, dir=None, verbose=True, env=None):
     if dir:
         olddir = os.getcwd()
         os.chdir(dir)
 
     commandStr = " ".join(command)
-    if verbose:
+    if verbose and buildlog.current() is None:
         print(commandStr)
-    result = os.system(commandStr)
+    result = buildlog.run_command(commandStr, env=env)
 
     if dir:
         os.chdir(olddir)
@@ -29,6 +46,10 @@ class Builder:
     """
     Base class exposing the Builder interface.
     """
+    # the program the builder runs by default, so it can be looked for
+    # without creating a builder
+    command = None
+    formatName = ""
 
     def __init__(self, formatName="", commandName="", programDir=None):
         """
@@ -58,26 +79,22 @@ class Builder:
         programPath = self.getProgramPath()
         if os.path.exists(programPath):
             return True
-        else:
-            # check the PATH for the program
-            # TODO: How do we check if we're in Cygwin?
-            if sys.platform.startswith("win"):
-                result = os.system(self.name)
-                if result == 0:
-                    return True
-                dirs = os.environ["PATH"].split(":")
-
-                for dir in dirs:
-                    if os.path.isfile(os.path.join(dir, self.name)):
-                        return True  
-
-            else:
-                result = os.system("which %s" % self.name)
+        # check the PATH for the program
+        return toolchain.current().find(self.name) is not None
 
-                if result == 0:
-                    return True
+    @classmethod
+    def isInstalled(cls):
+        """
+        Returns True if the builder's program can be found.
+        """
+        return toolchain.current().find(cls.command) is not None
 
-        return False
+    @classmethod
+    def programs(cls):
+        """
+        Returns the programs builds with this builder may run.
+        """
+        return [cls.command]
 
     def getProgramPath(self):
         if self.programDir:
@@ -140,16 +157,24 @@ class Builder:
 # Concrete subclasses of abstract Builder interface
 
 class GNUMakeBuilder(Builder):
+    command = "make"
+    formatName = "GNUMake"
+
     def __init__(self, commandName="make", formatName="GNUMake"):
         Builder.__init__(self, commandName=commandName, formatName=formatName)
 
 
 class XcodeBuilder(Builder):
+    command = "xcodebuild"
+    formatName = "Xcode"
+
     def __init__(self, commandName="xcodebuild", formatName="Xcode"):
         Builder.__init__(self, commandName=commandName, formatName=formatName)
 
 
 class AutoconfBuilder(GNUMakeBuilder):
+    formatName = "autoconf"
+
     def __init__(self, formatName="autoconf"):
         GNUMakeBuilder.__init__(self, formatName=formatName)
 
@@ -180,22 +205,187 @@ class AutoconfBuilder(GNUMakeBuilder):
 
         optionsStr = " ".join(options) if options else ""
         command = "./configure %s" % optionsStr
-        print(command)
-        result = os.system(command)
+        if buildlog.current() is None:
+            print(command)
+        result = buildlog.run_command(command)
         os.chdir(olddir)
         return result
 
 
+class NinjaBuilder(Builder):
+    """
+    Builds projects that have a build.ninja, such as those generated by CMake
+    or Meson. Ninja tracks the dependencies of every output itself, so
+    rebuilds only redo what changed.
+    """
+    command = "ninja"
+    formatName = "ninja"
+
+    def __init__(self, commandName="ninja", formatName="ninja", jobs=1):
+        """
+        jobs = number of commands ninja may run at once
+        """
+        Builder.__init__(self, commandName=commandName, formatName=formatName)
+        self.jobs = jobs
+
+    def getProjectFileArg(self, projectFile = None):
+        result = ["-j%d" % self.jobs]
+        if projectFile:
+            result.extend(['-f', projectFile])
+        return result
+
+    def clean(self, dir=None, projectFile=None, options=[]):
+        if self.isAvailable():
+            args = [self.getProgramPath()]
+            args.extend(self.getProjectFileArg(projectFile))
+            args.extend(["-t", "clean"])
+            return runInDir(args, dir)
+
+        return False
+
+    def install(self, dir=None, projectFile=None, options=[], destdir=None):
+        """
+        destdir = directory to stage the installed files in, if any
+        """
+        if self.isAvailable():
+            args = [self.getProgramPath()]
+            args.extend(self.getProjectFileArg(projectFile))
+            args.append("install")
+            args.extend(options)
+            return runInDir(args, dir, env=destdirEnv(destdir))
+
+        return 1
+
+
+class CMakeBuilder(Builder):
+    """
+    Configures CMake projects into a build dir of their own, which is kept
+    between builds, and builds them with Ninja if it is installed or with
+    make otherwise.
+    """
+    command = "cmake"
+    formatName = "cmake"
+    # where the build files go, relative to the dir containing CMakeLists.txt
+    binaryDirName = "_build"
+    # remembers the configure command, so unchanged builds skip configuring
+    configureStamp = "gattai-configure.txt"
+
+    def __init__(self, generator=None, jobs=1):
+        """
+        generator = CMake generator to use, Ninja or Unix Makefiles if None
+        jobs = number of commands the build may run at once
+        """
+        Builder.__init__(self, commandName="cmake", formatName="cmake")
+        if generator is None:
+            generator = "Unix Makefiles"
+            if NinjaBuilder.isInstalled():
+                generator = "Ninja"
+        self.generator = generator
+        self.jobs = jobs
+
+    @classmethod
+    def programs(cls):
+        return ["cmake", "ninja"]
+
+    def isAvailable(self):
+        if self.generator == "Ninja" and not NinjaBuilder.isInstalled():
+            return False
+        return Builder.isAvailable(self)
+
+    def binaryDir(self, dir=None):
+        if not dir:
+            dir = os.getcwd()
+        return os.path.join(dir, self.binaryDirName)
+
+    def flagOptions(self, prefix, cflags=[], ldflags=[]):
+        """
+        Returns the configure options that install into prefix and compile
+        and link with the given flags.
+        """
+        options = ['-DCMAKE_INSTALL_PREFIX="%s"' % prefix]
+        if cflags:
+            for name in ["CMAKE_C_FLAGS", "CMAKE_CXX_FLAGS"]:
+                options.append('-D%s="%s"' % (name, " ".join(cflags)))
+        if ldflags:
+            for name in ["CMAKE_EXE_LINKER_FLAGS", "CMAKE_SHARED_LINKER_FLAGS", "CMAKE_MODULE_LINKER_FLAGS"]:
+                options.append('-D%s="%s"' % (name, " ".join(ldflags)))
+        return options
+
+    def configure(self, dir=None, options=[]):
+        if not dir:
+            dir = os.getcwd()
+        binaryDir = self.binaryDir(dir)
+        args = [self.getProgramPath(), "-G", '"%s"' % self.generator]
+        args.extend(options)
+        args.append('"%s"' % os.path.abspath(dir))
+        command = " ".join(args)
+
+        stamp = os.path.join(binaryDir, self.configureStamp)
+        cache = os.path.join(binaryDir, "CMakeCache.txt")
+        if os.path.exists(cache):
+            if os.path.exists(stamp) and open(stamp).read() == command:
+                # the build files regenerate themselves when CMakeLists.txt changes
+                return 0
+            # start from a fresh cache so removed options and a new generator
+            # take effect, the objects already built are kept
+            os.remove(cache)
+        elif not os.path.exists(binaryDir):
+            os.makedirs(binaryDir)
+
+        result = runInDir(args, binaryDir)
+        if result == 0:
+            f = open(stamp, "w")
+            f.write(command)
+            f.close()
+        return result
+
+    def buildArgs(self, dir, target=None, options=[]):
+        args = [self.getProgramPath(), "--build", '"%s"' % self.binaryDir(dir)]
+        if target:
+            args.extend(["--target", target])
+        # the rest goes to ninja or make, which both take -j
+        args.append("--")
+        args.append("-j%d" % self.jobs)
+        args.extend(options)
+        return args
+
+    def clean(self, dir=None, projectFile=None, options=[]):
+        if self.isAvailable():
+            return runInDir(self.buildArgs(dir, "clean", options), dir)
+
+        return False
+
+    def build(self, dir=None, projectFile=None, targets=None, options=[]):
+        if self.isAvailable():
+            return runInDir(self.buildArgs(dir, options=options), dir)
+
+        return 1
+
+    def install(self, dir=None, projectFile=None, options=[], destdir=None):
+        """
+        destdir = directory to stage the installed files in, if any
+        """
+        if self.isAvailable():
+            return runInDir(self.buildArgs(dir, "install", options), dir, env=destdirEnv(destdir))
+
+        return 1
+
+
 class MSVCBuilder(Builder):
+    command = "nmake.exe"
+    formatName = "msvc"
+
     def __init__(self, commandName="nmake.exe"):
         Builder.__init__(self, commandName=commandName, formatName="msvc")
 
     def isAvailable(self):
-        PATH = os.environ['PATH'].split(os.path.pathsep)
-        for p in PATH:
-            if os.path.exists(os.path.join(p, self.name)):
-                return True
-        return False
+        return toolchain.current().find(self.name) is not None
+
+    @classmethod
+    def isInstalled(cls):
+        if not sys.platform.startswith("win"):
+            return False
+        return toolchain.current().find(cls.command) is not None
 
     def getProjectFileArg(self, projectFile = None):
         result = []
@@ -206,6 +396,9 @@ class MSVCBuilder(Builder):
 
         
 class MSVCProjectBuilder(Builder):
+    command = "VCExpress.exe"
+    formatName = "msvcProject"
+
     def __init__(self):
         Builder.__init__(self, commandName="VCExpress.exe", formatName="msvcProject")
         for key in ["VS90COMNTOOLS", "VC80COMNTOOLS", "VC71COMNTOOLS"]:
@@ -233,13 +426,23 @@ class MSVCProjectBuilder(Builder):
 
         return False
 
-builders = [GNUMakeBuilder, XcodeBuilder, AutoconfBuilder, MSVCBuilder, MSVCProjectBuilder]
+    @classmethod
+    def isInstalled(cls):
+        # the IDE is found through the environment and Program Files
+        if not sys.platform.startswith("win"):
+            return False
+        return cls().isAvailable()
+
+builders = [GNUMakeBuilder, XcodeBuilder, AutoconfBuilder, NinjaBuilder, CMakeBuilder, MSVCBuilder, MSVCProjectBuilder]
+
+# the builder used for each format a cxx package can have
+formats = {'autoconf': AutoconfBuilder, 'gnumake': GNUMakeBuilder, 'cmake': CMakeBuilder,
+           'ninja': NinjaBuilder, 'msvc': MSVCBuilder}
 
 def getAvailableBuilders():
     availableBuilders = {}
     for symbol in builders:
-        thisBuilder = symbol()
-        if thisBuilder.isAvailable():
-            availableBuilders[thisBuilder.formatName] = symbol
+        if symbol.isInstalled():
+            availableBuilders[symbol.formatName] = symbol
 
     return availableBuilders
@@ -0,0 +1,273 @@
+"""
+Per-package build logging.
+
+Each package being built gets its own log file that receives both the
+logging messages emitted while it builds and the output of every command
+it runs. Output is streamed to disk through a buffered file, and only a
+bounded tail of lines is kept in memory so that failures can be summarized
+without re-reading (possibly huge) make logs. Optionally, finished logs are
+gzip compressed and a JSON-lines stream of build events is written for
+consumption by other tools.
+"""
+
+import collections
+import gzip
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+DEFAULT_TAIL_LINES = 200
+DEFAULT_BUFFER_SIZE = 64 * 1024
+# upper bound on a single unterminated line kept for the tail
+MAX_PARTIAL_LINE = 4096
+
+_local = threading.local()
+# a single handler serves every LogManager, so that loading several recipes
+# doesn't write each message to the package logs more than once
+_handler = None
+
+def current():
+    """
+    Returns the PackageLog active on this thread, or None.
+    """
+    return getattr(_local, 'log', None)
+
+def set_current(log):
+    _local.log = log
+
+class LineTail(object):
+    """
+    Keeps the last lines of the data written to it.
+    """
+    def __init__(self, max_lines=DEFAULT_TAIL_LINES):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.partial = ''
+
+    def write(self, data):
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()[-MAX_PARTIAL_LINE:]
+        # only the last maxlen lines can survive, so don't bother with the rest
+        self.lines.extend(lines[-self.lines.maxlen:])
+
+    def tail(self):
+        result = list(self.lines)
+        if self.partial:
+            result.append(self.partial)
+        return result
+
+class PackageLog(object):
+    def __init__(self, name, path, tail_lines=DEFAULT_TAIL_LINES, bufsize=DEFAULT_BUFFER_SIZE):
+        """
+        name = name of the package being logged
+        path = log file to write to, truncated if it exists
+        tail_lines = number of trailing lines kept in memory
+        """
+        self.name = name
+        self.path = path
+        self.lines = LineTail(tail_lines)
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.file = open(path, 'wb', bufsize)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8', 'replace')
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(data)
+            self.bytes_written += len(data)
+            self.lines.write(data)
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def tail(self):
+        """
+        Returns the last lines written to this log.
+        """
+        with self.lock:
+            return self.lines.tail()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class PackageLogHandler(logging.Handler):
+    """
+    Routes log records to the PackageLog active on the emitting thread.
+    """
+    def emit(self, record):
+        log = current()
+        if log is None:
+            return
+        try:
+            log.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+class EventStream(object):
+    """
+    Writes one JSON object per line describing build events.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.file = open(path, 'a')
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + '\n')
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def compress_file(path):
+    """
+    gzips path to path + '.gz' and removes the original
+    """
+    gzpath = path + '.gz'
+    src = open(path, 'rb')
+    try:
+        dest = gzip.open(gzpath, 'wb')
+        try:
+            shutil.copyfileobj(src, dest, DEFAULT_BUFFER_SIZE)
+        finally:
+            dest.close()
+    finally:
+        src.close()
+    os.remove(path)
+    return gzpath
+
+class LogManager(object):
+    def __init__(self, log_dir, events_path=None, compress=False, tail_lines=DEFAULT_TAIL_LINES):
+        """
+        log_dir = directory that receives one <package>.log per package
+        events_path = if set, file to append JSON-lines build events to
+        compress = gzip each package log once its build has finished
+        tail_lines = number of lines per package kept in memory for failure summaries
+        """
+        self.log_dir = log_dir
+        self.compress = compress
+        self.tail_lines = tail_lines
+        self.events = None
+        if events_path:
+            self.events = EventStream(events_path)
+        global _handler
+        if _handler is None:
+            _handler = PackageLogHandler()
+            _handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+            logging.getLogger().addHandler(_handler)
+
+    def log_path(self, name):
+        return os.path.join(self.log_dir, '%s.log' % name)
+
+    def emit(self, event, **fields):
+        if self.events is not None:
+            self.events.emit(event, **fields)
+
+    def open_package(self, name):
+        """
+        Starts logging for the named package on the current thread and returns its PackageLog.
+        """
+        path = self.log_path(name)
+        # don't leave a stale archive from a previous run next to the fresh log
+        if os.path.exists(path + '.gz'):
+            os.remove(path + '.gz')
+        log = PackageLog(name, path, tail_lines=self.tail_lines)
+        set_current(log)
+        self.emit('start', package=name, log=path)
+        return log
+
+    def close_package(self, log, success):
+        """
+        Stops logging for the package, reporting the tail of its log if it failed.
+        """
+        if current() is log:
+            set_current(None)
+        log.close()
+        path = log.path
+        if self.compress:
+            path = compress_file(log.path)
+        self.emit('finish', package=log.name, success=bool(success), log=path,
+                  bytes=log.bytes_written)
+        if not success:
+            logging.error("Last lines of the log for %s (full log at %s):" % (log.name, path))
+            for line in log.tail():
+                logging.error("    %s" % line)
+
+    def close(self):
+        if self.events is not None:
+            self.events.close()
+
+def stream_command(command, write, cwd=None, env=None, shell=True):
+    """
+    Runs command, passing its output to write() in chunks as it arrives
+    rather than collecting it. Returns the exit code of the command.
+    """
+    proc = subprocess.Popen(command, shell=shell, cwd=cwd, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    fd = proc.stdout.fileno()
+    while True:
+        data = os.read(fd, DEFAULT_BUFFER_SIZE)
+        if not data:
+            break
+        write(data)
+    proc.stdout.close()
+    return proc.wait()
+
+def command_line(command):
+    if isinstance(command, basestring):
+        return command
+    return " ".join(command)
+
+def run_command(command, cwd=None, env=None, shell=True):
+    """
+    Runs command, streaming its output to the current package log when there
+    is one and passing it through to the terminal otherwise. Returns the exit
+    code of the command.
+    """
+    log = current()
+    if log is None:
+        return subprocess.call(command, shell=shell, cwd=cwd, env=env)
+
+    log.write("$ %s\n" % command_line(command))
+    return stream_command(command, log.write, cwd=cwd, env=env, shell=shell)
+
+def capture_command(command, tail_lines=DEFAULT_TAIL_LINES, cwd=None, env=None, shell=True):
+    """
+    Runs command like run_command, but also keeps the last tail_lines lines
+    of its output. Returns an (exit code, lines) tuple.
+    """
+    log = current()
+    tail = LineTail(tail_lines)
+    def write(data):
+        tail.write(data)
+        if log is not None:
+            log.write(data)
+    if log is not None:
+        log.write("$ %s\n" % command_line(command))
+    result = stream_command(command, write, cwd=cwd, env=env, shell=shell)
+    return result, tail.tail()
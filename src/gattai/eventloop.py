@@ -0,0 +1,172 @@
+"""
+A small select based event loop for orchestrating builds.
+
+Everything the build orchestration waits for is multiplexed by one loop in
+one thread: the pipes of forked build jobs, the completion of work done by
+bounded pools of worker threads, such as source downloads, and timers. Work handed
+to a pool reports back through a pipe that wakes the loop up, so callbacks
+always run in the thread running the loop, and only as many threads exist as
+the pools were given.
+"""
+
+import collections
+import errno
+import heapq
+import itertools
+import os
+import select
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # select can't wait for pipes on Windows, so the loop isn't used there
+    fcntl = None
+
+def _fileno(fileobj):
+    if isinstance(fileobj, (int, long)):
+        return fileobj
+    return fileobj.fileno()
+
+class EventLoop(object):
+    def __init__(self):
+        self.readers = {}
+        self.pending = collections.deque()
+        # (when, sequence number, callback, args) heap of calls due at a time
+        self.timers = []
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.wake_read, self.wake_write = os.pipe()
+        # a full pipe already means the loop will wake up
+        if fcntl is not None:
+            fcntl.fcntl(self.wake_write, fcntl.F_SETFL, fcntl.fcntl(self.wake_write, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.closed = False
+
+    def add_reader(self, fileobj, callback):
+        """
+        Calls callback() whenever fileobj (a file descriptor or an object
+        with a fileno() method) is readable, until remove_reader is called.
+        """
+        self.readers[_fileno(fileobj)] = callback
+
+    def remove_reader(self, fileobj):
+        self.readers.pop(_fileno(fileobj), None)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Arranges for callback(*args) to be called by the loop. Unlike the
+        other methods, this one can be called from any thread.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.pending.append((callback, args))
+            try:
+                os.write(self.wake_write, 'x')
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def call_later(self, delay, callback, *args):
+        """
+        Arranges for callback(*args) to be called by the loop once delay
+        seconds have passed.
+        """
+        heapq.heappush(self.timers, (time.time() + delay, next(self.sequence), callback, args))
+
+    def run_once(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for something to
+        happen, then runs the callbacks that are due.
+        """
+        if self.timers:
+            until_timer = max(0, self.timers[0][0] - time.time())
+            if timeout is None or until_timer < timeout:
+                timeout = until_timer
+        fds = list(self.readers) + [self.wake_read]
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if self.wake_read in readable:
+            os.read(self.wake_read, 4096)
+            readable.remove(self.wake_read)
+        for fd in readable:
+            # an earlier callback may have removed this reader
+            callback = self.readers.get(fd)
+            if callback is not None:
+                callback()
+        while True:
+            with self.lock:
+                if not self.pending:
+                    break
+                callback, args = self.pending.popleft()
+            callback(*args)
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            callback, args = heapq.heappop(self.timers)[2:]
+            callback(*args)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pending.clear()
+            del self.timers[:]
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+
+class WorkerPool(object):
+    """
+    Runs blocking calls on a fixed number of threads, reporting each result
+    back to the event loop.
+    """
+    def __init__(self, loop, threads=4):
+        self.loop = loop
+        self.size = max(1, threads)
+        self.queue = collections.deque()
+        self.lock = threading.Condition()
+        self.threads = []
+        self.closed = False
+
+    def submit(self, func, callback, *args):
+        """
+        Calls func(*args) on a worker thread. Once it returns, the loop calls
+        callback(result, None), or callback(None, error) with the exception
+        it raised.
+        """
+        with self.lock:
+            self.queue.append((func, args, callback))
+            # threads are only started as there is work for them
+            if len(self.threads) < self.size:
+                thread = threading.Thread(target=self.worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.lock.notify()
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+                func, args, callback = self.queue.popleft()
+            try:
+                result, error = func(*args), None
+            except Exception, e:
+                result, error = None, e
+            self.loop.call_soon_threadsafe(callback, result, error)
+
+    def close(self):
+        """
+        Stops the workers once they finish what they are doing; work still
+        queued is dropped.
+        """
+        with self.lock:
+            self.closed = True
+            self.queue.clear()
+            self.lock.notify_all()
@@ -0,0 +1,420 @@
+"""
+Extracting source archives.
+
+Compressed tarballs are decompressed by external parallel decompressors
+(pigz, pbzip2, xz -T0, zstd) when they are available, with Python's own
+gzip and bz2 support as the fallback. The tar stream is parsed as it
+arrives, and file contents are written out by a small pool of writer
+threads so that disk writes overlap with decompression.
+
+Archives are extracted into a temporary directory that is moved into place
+once extraction has finished, and the extracted source tree gets a marker
+file recording which archive it came from. A tree with a matching marker is
+known to be complete. A tree without one may have been unpacked by hand or
+by an older gattai, and is left alone unless the temporary directory of an
+interrupted extraction shows that it is incomplete. Packages can also list globs of archive members to include or
+exclude, so that large test data directories are never written to disk.
+"""
+
+import bz2
+import errno
+import fnmatch
+import gzip
+import hashlib
+import json
+import os
+import Queue
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+import zipfile
+
+# files larger than this are written directly from the tar stream instead
+# of being read into memory and handed to a writer thread
+INLINE_SIZE = 4 * 1024 * 1024
+STREAM_BUFFER_SIZE = 1024 * 1024
+DEFAULT_THREADS = 4
+MARKER_NAME = '.gattai_extracted'
+TMP_PREFIX = '.gattai_extracting_'
+
+# suffix -> (container, compression), longest suffixes first
+FORMATS = [
+    ('.tar.gz', ('tar', 'gz')),
+    ('.tar.bz2', ('tar', 'bz2')),
+    ('.tar.xz', ('tar', 'xz')),
+    ('.tar.zst', ('tar', 'zst')),
+    ('.tgz', ('tar', 'gz')),
+    ('.tbz2', ('tar', 'bz2')),
+    ('.tbz', ('tar', 'bz2')),
+    ('.txz', ('tar', 'xz')),
+    ('.tzst', ('tar', 'zst')),
+    ('.tar', ('tar', '')),
+    ('.zip', ('zip', '')),
+]
+
+# external decompressors, in order of preference
+DECOMPRESSORS = {
+    'gz': [['pigz', '-dc']],
+    'bz2': [['pbzip2', '-dc'], ['lbzip2', '-dc']],
+    'xz': [['xz', '-T0', '-dc']],
+    'zst': [['zstd', '-dc']],
+}
+
+# compressions Python can read without help
+PYTHON_OPENERS = {'gz': gzip.GzipFile, 'bz2': bz2.BZ2File, '': open}
+
+class ExtractError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+def archive_format(filename):
+    """
+    Returns a (container, compression) tuple like ('tar', 'gz') for the
+    archive, or None if it isn't a supported archive.
+    """
+    name = filename.lower()
+    for suffix, format in FORMATS:
+        if name.endswith(suffix):
+            return format
+    return None
+
+def find_program(name):
+    for dir in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(dir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def decompressor_command(compression):
+    for command in DECOMPRESSORS.get(compression, []):
+        if find_program(command[0]):
+            return command
+    return None
+
+def inside(dest, path):
+    return (path + os.sep).startswith(dest + os.sep)
+
+def member_path(dest, name):
+    """
+    Returns where the archive member should be written, refusing names that
+    would end up outside of dest, also by way of links extracted earlier.
+    """
+    dest = os.path.realpath(dest)
+    path = os.path.normpath(os.path.join(dest, name))
+    if os.path.isabs(name) or not inside(dest, path) or not inside(dest, os.path.realpath(os.path.dirname(path))):
+        raise ExtractError("Refusing to extract %r outside of %s" % (name, dest))
+    return path
+
+def check_link(dest, member, path):
+    """
+    Refuses links whose targets are outside of dest.
+    """
+    if member.issym():
+        target = os.path.normpath(os.path.join(os.path.dirname(path), member.linkname))
+        if os.path.isabs(member.linkname) or not inside(os.path.realpath(dest), target):
+            raise ExtractError("Refusing to extract %r linking outside of %s" % (member.name, dest))
+    elif member.islnk():
+        member_path(dest, member.linkname)
+
+def wanted(name, include=None, exclude=None):
+    """
+    Returns True if the archive member should be extracted. A member matches
+    a glob if its own path or the path of one of its parent dirs does.
+    """
+    if not include and not exclude:
+        return True
+    parts = [part for part in name.split('/') if part and part != '.']
+    paths = ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+    def matches(patterns):
+        for path in paths:
+            for pattern in patterns:
+                if fnmatch.fnmatch(path, pattern):
+                    return True
+        return False
+    if exclude and matches(exclude):
+        return False
+    if include and not matches(include):
+        return False
+    return True
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    f = open(filename, 'rb')
+    while True:
+        data = f.read(STREAM_BUFFER_SIZE)
+        if not data:
+            break
+        digest.update(data)
+    f.close()
+    return digest.hexdigest()
+
+def archive_info(filename, include=None, exclude=None):
+    """
+    Returns what a completion marker records about extracting the archive,
+    without its digest.
+    """
+    stat = os.stat(filename)
+    return {'archive': os.path.basename(filename), 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'include': include or [], 'exclude': exclude or []}
+
+def write_marker(tree, filename, include=None, exclude=None):
+    info = archive_info(filename, include, exclude)
+    info['sha256'] = file_digest(filename)
+    f = open(os.path.join(tree, MARKER_NAME), 'w')
+    json.dump(info, f, sort_keys=True)
+    f.close()
+
+def has_marker(tree):
+    return os.path.exists(os.path.join(tree, MARKER_NAME))
+
+def process_alive(pid):
+    # signal 0 would terminate the process on Windows
+    if not hasattr(os, 'fork'):
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+def tmp_dir_name(filename, pid):
+    return '%s%s_%d' % (TMP_PREFIX, os.path.basename(filename), pid)
+
+def interrupted_extractions(dest, filename):
+    """
+    Returns the temporary directories that extractions of filename into dest
+    by processes that are gone left behind.
+    """
+    prefix = tmp_dir_name(filename, 0)[:-1]
+    result = []
+    if not os.path.isdir(dest):
+        return result
+    for name in os.listdir(dest):
+        if not name.startswith(prefix):
+            continue
+        try:
+            # the tree being replaced is moved aside to <tmp dir>_old
+            pid = int(name[len(prefix):].split('_')[0])
+        except ValueError:
+            continue
+        if not process_alive(pid):
+            result.append(os.path.join(dest, name))
+    return result
+
+def is_intact(tree, filename, include=None, exclude=None):
+    """
+    Returns True if tree has a marker showing that filename was completely
+    extracted into it with the same include and exclude globs. The archive
+    is only hashed if its size or modification time changed.
+    """
+    try:
+        marker = json.load(open(os.path.join(tree, MARKER_NAME)))
+    except (IOError, ValueError):
+        return False
+    info = archive_info(filename, include, exclude)
+    for key in ['archive', 'include', 'exclude']:
+        if marker.get(key) != info[key]:
+            return False
+    if marker.get('size') == info['size'] and marker.get('mtime') == info['mtime']:
+        return True
+    return marker.get('sha256') == file_digest(filename)
+
+def merge_tree(src, dest):
+    """
+    Moves src to dest, merging directories with ones that already exist there
+    and replacing files.
+    """
+    if os.path.isdir(src) and not os.path.islink(src) and os.path.isdir(dest) and not os.path.islink(dest):
+        for name in os.listdir(src):
+            merge_tree(os.path.join(src, name), os.path.join(dest, name))
+        os.rmdir(src)
+        return
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        shutil.rmtree(dest)
+    elif os.path.lexists(dest):
+        os.remove(dest)
+    os.rename(src, dest)
+
+class WriterPool(object):
+    def __init__(self, threads=DEFAULT_THREADS):
+        # bound the queue so decompression can't run far ahead of the disk
+        self.queue = Queue.Queue(maxsize=threads * 4)
+        self.errors = []
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, data, mode, mtime = item
+                f = open(path, 'wb')
+                f.write(data)
+                f.close()
+                os.chmod(path, mode)
+                os.utime(path, (mtime, mtime))
+            except Exception, e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def write(self, path, data, mode, mtime):
+        self.queue.put((path, data, mode, mtime))
+
+    def wait(self):
+        """
+        Blocks until everything queued so far has been written.
+        """
+        self.queue.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+def extract_tar_stream(stream, dest, threads=DEFAULT_THREADS, include=None, exclude=None):
+    """
+    Extracts the uncompressed tar data read from stream into dest, returning
+    the number of bytes of file data written.
+    """
+    tar = tarfile.open(fileobj=stream, mode='r|')
+    pool = WriterPool(threads)
+    directories = []
+    total = 0
+    try:
+        for member in tar:
+            path = member_path(dest, member.name)
+            if not wanted(member.name, include, exclude):
+                continue
+            if member.isreg():
+                parent = os.path.dirname(path)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                source = tar.extractfile(member)
+                if member.size > INLINE_SIZE:
+                    f = open(path, 'wb')
+                    shutil.copyfileobj(source, f, STREAM_BUFFER_SIZE)
+                    f.close()
+                    tar.chmod(member, path)
+                    tar.utime(member, path)
+                else:
+                    pool.write(path, source.read(), member.mode & 07777, member.mtime)
+                total += member.size
+            elif member.isdir():
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                directories.append((member, path))
+            else:
+                check_link(dest, member, path)
+                if member.islnk():
+                    # the link target may still be waiting for a writer
+                    pool.wait()
+                tar.extract(member, dest)
+        pool.wait()
+        # set directory permissions last, in case they are read-only
+        for member, path in reversed(directories):
+            tar.chmod(member, path)
+            tar.utime(member, path)
+    finally:
+        pool.close()
+        tar.close()
+    # drain the end of archive padding, so an external decompressor doesn't
+    # fail on a broken pipe
+    while stream.read(STREAM_BUFFER_SIZE):
+        pass
+    return total
+
+def extract(filename, dest='.', threads=DEFAULT_THREADS, include=None, exclude=None):
+    """
+    Extracts the archive into dest. Returns a dict of statistics: the bytes
+    of data extracted, the seconds it took and the decompressor used.
+
+    include = if set, only members matching one of these globs are extracted
+    exclude = members matching one of these globs are not extracted
+    """
+    format = archive_format(filename)
+    if format is None:
+        raise ExtractError("Unsupported archive %s" % filename)
+    container, compression = format
+    start = time.time()
+    tool = 'python'
+    if container == 'zip':
+        archive = zipfile.ZipFile(filename)
+        members = [info for info in archive.infolist() if wanted(info.filename, include, exclude)]
+        archive.extractall(dest, members)
+        total = sum([info.file_size for info in members])
+        archive.close()
+    else:
+        command = decompressor_command(compression)
+        if command is not None:
+            tool = command[0]
+            proc = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, bufsize=STREAM_BUFFER_SIZE)
+            try:
+                total = extract_tar_stream(proc.stdout, dest, threads, include, exclude)
+            finally:
+                proc.stdout.close()
+                result = proc.wait()
+            if result != 0:
+                raise ExtractError("'%s %s' failed" % (" ".join(command), filename))
+        elif compression in PYTHON_OPENERS:
+            stream = PYTHON_OPENERS[compression](filename, 'rb')
+            try:
+                total = extract_tar_stream(stream, dest, threads, include, exclude)
+            finally:
+                stream.close()
+        else:
+            raise ExtractError("Extracting %s needs %s to be installed" % (filename, DECOMPRESSORS[compression][0][0]))
+    return {'bytes': total, 'seconds': time.time() - start, 'tool': tool}
+
+def extract_atomically(filename, dest='.', replace=None, threads=DEFAULT_THREADS, include=None, exclude=None):
+    """
+    Extracts the archive into a temporary directory inside dest, then moves
+    the results into dest. replace is a path of a partial tree from an
+    earlier attempt, which is swapped for the new one rather than merged
+    with.
+    """
+    for leftover in interrupted_extractions(dest, filename):
+        shutil.rmtree(leftover, ignore_errors=True)
+    # processes extracting the same archive at once each get their own
+    tmp_dir = os.path.join(dest, tmp_dir_name(filename, os.getpid()))
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    try:
+        stats = extract(filename, tmp_dir, threads, include, exclude)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    # if moving the results is interrupted, the temporary directory is left
+    # behind to show that the tree in dest is incomplete
+    old = None
+    if replace is not None and os.path.isdir(replace):
+        # moved aside rather than removed, so the tree is only missing until
+        # the new one is renamed into place
+        old = tmp_dir + '_old'
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        os.rename(replace, old)
+    for name in os.listdir(tmp_dir):
+        merge_tree(os.path.join(tmp_dir, name), os.path.join(dest, name))
+    shutil.rmtree(tmp_dir)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+    return stats
@@ -0,0 +1,131 @@
+"""
+Package dependency graph.
+
+Packages may list the names of the packages they need in a 'depends' prop.
+Packages that don't declare 'depends' are taken to depend on the package
+listed just before them, so recipes written for the old strictly ordered
+behavior keep building in the same order.
+"""
+
+import heapq
+
+from builder import BuildError
+
+# a BuildError, so that commands report bad depends like other recipe errors
+class GraphError(BuildError):
+    pass
+
+class BuildGraph(object):
+    def __init__(self, names, depends):
+        """
+        names = package names, in recipe order
+        depends = dict mapping a name to the list of names it depends on, or
+                  to None if it did not declare any
+        """
+        self.names = list(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.deps = {}
+        self.rdeps = dict((name, []) for name in self.names)
+        previous = None
+        for name in self.names:
+            required = depends.get(name)
+            if required is None:
+                required = [previous] if previous is not None else []
+            for dep in required:
+                if dep not in self.index:
+                    raise GraphError("%s depends on unknown package %r" % (name, dep))
+                self.rdeps[dep].append(name)
+            self.deps[name] = list(required)
+            previous = name
+        self.order = self.topological_order()
+
+    def dependencies(self, name):
+        return self.deps[name]
+
+    def dependents(self, name):
+        return self.rdeps[name]
+
+    def transitive_dependents(self, names):
+        """
+        Returns the set of the given packages and everything that depends on them.
+        """
+        result = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in result:
+                result.add(name)
+                pending.extend(self.rdeps[name])
+        return result
+
+    def topological_order(self):
+        """
+        Returns the names sorted so that each package comes after its
+        dependencies, keeping recipe order wherever there is a choice.
+        """
+        remaining = dict((name, len(self.deps[name])) for name in self.names)
+        ready = [self.index[name] for name in self.names if remaining[name] == 0]
+        heapq.heapify(ready)
+        result = []
+        while ready:
+            name = self.names[heapq.heappop(ready)]
+            result.append(name)
+            for dependent in self.rdeps[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, self.index[dependent])
+        if len(result) != len(self.names):
+            cycle = [name for name in self.names if remaining[name] > 0]
+            raise GraphError("Circular dependencies between %s" % ", ".join(cycle))
+        return result
+
+    def remaining_path(self, durations):
+        """
+        Returns a dict mapping each name to the length of the longest chain of
+        durations starting at that package, including its own duration.
+        """
+        result = {}
+        for name in reversed(self.order):
+            longest = 0
+            for dependent in self.rdeps[name]:
+                longest = max(longest, result[dependent])
+            result[name] = durations.get(name, 0) + longest
+        return result
+
+    def critical_path(self, durations):
+        """
+        Returns the chain of packages with the longest total duration.
+        """
+        lengths = self.remaining_path(durations)
+        roots = [name for name in self.order if not self.deps[name]]
+        if not roots:
+            return []
+        path = [max(roots, key=lambda name: lengths[name])]
+        while self.rdeps[path[-1]]:
+            path.append(max(self.rdeps[path[-1]], key=lambda name: lengths[name]))
+        return path
+
+    def simulate(self, durations, jobs=1, priority=None):
+        """
+        Predicts the wall time needed to build every package with the given
+        number of parallel jobs. priority is a function of a name returning a
+        sort key, lowest first; the default is recipe order.
+        """
+        if priority is None:
+            priority = lambda name: self.index[name]
+        jobs = max(1, jobs)
+        remaining = dict((name, len(self.deps[name])) for name in self.names)
+        ready = [(priority(name), name) for name in self.names if remaining[name] == 0]
+        heapq.heapify(ready)
+        running = []
+        now = 0
+        while ready or running:
+            while ready and len(running) < jobs:
+                key, name = heapq.heappop(ready)
+                heapq.heappush(running, (now + durations.get(name, 0), name))
+            now, name = heapq.heappop(running)
+            for dependent in self.rdeps[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, (priority(dependent), dependent))
+        return now
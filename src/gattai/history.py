@@ -0,0 +1,147 @@
+"""
+On-disk history of how long packages took to build.
+
+The history is a small JSON file mapping each package name to the durations
+of its recent builds, split by the kind of build that was done ('full' when
+the source had to be fetched and configured, 'incremental' when an already
+configured tree was rebuilt), along with the durations of each build phase
+(fetch, prebuild, build, postinstall). Durations are smoothed so that one unusually
+slow or fast run doesn't throw off predictions. The peak memory use of recent
+builds is kept as well, erring on the high side since it is used to keep
+parallel builds from running out of memory.
+
+A separate state file records what happened to each package in the last run,
+so that a failed run can be resumed without going over the packages that
+were already built.
+"""
+
+import json
+import logging
+import os
+import sys
+
+# weight given to the newest sample when updating an average
+SMOOTHING = 0.5
+
+def smooth(previous, seconds):
+    if previous is not None:
+        seconds = SMOOTHING * seconds + (1 - SMOOTHING) * previous
+    return round(seconds, 3)
+
+class BuildHistory(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {}
+        if os.path.exists(filename):
+            try:
+                self.data = json.load(open(filename))
+            except ValueError:
+                logging.warning("Ignoring unreadable build history %s" % filename)
+
+    def record(self, name, mode, seconds, phases=None, mem_mb=None):
+        """
+        Adds a build of the given mode that took seconds in total. phases
+        optionally maps the phases of the build to their durations, and mem_mb
+        is the peak memory the build used, if it was measured.
+        """
+        entry = self.data.setdefault(name, {})
+        entry[mode] = smooth(entry.get(mode), seconds)
+        if phases:
+            entry_phases = entry.setdefault('phases', {})
+            for phase in phases:
+                entry_phases[phase] = smooth(entry_phases.get(phase), phases[phase])
+        if mem_mb:
+            previous = entry.get('mem_mb')
+            if previous is None or mem_mb > previous:
+                entry['mem_mb'] = mem_mb
+            else:
+                entry['mem_mb'] = int(round(smooth(previous, mem_mb)))
+
+    def phases(self, name):
+        """
+        Returns the average duration of each phase of the package's builds.
+        """
+        return self.data.get(name, {}).get('phases', {})
+
+    def memory(self, name):
+        """
+        Returns the peak memory in MB the package's builds used, or None if
+        it hasn't been measured.
+        """
+        return self.data.get(name, {}).get('mem_mb')
+
+    def estimate(self, name, mode='full'):
+        """
+        Returns the expected duration in seconds, or None if the package has
+        never been built.
+        """
+        entry = self.data.get(name, {})
+        if mode in entry:
+            return entry[mode]
+        # an estimate for the other kind of build is better than nothing
+        for key, value in entry.items():
+            if key != 'mem_mb' and isinstance(value, (int, float)):
+                return value
+        return None
+
+    def save(self):
+        save_json(self.filename, self.data)
+
+def save_json(filename, data, tmpname=None):
+    """
+    Writes data to filename, replacing it only once the new data is complete.
+
+    tmpname = file to write the data to first, filename + '.tmp' by default
+    """
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmpname = tmpname or filename + '.tmp'
+    f = open(tmpname, 'w')
+    json.dump(data, f, indent=1, sort_keys=True)
+    f.close()
+    if sys.platform.startswith('win') and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpname, filename)
+
+# states of packages in a run; 'done' covers packages that were skipped
+# because they were already installed or ignored
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+class RunState(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.packages = {}
+        self.exists = os.path.exists(filename)
+        if self.exists:
+            try:
+                self.packages = json.load(open(filename)).get('packages', {})
+            except ValueError:
+                logging.warning("Ignoring unreadable run state %s" % filename)
+
+    def start(self, names, resume=False):
+        """
+        Marks names as about to be built. Unless resuming, what earlier runs
+        did is forgotten.
+        """
+        if not resume:
+            self.packages = {}
+        for name in names:
+            self.packages[name] = PENDING
+        self.save()
+
+    def finish(self, name, success):
+        self.packages[name] = success and DONE or FAILED
+        self.save()
+
+    def unfinished(self, names):
+        """
+        Returns the names that the last run failed or didn't get to, in order.
+        Names it never knew about count as not built yet.
+        """
+        return [name for name in names if self.packages.get(name) != DONE]
+
+    def save(self):
+        save_json(self.filename, {'packages': self.packages})
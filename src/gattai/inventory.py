@@ -0,0 +1,197 @@
+"""
+Finding out which versions of packages are already installed.
+
+Instead of running pkg-config, foo-config and Python for every package, the
+.pc files in the pkg-config search path and the metadata of the Python
+packages in the target interpreter's site-packages are read, once per
+directory per run, into dicts mapping package names to versions. Checking
+whether a package is installed is then a lookup in those dicts.
+
+The pkg-config search path is the one pkg-config itself would use: the
+dirs in PKG_CONFIG_PATH, then the pkgconfig dirs of the install prefix, then
+PKG_CONFIG_LIBDIR or the usual system dirs.
+"""
+
+import glob
+import logging
+import os
+import re
+
+PC_VARIABLE = re.compile(r'\$\{(\w+)\}')
+
+def system_pc_dirs():
+    dirs = []
+    for prefix in ['/usr', '/usr/local']:
+        for libdir in ['lib', 'lib64', 'share']:
+            dirs.append(os.path.join(prefix, libdir, 'pkgconfig'))
+        # Debian's multiarch dirs, such as /usr/lib/x86_64-linux-gnu
+        dirs.extend(sorted(glob.glob(os.path.join(prefix, 'lib', '*-*-*', 'pkgconfig'))))
+    return dirs
+
+def prefix_pc_dirs(prefix):
+    return [os.path.join(prefix, libdir, 'pkgconfig') for libdir in ['lib', 'lib64', 'share']]
+
+def split_path(value):
+    return [dir for dir in (value or '').split(os.pathsep) if dir]
+
+def parse_pc(filename):
+    """
+    Returns the fields of the .pc file filename, such as 'Version', with
+    the variables it defines substituted.
+    """
+    variables = {}
+    fields = {}
+    def expand(value):
+        return PC_VARIABLE.sub(lambda match: variables.get(match.group(1), ''), value)
+    for line in open(filename):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        # 'name=value' defines a variable, 'Name: value' a field
+        match = re.match(r'([\w.]+)\s*([:=])\s*(.*)$', line)
+        if match is None:
+            continue
+        key, kind, value = match.groups()
+        if kind == '=':
+            variables[key] = expand(value)
+        else:
+            fields[key] = expand(value)
+    return fields
+
+def read_pc_dir(dir):
+    """
+    Returns a dict mapping the names of the modules with .pc files in dir
+    to their versions.
+    """
+    versions = {}
+    if not os.path.isdir(dir):
+        return versions
+    for filename in os.listdir(dir):
+        name, ext = os.path.splitext(filename)
+        if ext != '.pc':
+            continue
+        try:
+            fields = parse_pc(os.path.join(dir, filename))
+        except IOError:
+            continue
+        if 'Version' in fields:
+            versions[name] = fields['Version']
+    return versions
+
+def normalize_name(name):
+    # the same project can be called Foo_Bar, foo-bar or foo.bar
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def read_metadata(filename):
+    """
+    Returns the (name, version) recorded in a PKG-INFO or METADATA file.
+    """
+    name = version = None
+    for line in open(filename):
+        if not line.strip():
+            # the headers end at the first blank line
+            break
+        if line.startswith('Name:'):
+            name = line[5:].strip()
+        elif line.startswith('Version:'):
+            version = line[8:].strip()
+    return name, version
+
+def metadata_file(path):
+    if path.endswith('.dist-info'):
+        return os.path.join(path, 'METADATA')
+    if path.endswith('.egg-info'):
+        if os.path.isdir(path):
+            return os.path.join(path, 'PKG-INFO')
+        return path
+    if path.endswith('.egg'):
+        return os.path.join(path, 'EGG-INFO', 'PKG-INFO')
+    return None
+
+def read_site_dir(dir):
+    """
+    Returns a dict mapping the normalized names of the Python packages
+    installed in dir, a site-packages dir, to their versions.
+    """
+    versions = {}
+    if not os.path.isdir(dir):
+        return versions
+    for entry in os.listdir(dir):
+        filename = metadata_file(os.path.join(dir, entry))
+        if filename is None:
+            continue
+        name = version = None
+        if os.path.isfile(filename):
+            try:
+                name, version = read_metadata(filename)
+            except IOError:
+                pass
+        if name is None or version is None:
+            # fall back to the name-version.dist-info naming
+            parts = os.path.splitext(entry)[0].split('-')
+            if len(parts) < 2:
+                continue
+            name, version = parts[0], parts[1]
+        versions[normalize_name(name)] = version
+    return versions
+
+class InstallIndex(object):
+    def __init__(self, site_dirs=[]):
+        """
+        site_dirs = the site-packages dirs of the interpreter packages are installed with
+        """
+        self.site_dirs = site_dirs
+        self.pc_dirs_read = {}
+        self.python = None
+
+    def pc_dirs(self, prefix=None):
+        dirs = split_path(os.environ.get('PKG_CONFIG_PATH'))
+        if prefix:
+            dirs.extend(prefix_pc_dirs(prefix))
+        if 'PKG_CONFIG_LIBDIR' in os.environ:
+            dirs.extend(split_path(os.environ['PKG_CONFIG_LIBDIR']))
+        else:
+            dirs.extend(system_pc_dirs())
+        return dirs
+
+    def preload(self, prefix=None):
+        """
+        Reads the dirs a lookup for a package installing into prefix would.
+        """
+        for dir in self.pc_dirs(prefix):
+            self.read_pc_dir(dir)
+        self.python_versions()
+
+    def read_pc_dir(self, dir):
+        if dir not in self.pc_dirs_read:
+            self.pc_dirs_read[dir] = read_pc_dir(dir)
+        return self.pc_dirs_read[dir]
+
+    def pkg_config_version(self, name, prefix=None):
+        """
+        Returns the version of the module name that pkg-config would report,
+        or None if it has no .pc file. prefix is the install prefix to
+        search as well.
+        """
+        # the search path depends on the package's env_vars, the dirs on it
+        # are only read once
+        for dir in self.pc_dirs(prefix):
+            versions = self.read_pc_dir(dir)
+            if name in versions:
+                return versions[name]
+        return None
+
+    def python_version(self, name):
+        """
+        Returns the version of the installed Python package name, or None.
+        """
+        return self.python_versions().get(normalize_name(name))
+
+    def python_versions(self):
+        if self.python is None:
+            self.python = {}
+            # earlier dirs on sys.path win
+            for dir in reversed(self.site_dirs):
+                self.python.update(read_site_dir(dir))
+            logging.debug("Found %d installed Python packages" % len(self.python))
+        return self.python
@@ -0,0 +1,63 @@
+"""
+Lockfiles pinning what a recipe resolves to.
+
+'gattai lock' writes a lockfile next to the recipe (a_recipe.gattai.lock)
+recording, for every package, the URL its source comes from, the archive it
+is saved as and that archive's SHA-256 digest, its source and build dirs,
+and its build key. Later runs use those instead of working them out again,
+and reject downloads that don't match the recorded digest.
+
+Each entry also records a digest of what it was worked out from: the
+package's props and the settings, the root dir and the versions of its build
+tools. When that no longer matches, the entry has drifted; drift is reported
+and drifted entries are ignored until the recipe is locked again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import history
+
+# bumped when entries change in ways older versions can't read
+LOCK_FORMAT = 1
+
+def lock_filename(recipe_filename):
+    return recipe_filename + '.lock'
+
+def props_digest(props):
+    return hashlib.sha1(json.dumps(props, sort_keys=True)).hexdigest()
+
+class Lock(object):
+    def __init__(self, filename):
+        self.filename = filename
+        # package name -> entry
+        self.packages = {}
+        self.exists = os.path.exists(filename)
+        if self.exists:
+            try:
+                data = json.load(open(filename))
+            except ValueError:
+                logging.warning("Ignoring unreadable lockfile %s" % filename)
+                return
+            if data.get('format') != LOCK_FORMAT:
+                logging.warning("Ignoring lockfile %s written by another version of gattai" % filename)
+                return
+            self.packages = data.get('packages', {})
+
+    def drift(self, digests):
+        """
+        Compares the lock with digests, a dict mapping the names of the
+        recipe's packages to their current digests. Returns sorted lists of
+        the names added to the recipe, removed from it, and changed since it
+        was locked.
+        """
+        added = sorted(name for name in digests if name not in self.packages)
+        removed = sorted(name for name in self.packages if name not in digests)
+        changed = sorted(name for name in digests
+                         if name in self.packages and self.packages[name].get('digest') != digests[name])
+        return added, removed, changed
+
+    def save(self):
+        history.save_json(self.filename, {'format': LOCK_FORMAT, 'packages': self.packages})
@@ -0,0 +1,137 @@
+"""
+Building packages for several architectures as separate jobs.
+
+Passing several -arch flags to one configure and make breaks many autoconf
+packages, and compiles every architecture one after the other. A package
+that sets split_archs is instead built once per entry of its archs, each in
+its own sandbox and as its own job, so that the builds for different
+architectures run in parallel. In the build graph, the package becomes a
+node fetching and unpacking its source (named package@), a node per arch
+(named package@arch) building from that source, and a node named after the
+package that depends on all of them and merges their results, which is
+what the package's dependents wait for.
+
+How the results are merged is the package's arch_merge:
+
+lipo    (the default on darwin) every arch is installed into a staging dir,
+        and the merge combines the Mach-O files of all of them into
+        universal ones with lipo before installing the result
+prefix  (the default elsewhere, for cross builds) every arch is installed
+        side by side into its own prefix, install_dir/<arch>, so there is
+        nothing to merge, and the builds for an arch only wait for the
+        same arch of their dependencies
+"""
+
+import os
+import shutil
+import struct
+
+import buildlog
+import graph
+from builder import BuildError
+
+ARCH_SEPARATOR = '@'
+# the arch of the node preparing the source the builds for all archs share
+SOURCE = ''
+
+# first four bytes of thin Mach-O files, in either byte order
+MACHO_MAGICS = [0xfeedface, 0xfeedfacf, 0xcefaedfe, 0xcffaedfe]
+
+def arch_node(name, arch):
+    return name + ARCH_SEPARATOR + arch
+
+def source_node(name):
+    return arch_node(name, SOURCE)
+
+def split_node(node):
+    """
+    Returns the (package name, arch) a node of an expanded graph builds,
+    with arch None for nodes building or merging all archs, and SOURCE for
+    nodes preparing the source of the archs.
+    """
+    if ARCH_SEPARATOR in node:
+        name, arch = node.rsplit(ARCH_SEPARATOR, 1)
+        return name, arch
+    return node, None
+
+def expand(build_graph, archs, merged_first=()):
+    """
+    Returns a BuildGraph in which each package in archs, a dict mapping
+    package names to the archs they build separately, has a node per arch
+    and a node named after it depending on those. The arch nodes also
+    depend on a node preparing the package's source, so that it is fetched
+    and unpacked only once.
+
+    merged_first = names of the packages whose archs are merged into one
+                   install, which the builds of their dependents need
+    """
+    names = []
+    depends = {}
+    for name in build_graph.names:
+        deps = build_graph.dependencies(name)
+        if name in archs:
+            names.append(source_node(name))
+            depends[source_node(name)] = []
+        for arch in archs.get(name, []):
+            node = arch_node(name, arch)
+            names.append(node)
+            depends[node] = [source_node(name)]
+            for dep in deps:
+                if arch in archs.get(dep, []) and not dep in merged_first:
+                    depends[node].append(arch_node(dep, arch))
+                else:
+                    depends[node].append(dep)
+        names.append(name)
+        if name in archs:
+            depends[name] = [arch_node(name, arch) for arch in archs[name]]
+        else:
+            depends[name] = list(deps)
+    return graph.BuildGraph(names, depends)
+
+def is_macho(filename):
+    try:
+        f = open(filename, 'rb')
+        try:
+            header = f.read(4)
+        finally:
+            f.close()
+    except IOError:
+        return False
+    return len(header) == 4 and struct.unpack('>I', header)[0] in MACHO_MAGICS
+
+def merge_trees(trees, dest, lipo='lipo'):
+    """
+    Merges trees, the staged installs of one package built for different
+    archs, into dest. Mach-O files that are in every tree are combined into
+    universal files with lipo, and other files are copied from the first
+    tree that has them. Returns the number of files combined.
+    """
+    # relative path -> the trees' copies of it, in the order of trees
+    files = {}
+    order = []
+    for tree in trees:
+        for dirpath, dirnames, filenames in os.walk(tree):
+            links = [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]
+            for name in links + filenames:
+                path = os.path.join(dirpath, name)
+                relpath = os.path.relpath(path, tree)
+                if relpath not in files:
+                    files[relpath] = []
+                    order.append(relpath)
+                files[relpath].append(path)
+    combined = 0
+    for relpath in order:
+        paths = files[relpath]
+        destpath = os.path.join(dest, relpath)
+        if not os.path.isdir(os.path.dirname(destpath)):
+            os.makedirs(os.path.dirname(destpath))
+        if os.path.islink(paths[0]):
+            os.symlink(os.readlink(paths[0]), destpath)
+        elif len(paths) == len(trees) and len(paths) > 1 and all(is_macho(path) for path in paths):
+            if buildlog.run_command([lipo, '-create'] + paths + ['-output', destpath], shell=False) != 0:
+                raise BuildError("Combining the archs of %s failed" % relpath)
+            shutil.copystat(paths[0], destpath)
+            combined += 1
+        else:
+            shutil.copy2(paths[0], destpath)
+    return combined
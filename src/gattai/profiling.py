@@ -0,0 +1,148 @@
+"""
+Profiling gattai's own Python overhead.
+
+For recipes with thousands of packages, the time gattai spends resolving
+props, substituting variables and looking up paths adds up. bin/gattai's
+--profile flag runs the whole command under cProfile, or under a sampling
+profiler that records collapsed stacks (one 'frame;frame;frame count' line
+per distinct stack, the input format of flame graph tools). It also counts
+calls to a few hot functions and prints the counts at the end.
+
+Package builds running in child processes with --jobs > 1 are not included,
+so profile with --jobs=1 to see everything.
+"""
+
+import collections
+import cProfile
+import logging
+import os
+import pstats
+import signal
+import subprocess
+
+# seconds of CPU time between stack samples
+SAMPLE_INTERVAL = 0.005
+
+counters = collections.Counter()
+# (owner, attr, the function replaced, or None if owner inherited it)
+_replaced = []
+
+def counting(func, name):
+    def wrapper(*args, **kwargs):
+        counters[name] += 1
+        return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+def count_calls(owner, attr, name):
+    """
+    Replaces owner.attr, a function or method of a module or class, with a
+    wrapper counting its calls under name.
+    """
+    own = vars(owner).get(attr)
+    _replaced.append((owner, attr, own))
+    setattr(owner, attr, counting(own or getattr(owner, attr), name))
+
+def install_counters():
+    """
+    Starts counting calls to the functions that are hot in large recipes.
+    Counting costs time itself, so it's only done while profiling.
+    """
+    if _replaced:
+        return
+    import gattai
+    count_calls(gattai.Dependency, 'get_prop', 'get_prop')
+    count_calls(gattai.Dependency, 'perform_substitutions', 'perform_substitutions')
+    count_calls(gattai.GattaiRecipe, 'perform_substitutions', 'perform_substitutions')
+    count_calls(os.path, 'exists', 'os.path.exists')
+    # every way of starting a process ends up here or in os.system
+    count_calls(subprocess.Popen, '_execute_child', 'subprocess spawns')
+    count_calls(os, 'system', 'subprocess spawns')
+
+def uninstall_counters():
+    """
+    Puts back the functions install_counters replaced.
+    """
+    while _replaced:
+        owner, attr, own = _replaced.pop()
+        if own is None:
+            delattr(owner, attr)
+        else:
+            setattr(owner, attr, own)
+
+def report_counters():
+    lines = ["Call counts:"]
+    for name, count in sorted(counters.items(), key=lambda item: -item[1]):
+        lines.append("    %-25s %d" % (name, count))
+    return "\n".join(lines)
+
+class StackSampler(object):
+    """
+    Records the stack of the main thread every interval seconds of CPU time
+    used by the process, so time spent waiting for builds isn't counted.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        # don't make system calls fail with EINTR whenever a sample is taken
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, filename):
+        f = open(filename, 'w')
+        for stack, count in sorted(self.stacks.items()):
+            f.write("%s %d\n" % (stack, count))
+        f.close()
+
+def profile(func, prefix, sampler=False):
+    """
+    Calls func under cProfile, writing the statistics to prefix.pstats, or
+    under the StackSampler if sampler is True, writing collapsed stacks to
+    prefix.collapsed. Call counts are logged once func has finished, even
+    if it raised, and the functions counted are restored.
+    """
+    install_counters()
+    try:
+        return run_profiler(func, prefix, sampler)
+    finally:
+        uninstall_counters()
+
+def run_profiler(func, prefix, sampler):
+    if sampler:
+        stack_sampler = StackSampler()
+        stack_sampler.start()
+        try:
+            return func()
+        finally:
+            stack_sampler.stop()
+            stack_sampler.write(prefix + '.collapsed')
+            logging.info("Wrote %d sampled stacks to %s.collapsed" % (sum(stack_sampler.stacks.values()), prefix))
+            logging.info(report_counters())
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(prefix + '.pstats')
+        logging.info("Wrote profile to %s.pstats, the slowest calls were:" % prefix)
+        stats = pstats.Stats(profiler)
+        for name, stat in sorted(stats.stats.items(), key=lambda item: -item[1][3])[:15]:
+            filename, line, function = name
+            logging.info("    %8.3fs %8d calls  %s:%d(%s)" % (stat[3], stat[1], os.path.basename(filename), line, function))
+        logging.info(report_counters())
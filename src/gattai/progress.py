@@ -0,0 +1,279 @@
+"""
+Showing how a run is progressing.
+
+While build_deps runs, the number of packages queued, building, done and
+failed, how fast source archives are downloading, how many CPUs are busy
+compared with the job slots, and how often the artifact cache had a package
+are kept up to date. They are shown on a status line at the bottom of the
+terminal, redrawn every second and cleared before each log message, and can
+be served in the Prometheus text format on a local port, so that the use of
+a build farm can be graphed.
+"""
+
+import BaseHTTPServer
+import collections
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import resources
+
+# seconds between redraws of the status line
+INTERVAL = 1.0
+# seconds of downloading the download rate is averaged over
+RATE_WINDOW = 5.0
+
+def format_rate(bytes_per_second):
+    for unit in ['B', 'KB', 'MB']:
+        if bytes_per_second < 1024:
+            return "%.1f %s/s" % (bytes_per_second, unit)
+        bytes_per_second /= 1024.0
+    return "%.1f GB/s" % bytes_per_second
+
+class BuildMetrics(object):
+    def __init__(self, total, jobs, cpus=None):
+        """
+        total = number of packages the run builds
+        jobs = number of job slots
+        cpus = number of CPUs of the host, counted if None
+        """
+        self.total = total
+        self.jobs = jobs
+        self.cpus = cpus or resources.cpu_count()
+        self.active = set()
+        self.done = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.download_bytes = 0
+        self.download_rate = 0.0
+        # None until two samples of the host's CPU times were taken
+        self.cpus_busy = None
+        # downloads report from worker threads, and scrapes come in on the server's
+        self.lock = threading.Lock()
+        self.samples = collections.deque()
+        self.last_cpu_times = resources.cpu_times()
+
+    def queued(self):
+        return self.total - len(self.active) - self.done - self.failed
+
+    def started(self, name):
+        self.active.add(name)
+
+    def finished(self, name, success, action=None, cached=False):
+        """
+        Counts a package as finished. cached says whether the package could
+        have come from the artifact cache, and action is what its build did.
+        """
+        self.active.discard(name)
+        if not success:
+            self.failed += 1
+            return
+        self.done += 1
+        if cached:
+            if action == 'cached':
+                self.cache_hits += 1
+            elif action in ['full', 'incremental']:
+                self.cache_misses += 1
+
+    def downloaded(self, nbytes):
+        with self.lock:
+            self.download_bytes += nbytes
+
+    def cache_hit_rate(self):
+        lookups = self.cache_hits + self.cache_misses
+        if lookups == 0:
+            return None
+        return float(self.cache_hits) / lookups
+
+    def sample(self):
+        """
+        Updates the download rate and the number of busy CPUs.
+        """
+        now = time.time()
+        with self.lock:
+            self.samples.append((now, self.download_bytes))
+            while len(self.samples) > 2 and self.samples[0][0] < now - RATE_WINDOW:
+                self.samples.popleft()
+            first_time, first_bytes = self.samples[0]
+            if now > first_time:
+                self.download_rate = (self.download_bytes - first_bytes) / (now - first_time)
+            cpu_times = resources.cpu_times()
+            if cpu_times is not None and self.last_cpu_times is not None:
+                busy = cpu_times[0] - self.last_cpu_times[0]
+                total = cpu_times[1] - self.last_cpu_times[1]
+                if total > 0:
+                    self.cpus_busy = self.cpus * float(busy) / total
+                    self.last_cpu_times = cpu_times
+            else:
+                self.last_cpu_times = cpu_times
+
+    def status(self):
+        """
+        Returns a one-line summary of the run.
+        """
+        parts = ["[%d/%d] %d building, %d queued" % (self.done + self.failed, self.total, len(self.active), self.queued())]
+        if self.failed:
+            parts[0] += ", %d failed" % self.failed
+        if self.download_rate:
+            parts.append("download %s" % format_rate(self.download_rate))
+        if self.cpus_busy is not None:
+            parts.append("cpu %.1f/%d, %d jobs" % (self.cpus_busy, self.cpus, self.jobs))
+        hit_rate = self.cache_hit_rate()
+        if hit_rate is not None:
+            parts.append("cache %d%%" % round(hit_rate * 100))
+        return " | ".join(parts)
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        def metric(name, kind, help, values):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in values:
+                lines.append("%s%s %s" % (name, labels, repr(float(value))))
+        metric('gattai_packages', 'gauge', "Packages of the run by state.",
+               [('{state="%s"}' % state, count) for state, count in
+                [('queued', self.queued()), ('building', len(self.active)), ('done', self.done), ('failed', self.failed)]])
+        metric('gattai_download_bytes_total', 'counter', "Bytes of source archives downloaded in the background.",
+               [('', self.download_bytes)])
+        metric('gattai_download_bytes_per_second', 'gauge', "Recent download rate.", [('', self.download_rate)])
+        metric('gattai_job_slots', 'gauge', "Packages that may build at the same time.", [('', self.jobs)])
+        metric('gattai_cpus', 'gauge', "CPUs of the host.", [('', self.cpus)])
+        if self.cpus_busy is not None:
+            metric('gattai_cpus_busy', 'gauge', "CPUs of the host that were recently busy.", [('', self.cpus_busy)])
+        metric('gattai_artifact_cache_requests_total', 'counter', "Packages looked up in the artifact cache.",
+               [('{result="hit"}', self.cache_hits), ('{result="miss"}', self.cache_misses)])
+        return "\n".join(lines) + "\n"
+
+class StatusLine(logging.Filter):
+    """
+    A line at the bottom of the terminal that is overwritten in place. As a
+    logging filter on the handlers writing to the same stream, it is cleared
+    before each message so that messages don't run into it.
+    """
+    def __init__(self, stream=sys.stderr):
+        logging.Filter.__init__(self)
+        self.stream = stream
+        self.handlers = []
+
+    def width(self):
+        try:
+            return int(os.environ.get('COLUMNS', 80)) - 1
+        except ValueError:
+            return 79
+
+    def show(self, text):
+        self.stream.write('\r' + text[:self.width()] + '\033[K')
+        self.stream.flush()
+
+    def clear(self):
+        # forked builds log to the same terminal without knowing whether
+        # the line is showing, so it is always cleared
+        self.stream.write('\r\033[K')
+        self.stream.flush()
+
+    def filter(self, record):
+        self.clear()
+        return True
+
+    def attach(self):
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler) and handler.stream is self.stream:
+                handler.addFilter(self)
+                self.handlers.append(handler)
+
+    def detach(self):
+        for handler in self.handlers:
+            handler.removeFilter(self)
+        self.handlers = []
+        self.clear()
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        metrics = self.server.metrics
+        # builds run without the loop when there is one job, so sample here too
+        metrics.sample()
+        body = metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would drown out the build's own messages
+        pass
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self.metrics = metrics
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MetricsHandler)
+
+class Monitor(object):
+    """
+    Keeps the status line and the metrics endpoint of a run up to date.
+    """
+    def __init__(self, metrics, loop, status=None, port=None):
+        """
+        metrics = the BuildMetrics of the run
+        loop = the EventLoop the run waits on
+        status = StatusLine to show the metrics on, or None
+        port = local port to serve the metrics on, or None
+        """
+        self.metrics = metrics
+        self.loop = loop
+        self.status = status
+        self.port = port
+        self.server = None
+        self.stopped = False
+
+    def start(self):
+        if self.status is not None:
+            self.status.attach()
+        if self.port is not None:
+            try:
+                self.server = MetricsServer(self.metrics, self.port)
+            except socket.error, e:
+                logging.warning("Unable to serve build metrics on port %d (%s), carrying on without them" % (self.port, e))
+        if self.server is not None:
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            logging.info("Serving build metrics on http://127.0.0.1:%d/metrics" % self.server.server_address[1])
+        self.tick()
+
+    def tick(self):
+        if self.stopped:
+            return
+        self.refresh()
+        self.loop.call_later(INTERVAL, self.tick)
+
+    def refresh(self):
+        self.metrics.sample()
+        if self.status is not None:
+            self.status.show(self.metrics.status())
+
+    def started(self, name):
+        self.metrics.started(name)
+        self.refresh()
+
+    def finished(self, name, success, action=None, cached=False):
+        self.metrics.finished(name, success, action, cached)
+        self.refresh()
+
+    def stop(self):
+        self.stopped = True
+        if self.status is not None:
+            self.status.detach()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,126 @@
+"""
+Compact, read-only records of package properties and settings.
+
+Recipes generated for large projects can define tens of thousands of
+packages, and every run looks at all of them. Rather than copying each
+package's dict and updating it with its platform block, a PackageProps keeps
+a reference to the dict as loaded from the recipe (the base) and to the dict
+of values that override it, such as the platform block. Lookups check the
+overrides first. Records are never changed once made; override() returns a
+new record sharing the same base, so nothing is copied until something
+actually differs.
+
+The recipe's JSON is loaded with interned keys, so the thousands of 'name',
+'version' and 'url' keys are all the same string object.
+"""
+
+import json
+
+def intern_key(key):
+    try:
+        return intern(str(key))
+    except UnicodeEncodeError:
+        return key
+
+def interned_object(pairs):
+    """
+    object_pairs_hook for the json module that interns the keys of every
+    object loaded.
+    """
+    return dict((intern_key(key), value) for key, value in pairs)
+
+def load_json(f):
+    return json.load(f, object_pairs_hook=interned_object)
+
+EMPTY = {}
+
+class PackageProps(object):
+    __slots__ = ('base', 'overrides')
+
+    def __init__(self, base, overrides=None):
+        """
+        base = the dict the properties come from, which is not copied and must not change
+        overrides = dict of values that take precedence over base's, or None
+        """
+        object.__setattr__(self, 'base', base)
+        object.__setattr__(self, 'overrides', overrides or EMPTY)
+
+    @classmethod
+    def resolve(cls, base, platform):
+        """
+        Returns the record for base with its block for platform, if any,
+        applied.
+        """
+        overrides = base.get(platform)
+        if not isinstance(overrides, dict):
+            overrides = None
+        return cls(base, overrides)
+
+    def override(self, changes):
+        """
+        Returns a new record with the values in changes taking precedence.
+        """
+        if not changes:
+            return self
+        overrides = dict(self.overrides)
+        overrides.update(changes)
+        return PackageProps(self.base, overrides)
+
+    def __getitem__(self, key):
+        if key in self.overrides:
+            return self.overrides[key]
+        return self.base[key]
+
+    def get(self, key, default=None):
+        if key in self.overrides:
+            return self.overrides[key]
+        return self.base.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.overrides or key in self.base
+
+    has_key = __contains__
+
+    def keys(self):
+        return [key for key in self]
+
+    def __iter__(self):
+        for key in self.base:
+            yield key
+        for key in self.overrides:
+            if key not in self.base:
+                yield key
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def __len__(self):
+        return len(self.base) + len([key for key in self.overrides if key not in self.base])
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, PackageProps):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __setattr__(self, name, value):
+        raise TypeError("PackageProps records can't be changed, use override()")
+
+    def __setitem__(self, key, value):
+        raise TypeError("PackageProps records can't be changed, use override()")
+
+    def __delitem__(self, key):
+        raise TypeError("PackageProps records can't be changed, use override()")
+
+    def __reduce__(self):
+        return (PackageProps, (self.base, self.overrides))
+
+    def __repr__(self):
+        return "PackageProps(%r)" % self.to_dict()
@@ -0,0 +1,101 @@
+"""
+Rebuilding only what changed in a recipe.
+
+After each run, what every package of the recipe resolved to (its props
+and the settings, the root dir and the versions of its build tools) is kept
+in .gattai/resolved.json, along with whether the package was built. The next
+run compares the recipe with it and reports the packages that were added,
+removed or changed, and which of their props changed. The packages that
+changed and everything depending on them are rebuilt, even if they seem to
+be installed already, and packages that were built by an earlier run and
+haven't changed since are skipped without being looked at, so that editing
+one package of a large recipe costs time in proportion to the edit.
+"""
+
+import json
+import logging
+import os
+
+import history
+
+class ResolvedRecipe(object):
+    def __init__(self, filename, ignore=()):
+        """
+        filename = where the recipe's resolved packages are kept
+        ignore = props that aren't compared, which earlier versions may have
+                 recorded
+        """
+        self.filename = filename
+        # package name -> {'props': what it resolved to, 'built': bool}
+        self.packages = {}
+        self.exists = os.path.exists(filename)
+        if self.exists:
+            try:
+                self.packages = json.load(open(filename)).get('packages', {})
+            except ValueError:
+                logging.warning("Ignoring unreadable resolved recipe %s" % filename)
+                self.exists = False
+        for package in self.packages.values():
+            for key in ignore:
+                package['props'].pop(key, None)
+
+    def diff(self, resolved):
+        """
+        Compares the recipe with resolved, a dict mapping the names of the
+        current recipe's packages to what they resolve to. Returns sorted
+        lists of the names added and removed, and a dict mapping the names of
+        the packages that changed to the sorted props that changed.
+        """
+        added = sorted(name for name in resolved if name not in self.packages)
+        removed = sorted(name for name in self.packages if name not in resolved)
+        changed = {}
+        for name in resolved:
+            if name in self.packages:
+                keys = changed_keys(self.packages[name]['props'], resolved[name])
+                if keys:
+                    changed[name] = keys
+        return added, removed, changed
+
+    def built(self, name):
+        return self.packages.get(name, {}).get('built', False)
+
+    def update(self, resolved, attempted, succeeded, rebuild=()):
+        """
+        Records what the recipe resolves to after a run.
+
+        resolved = dict mapping package names to what they resolve to
+        attempted = names of the packages the run set out to build
+        succeeded = names of the packages it built
+        rebuild = names of packages that still have to be rebuilt
+        """
+        packages = {}
+        for name, props in resolved.items():
+            if name in succeeded:
+                built = True
+            elif name in attempted or name in rebuild:
+                built = False
+            else:
+                # packages the run didn't look at keep their state while unchanged
+                built = self.built(name) and self.packages[name]['props'] == props
+            packages[name] = {'props': props, 'built': built}
+        self.packages = packages
+        self.exists = True
+
+    def save(self):
+        history.save_json(self.filename, {'packages': self.packages})
+
+def changed_keys(old, new):
+    return sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+def format_diff(added, removed, changed):
+    """
+    Returns the lines describing the differences found by ResolvedRecipe.diff.
+    """
+    lines = []
+    if added:
+        lines.append("    Added: %s" % ", ".join(added))
+    if removed:
+        lines.append("    Removed: %s" % ", ".join(removed))
+    if changed:
+        lines.append("    Changed: %s" % ", ".join("%s (%s)" % (name, ", ".join(changed[name])) for name in sorted(changed)))
+    return lines
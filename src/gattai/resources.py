@@ -0,0 +1,207 @@
+"""
+CPU and memory budgets for parallel builds.
+
+Packages can declare how many CPUs (cpu_weight) and how much memory in MB
+(mem_mb) their build needs. The scheduler only starts a package while the
+hints of everything running, plus its own, fit into the host's budget, which
+defaults to the number of CPUs and the memory available according to
+/proc/meminfo. The peak memory use of each build is measured, by sampling
+the resident size of the process tree doing the build, so that packages
+without a mem_mb hint can use what they needed last time.
+"""
+
+import multiprocessing
+import os
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# seconds between samples of a build's memory use
+SAMPLE_INTERVAL = 1.0
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def available_memory_mb(meminfo='/proc/meminfo'):
+    """
+    Returns the memory available for builds in MB, or None if it is unknown.
+    """
+    try:
+        lines = open(meminfo).readlines()
+    except IOError:
+        return None
+    values = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) >= 2 and parts[1].isdigit():
+            values[parts[0].rstrip(':')] = int(parts[1])
+    # older kernels don't estimate MemAvailable
+    kb = values.get('MemAvailable', values.get('MemTotal'))
+    if kb is None:
+        return None
+    return kb // 1024
+
+def cpu_times(stat='/proc/stat'):
+    """
+    Returns the (busy, total) time all CPUs of the host have spent since it
+    booted, in clock ticks, or None if it is unknown.
+    """
+    try:
+        f = open(stat)
+        try:
+            fields = f.readline().split()
+        finally:
+            f.close()
+    except IOError:
+        return None
+    if not fields or fields[0] != 'cpu':
+        return None
+    # user, nice, system, idle, iowait, irq, softirq and steal; the guest
+    # times after them are already counted as user and nice
+    ticks = [int(field) for field in fields[1:9]]
+    idle = sum(ticks[3:5])
+    return sum(ticks) - idle, sum(ticks)
+
+class Budget(object):
+    def __init__(self, cpus=None, mem_mb=None):
+        """
+        cpus = number of CPUs builds may use at once, the host's CPU count if None
+        mem_mb = MB of memory builds may use at once, the available memory if
+                 None, and unlimited if that is unknown
+        """
+        if cpus is None:
+            cpus = cpu_count()
+        if mem_mb is None:
+            mem_mb = available_memory_mb()
+        self.cpus = cpus
+        self.mem_mb = mem_mb
+        self.used_cpus = 0
+        self.used_mem_mb = 0
+
+    def fits(self, cpus, mem_mb):
+        """
+        Returns True if work needing cpus and mem_mb can start now. Anything
+        fits when nothing else is running, so that packages needing more
+        than the whole budget still get built, one at a time.
+        """
+        if self.used_cpus == 0 and self.used_mem_mb == 0:
+            return True
+        if self.used_cpus + cpus > self.cpus:
+            return False
+        if self.mem_mb is not None and self.used_mem_mb + mem_mb > self.mem_mb:
+            return False
+        return True
+
+    def acquire(self, cpus, mem_mb):
+        self.used_cpus += cpus
+        self.used_mem_mb += mem_mb
+
+    def release(self, cpus, mem_mb):
+        self.used_cpus -= cpus
+        self.used_mem_mb -= mem_mb
+
+def _process_table():
+    """
+    Returns a dict mapping the pids of all processes to (parent pid, resident
+    size in KB), or None if /proc is not available.
+    """
+    if not os.path.isdir('/proc/self'):
+        return None
+    page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+    table = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % name).read()
+        except IOError:
+            # the process exited while we were looking
+            continue
+        # the command name can contain spaces, the other fields start after it
+        fields = stat[stat.rfind(')') + 2:].split()
+        table[int(name)] = (int(fields[1]), int(fields[21]) * page_kb)
+    return table
+
+def tree_rss_kb(pid):
+    """
+    Returns the total resident size in KB of pid and all its descendants, or
+    None if it can't be measured on this platform.
+    """
+    table = _process_table()
+    if table is None:
+        return None
+    children = {}
+    for child, (parent, rss) in table.items():
+        children.setdefault(parent, []).append(child)
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        if current in table:
+            total += table[current][1]
+        pending.extend(children.get(current, []))
+    return total
+
+def children_max_rss_kb():
+    """
+    Returns the largest resident size in KB of any finished child process.
+    """
+    if resource is None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if os.uname()[0] == 'Darwin':
+        # reported in bytes there
+        maxrss //= 1024
+    return maxrss
+
+class PeakMemory(object):
+    """
+    Measures the peak memory use of this process and the processes it starts
+    while the with block runs. The result is in peak_mb afterwards.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_kb = 0
+        self.done = threading.Event()
+        self.thread = None
+        self.start_maxrss_kb = 0
+
+    def sample(self):
+        rss = tree_rss_kb(os.getpid())
+        if rss is not None:
+            self.peak_kb = max(self.peak_kb, rss)
+        return rss is not None
+
+    def run(self):
+        while not self.done.is_set():
+            if not self.sample():
+                return
+            self.done.wait(self.interval)
+
+    def __enter__(self):
+        self.start_maxrss_kb = children_max_rss_kb()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.done.set()
+        self.thread.join()
+        # short lived processes like compilers can peak between samples. The
+        # maximum covers every child this process ever had, so it only tells
+        # us something if it grew during the block
+        maxrss = children_max_rss_kb()
+        if maxrss > self.start_maxrss_kb:
+            self.peak_kb = max(self.peak_kb, maxrss)
+        return False
+
+    @property
+    def peak_mb(self):
+        return int(round(self.peak_kb / 1024.0))
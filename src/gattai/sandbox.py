@@ -0,0 +1,133 @@
+"""
+Building packages in a scratch directory.
+
+When a recipe sets scratch_dir, usually a tmpfs or a local SSD, each package
+is built in its own sandbox there instead of in its source dir under the
+root dir, which may be on slow network storage. The source tree is synced
+into the sandbox (only files that changed are copied, so a kept sandbox
+builds incrementally), configured and built there, and installed into a
+staging dir with DESTDIR. Only the installed files are then synced to the
+install dir, and concurrent builds can't write into each other's trees.
+"""
+
+import logging
+import os
+import shutil
+
+class Sandbox(object):
+    def __init__(self, root, source_dir, build_dir):
+        """
+        root = directory to build in, created if needed
+        source_dir = the package's real source dir, which is copied into the sandbox
+        build_dir = the package's real build dir
+        """
+        self.root = os.path.abspath(root)
+        self.source_dir = os.path.abspath(source_dir)
+        self.build_dir = os.path.abspath(build_dir)
+        self.src = os.path.join(self.root, 'src')
+        self.stage = os.path.join(self.root, 'stage')
+
+    def path(self, real_path):
+        """
+        Returns where real_path, a path in the package's source or build dir,
+        is in the sandbox.
+        """
+        real_path = os.path.abspath(real_path)
+        for real, sandboxed in [(self.source_dir, self.src), (self.build_dir, os.path.join(self.root, 'build'))]:
+            if real_path == real:
+                return sandboxed
+            if real_path.startswith(real + os.sep):
+                return os.path.join(sandboxed, real_path[len(real) + 1:])
+        return real_path
+
+    def staged_path(self, install_dir):
+        """
+        Returns where files installed with DESTDIR set to the stage end up.
+        """
+        return os.path.join(self.stage, os.path.abspath(install_dir).lstrip(os.sep))
+
+    def sync_in(self):
+        """
+        Brings the sandbox's copy of the sources up to date, returning the
+        number of files copied.
+        """
+        build = self.path(self.build_dir)
+        if not os.path.exists(build):
+            os.makedirs(build)
+        return sync_tree(self.source_dir, self.src)
+
+    def sync_out(self, install_dir):
+        """
+        Moves the staged install into install_dir, returning the number of
+        files copied.
+        """
+        staged = self.staged_path(install_dir)
+        copied = 0
+        if os.path.isdir(staged):
+            copied = sync_tree(staged, install_dir)
+        for dirpath, dirnames, filenames in os.walk(self.stage):
+            if dirpath == staged:
+                dirnames[:] = []
+                continue
+            for filename in filenames:
+                logging.warning("Not copying %s, it was installed outside of %s" % (os.path.join(dirpath, filename), install_dir))
+        shutil.rmtree(self.stage)
+        return copied
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+def same_file(src, dest):
+    try:
+        src_stat = os.lstat(src)
+        dest_stat = os.lstat(dest)
+    except OSError:
+        return False
+    return src_stat.st_size == dest_stat.st_size and int(src_stat.st_mtime) == int(dest_stat.st_mtime)
+
+def is_real_dir(path):
+    return os.path.isdir(path) and not os.path.islink(path)
+
+def sync_tree(src, dest):
+    """
+    Copies the files in src that are missing or different in dest, judging
+    by size and modification time. Files only in dest are left alone, and
+    so is anything in dest whose type differs from src's copy: dest may be
+    a prefix other packages installed into, so a directory there is never
+    replaced by a file or a link, nor a file or link by a directory (links
+    to directories are copied into). Returns the number of files copied.
+    """
+    copied = 0
+    for dirpath, dirnames, filenames in os.walk(src):
+        relpath = os.path.relpath(dirpath, src)
+        destdir = os.path.normpath(os.path.join(dest, relpath))
+        if not os.path.lexists(destdir):
+            os.makedirs(destdir)
+        for name in list(dirnames):
+            destpath = os.path.join(destdir, name)
+            if not os.path.islink(os.path.join(dirpath, name)) and os.path.lexists(destpath) and not os.path.isdir(destpath):
+                logging.warning("Not copying %s, %s is in the way" % (os.path.join(dirpath, name), destpath))
+                dirnames.remove(name)
+        links = [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]
+        # os.walk doesn't descend into linked dirs, copy them as links
+        for name in links + filenames:
+            srcpath = os.path.join(dirpath, name)
+            destpath = os.path.join(destdir, name)
+            if is_real_dir(destpath):
+                logging.warning("Not copying %s, %s is a directory" % (srcpath, destpath))
+                continue
+            if os.path.islink(srcpath):
+                target = os.readlink(srcpath)
+                if os.path.islink(destpath) and os.readlink(destpath) == target:
+                    continue
+                if os.path.lexists(destpath):
+                    os.remove(destpath)
+                os.symlink(target, destpath)
+            else:
+                if same_file(srcpath, destpath):
+                    continue
+                if os.path.lexists(destpath):
+                    os.remove(destpath)
+                shutil.copy2(srcpath, destpath)
+            copied += 1
+    return copied
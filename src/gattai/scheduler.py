@@ -0,0 +1,164 @@
+"""
+Runs package builds in dependency order, optionally several at a time.
+
+Whenever a job slot is free, the ready package with the longest remaining
+path to the end of the dependency graph is started first, using durations
+from the build history. That way long poles like icu or webkit start as
+early as possible instead of whenever recipe order happens to reach them.
+
+Parallel jobs are run in forked child processes, since building a package
+changes the working directory and environment of the process doing it.
+Packages can also be given CPU and memory weights, in which case a package
+is only started while it fits into the budget left by those already
+running. The scheduler waits for jobs on an event loop, which can also
+deliver the completion of other work, such as downloads, that packages are
+held for.
+"""
+
+import heapq
+import logging
+import multiprocessing
+import os
+
+import eventloop
+
+def _run_job(job, name):
+    """
+    Calls job(name), turning any way it can fail into a failed result so
+    that one package can't take down the whole run.
+    """
+    try:
+        return job(name)
+    except SystemExit:
+        return (False, None)
+    except Exception:
+        logging.exception("Unexpected error while building %s" % name)
+        return (False, None)
+
+def _run_child(job, name, conn):
+    conn.send(_run_job(job, name))
+    conn.close()
+
+class Scheduler(object):
+    def __init__(self, build_graph, durations, jobs=1, loop=None, weights=None, budget=None):
+        """
+        build_graph = the BuildGraph of the recipe
+        durations = dict mapping names to expected build times in seconds
+        jobs = maximum number of packages built at the same time
+        loop = the EventLoop to wait on, a private one is used if None
+        weights = dict mapping names to the (cpus, mem_mb) their builds need
+        budget = resources.Budget that running packages' weights must fit into
+        """
+        self.weights = weights or {}
+        self.budget = budget
+        self.own_loop = loop is None
+        if self.own_loop:
+            loop = eventloop.EventLoop()
+        self.loop = loop
+        self.graph = build_graph
+        self.jobs = max(1, jobs)
+        if self.jobs > 1 and not hasattr(os, 'fork'):
+            logging.warning("Parallel builds are not supported on this platform, building one package at a time.")
+            self.jobs = 1
+        self.lengths = build_graph.remaining_path(durations)
+        self.remaining = {}
+        self.ready = []
+        self.running = {}
+        self.holds = 0
+        self.stopped = False
+
+    def priority(self, name):
+        return (-self.lengths[name], self.graph.index[name])
+
+    def run(self, names, job, on_finish, held=[], on_start=None):
+        """
+        Calls job(name) for each of names once the names it depends on have
+        finished successfully. job returns a (success, info) tuple, which is
+        passed to on_finish(name, result) in this process. If on_finish
+        returns False, no new jobs are started. Dependencies that are not in
+        names are assumed to be satisfied already. The names in held are not
+        started until release(name) is called for them from the loop. If
+        given, on_start(name) is called as each job starts.
+        """
+        selected = set(names)
+        for name in names:
+            self.remaining[name] = len([dep for dep in self.graph.dependencies(name) if dep in selected])
+        for name in held:
+            if name in self.remaining:
+                self.remaining[name] += 1
+                self.holds += 1
+        for name in names:
+            if self.remaining[name] == 0:
+                heapq.heappush(self.ready, (self.priority(name), name))
+
+        try:
+            while ((self.ready or self.holds) and not self.stopped) or self.running:
+                while self.ready and not self.stopped and len(self.running) < self.jobs:
+                    weight = self.weight(self.ready[0][1])
+                    if self.budget is not None and not self.budget.fits(*weight):
+                        # rather than letting smaller packages overtake the
+                        # most urgent one, wait for enough to become free
+                        break
+                    key, name = heapq.heappop(self.ready)
+                    if self.budget is not None:
+                        self.budget.acquire(*weight)
+                    if on_start is not None:
+                        on_start(name)
+                    if self.jobs == 1:
+                        self.finish(name, _run_job(job, name), on_finish)
+                        if self.holds:
+                            # pick up whatever was released while the job ran
+                            self.loop.run_once(0)
+                    else:
+                        self.start(name, job, on_finish)
+                if self.running or (self.holds and not self.ready and not self.stopped):
+                    self.loop.run_once()
+        finally:
+            if self.own_loop:
+                self.loop.close()
+
+    def weight(self, name):
+        return self.weights.get(name, (1, 0))
+
+    def release(self, name):
+        """
+        Lets a package held by run() start once its dependencies are done.
+        """
+        self.holds -= 1
+        self.ready_if_done(name)
+
+    def start(self, name, job, on_finish):
+        recv_conn, send_conn = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(target=_run_child, args=(job, name, send_conn))
+        process.start()
+        send_conn.close()
+        self.running[recv_conn] = (name, process)
+        self.loop.add_reader(recv_conn, lambda: self.collect(recv_conn, on_finish))
+
+    def collect(self, conn, on_finish):
+        self.loop.remove_reader(conn)
+        name, process = self.running.pop(conn)
+        try:
+            result = conn.recv()
+        except EOFError:
+            # the child died without reporting back
+            result = (False, None)
+        conn.close()
+        process.join()
+        self.finish(name, result, on_finish)
+
+    def finish(self, name, result, on_finish):
+        if self.budget is not None:
+            self.budget.release(*self.weight(name))
+        if on_finish(name, result) is False:
+            self.stopped = True
+        if not result[0]:
+            return
+        for dependent in self.graph.dependents(name):
+            self.ready_if_done(dependent)
+
+    def ready_if_done(self, name):
+        if name in self.remaining:
+            self.remaining[name] -= 1
+            if self.remaining[name] == 0:
+                heapq.heappush(self.ready, (self.priority(name), name))
@@ -0,0 +1,168 @@
+"""
+Finding the programs packages are built with.
+
+Builders used to look for their program by running 'which' before every
+clean, build and install. The toolchain searches PATH in-process instead and
+remembers what it found for the rest of the run. Results are also cached on
+disk, keyed by the PATH value and the modification times of the directories
+on it, so adding or removing a program anywhere on PATH invalidates them.
+The file is only written after a batch of lookups, such as the versions of
+all the programs a package is built with, and only if something new was
+found.
+
+The versions of the programs found are worked out by running them with
+--version, once per binary (the cache entry is dropped when the binary's
+modification time changes), so that they can be part of build keys: a
+package built with a different make or compiler is a different build.
+"""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+
+import history
+import versions
+
+def executable_names(name):
+    if not sys.platform.startswith('win') or os.path.splitext(name)[1]:
+        return [name]
+    extensions = os.environ.get('PATHEXT', '.COM;.EXE;.BAT;.CMD').split(os.pathsep)
+    return [name] + [name + ext.lower() for ext in extensions if ext]
+
+def search_path(name, path):
+    """
+    Returns the full path of the program name on path, a PATH value, or None.
+    """
+    names = executable_names(name)
+    for dir in path.split(os.pathsep):
+        if not dir:
+            continue
+        for candidate in names:
+            filename = os.path.join(dir, candidate)
+            if os.path.isfile(filename) and os.access(filename, os.X_OK):
+                return filename
+    return None
+
+def mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+class Toolchain(object):
+    def __init__(self, path, cache_file=None):
+        """
+        path = the PATH value to search
+        cache_file = JSON file to keep results in between runs, or None
+        """
+        self.path = path
+        self.cache_file = cache_file
+        self.dirs = dict((dir, mtime(dir)) for dir in path.split(os.pathsep) if dir)
+        # program name -> {'path': full path or None, 'mtime': ..., 'version': ...}
+        self.tools = {}
+        # set when tools has entries the cache file doesn't
+        self.dirty = False
+        if cache_file and os.path.exists(cache_file):
+            try:
+                entry = json.load(open(cache_file)).get(path)
+            except (IOError, ValueError):
+                logging.warning("Ignoring unreadable toolchain cache %s" % cache_file)
+                entry = None
+            if entry and entry.get('dirs') == self.dirs:
+                self.tools = entry.get('tools', {})
+
+    def find(self, name):
+        """
+        Returns the full path of the program name, or None if it isn't on PATH.
+        """
+        if name not in self.tools:
+            filename = search_path(name, self.path)
+            self.tools[name] = {'path': filename, 'mtime': filename and mtime(filename)}
+            self.dirty = True
+        return self.tools[name]['path']
+
+    def version(self, name):
+        """
+        Returns the version of the program name, or None if it isn't on PATH
+        or doesn't say.
+        """
+        filename = self.find(name)
+        if filename is None:
+            return None
+        tool = self.tools[name]
+        if 'version' in tool and tool['mtime'] == mtime(filename):
+            return tool['version']
+        try:
+            process = subprocess.Popen([filename, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            version = versions.extract_version(process.communicate()[0])
+            if version is not None:
+                version = version.text
+        except OSError:
+            version = None
+        tool.update(mtime=mtime(filename), version=version)
+        self.dirty = True
+        return version
+
+    def versions(self, names):
+        """
+        Returns a dict mapping those of names that are on PATH to their versions.
+        """
+        result = {}
+        for name in names:
+            if self.find(name) is not None:
+                result[name] = self.version(name)
+        self.save()
+        return result
+
+    def save(self):
+        """
+        Writes what was found to the cache file, if anything new was. Build
+        jobs running at the same time each write through a temp file of
+        their own, and as the cache only saves work, failing to write it is
+        only worth a warning.
+        """
+        if not self.cache_file or not self.dirty:
+            return
+        data = {}
+        if os.path.exists(self.cache_file):
+            try:
+                data = json.load(open(self.cache_file))
+            except (IOError, ValueError):
+                pass
+        data[self.path] = {'dirs': self.dirs, 'tools': self.tools}
+        tmpname = '%s.tmp.%d' % (self.cache_file, os.getpid())
+        try:
+            history.save_json(self.cache_file, data, tmpname)
+            self.dirty = False
+        except (IOError, OSError), e:
+            logging.warning("Could not update toolchain cache %s: %s" % (self.cache_file, e))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+_cache_file = None
+_toolchains = {}
+
+def use_cache(filename):
+    """
+    Keeps what is found in filename from now on.
+    """
+    global _cache_file
+    _cache_file = filename
+    _toolchains.clear()
+
+def for_path(path):
+    """
+    Returns the Toolchain for path, a PATH value.
+    """
+    if path not in _toolchains:
+        _toolchains[path] = Toolchain(path, _cache_file)
+    return _toolchains[path]
+
+def current():
+    """
+    Returns the Toolchain for the current value of PATH, which packages'
+    env_vars can change.
+    """
+    return for_path(os.environ.get('PATH', ''))
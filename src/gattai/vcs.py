@@ -0,0 +1,128 @@
+"""
+Fetching package sources from git.
+
+Only the commit being built is fetched (a shallow fetch of depth 1 by
+default), optionally checking out only some paths of the tree. Fetches go
+through a persistent bare mirror per repository; checkouts borrow their
+objects from it the way 'git clone --reference' does, so fetching the same
+repository again transfers little more than what changed.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+
+import buildlog
+
+class FetchError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+def is_git_url(url):
+    return url.split('#')[0].endswith('.git')
+
+def run_git(args, cwd=None):
+    command = ' '.join(['git'] + ['"%s"' % arg for arg in args])
+    if buildlog.run_command(command, cwd=cwd) != 0:
+        raise FetchError("'%s' failed" % command)
+
+def mirror_path(mirror_dir, url):
+    path = url.rstrip('/')
+    if path.endswith('/.git'):
+        path = path[:-len('/.git')]
+    name = os.path.basename(path)
+    if not name.endswith('.git'):
+        name += '.git'
+    return os.path.join(mirror_dir, '%s-%s' % (hashlib.sha1(url).hexdigest()[:12], name))
+
+def update_mirror(url, mirror, ref, depth):
+    """
+    Fetches ref from url into the bare mirror and returns the commit it points to.
+    """
+    if not os.path.exists(mirror):
+        os.makedirs(mirror)
+        run_git(['init', '-q', '--bare', mirror])
+    # every ref gets its own tracking ref, so that concurrent fetches of
+    # different refs from the same repository don't race on FETCH_HEAD
+    local_ref = 'refs/gattai/%s' % hashlib.sha1(ref).hexdigest()[:12]
+    args = ['--git-dir', mirror, 'fetch', '-q']
+    if depth:
+        args.append('--depth=%d' % depth)
+    run_git(args + [url, '+%s:%s' % (ref, local_ref)])
+    try:
+        return subprocess.check_output(['git', '--git-dir', mirror, 'rev-parse', local_ref]).strip()
+    except (OSError, subprocess.CalledProcessError), e:
+        raise FetchError("Unable to resolve %s in mirror %s: %s" % (ref, mirror, e))
+
+def setup_sparse_checkout(git_dir, sparse_paths):
+    run_git(['--git-dir', git_dir, 'config', 'core.sparseCheckout', 'true'])
+    info_dir = os.path.join(git_dir, 'info')
+    if not os.path.exists(info_dir):
+        os.makedirs(info_dir)
+    f = open(os.path.join(info_dir, 'sparse-checkout'), 'w')
+    for path in sparse_paths:
+        f.write(path + '\n')
+    f.close()
+
+def fetch(url, dest, ref=None, depth=1, sparse_paths=None, mirror_dir=None):
+    """
+    Checks out ref (a branch, tag or commit, default HEAD) of the repository
+    at url into dest.
+
+    depth = number of commits of history to fetch, 0 for all of it
+    sparse_paths = if set, only these paths (sparse-checkout patterns) are checked out
+    mirror_dir = directory holding persistent bare mirrors, or None to fetch directly
+    """
+    if ref is None:
+        ref = 'HEAD'
+    if os.path.exists(dest):
+        raise FetchError("%s already exists" % dest)
+    tmp_dest = dest + '.tmp'
+    if os.path.exists(tmp_dest):
+        shutil.rmtree(tmp_dest)
+
+    try:
+        checkout(url, tmp_dest, ref, depth, sparse_paths, mirror_dir)
+    except:
+        if os.path.exists(tmp_dest):
+            shutil.rmtree(tmp_dest)
+        raise
+    os.rename(tmp_dest, dest)
+
+def checkout(url, dest, ref, depth, sparse_paths, mirror_dir):
+    """
+    Does the work of fetch in dest, which the caller removes if it fails.
+    """
+    run_git(['init', '-q', dest])
+    git_dir = os.path.join(dest, '.git')
+    run_git(['remote', 'add', 'origin', url], cwd=dest)
+    if sparse_paths:
+        setup_sparse_checkout(git_dir, sparse_paths)
+
+    if mirror_dir:
+        mirror = mirror_path(mirror_dir, url)
+        logging.info("Fetching %s %s into mirror %s" % (url, ref, mirror))
+        commit = update_mirror(url, mirror, ref, depth)
+        f = open(os.path.join(git_dir, 'objects', 'info', 'alternates'), 'w')
+        f.write(os.path.join(os.path.abspath(mirror), 'objects') + '\n')
+        f.close()
+        shallow = os.path.join(mirror, 'shallow')
+        if os.path.exists(shallow):
+            shutil.copyfile(shallow, os.path.join(git_dir, 'shallow'))
+    else:
+        logging.info("Fetching %s %s" % (url, ref))
+        args = ['fetch', '-q']
+        if depth:
+            args.append('--depth=%d' % depth)
+        run_git(args + ['origin', ref], cwd=dest)
+        commit = 'FETCH_HEAD'
+
+    run_git(['checkout', '-q', commit], cwd=dest)
@@ -0,0 +1,155 @@
+"""
+Parsing and comparing versions of installed packages.
+
+Version strings are parsed into Version objects, which compare by their
+numbers first (trailing zeros don't count, so 1.4 == 1.4.0) and then by their
+suffix: development and pre-releases (1.4.dev1 < 1.4a1 < 1.4b2 < 1.4rc1) come
+before the release, and anything else (1.0.2k, 2.1.post1) after it.
+
+Requirements are comma-separated lists of comparisons that must all hold,
+such as '>=1.5,<2'. The operators are ==, !=, <, <=, > and >=; a version on
+its own means ==.
+
+Recipes with thousands of packages check versions constantly, so parsed
+versions and requirements, and the results of matching them, are cached.
+"""
+
+import functools
+import re
+
+# the first thing that looks like a version in the output of 'program --version'
+VERSION_IN_OUTPUT = re.compile(r'(?<![\w.])v?(\d+(?:\.\d+)+(?:[-.]?[a-zA-Z]+\.?\d*)?)(?!\w)')
+# programs that use plain numbers, used if there is nothing better
+NUMBER_IN_OUTPUT = re.compile(r'(?<![\w.])v?(\d+)(?![\w.])')
+VERSION = re.compile(r'^v?(\d+(?:\.\d+)*)(?:[-_.]?([a-zA-Z]+)[-_.]?(\d*))?')
+COMPARISON = re.compile(r'^\s*(==|!=|<=|>=|<|>)?\s*(\S+)\s*$')
+
+# the order of the suffixes that come before a release
+PRE_RELEASES = {'dev': -4, 'a': -3, 'alpha': -3, 'b': -2, 'beta': -2, 'pre': -1, 'rc': -1, 'c': -1}
+
+_versions = {}
+_requirements = {}
+
+@functools.total_ordering
+class Version(object):
+    __slots__ = ('text', 'release', 'key')
+
+    def __init__(self, text):
+        """
+        text = the version string, ValueError is raised if it doesn't start with a number
+        """
+        match = VERSION.match(text.strip())
+        if match is None:
+            raise ValueError("Not a version: %r" % text)
+        self.text = text.strip()
+        numbers, suffix, suffix_number = match.groups()
+        release = [int(part) for part in numbers.split('.')]
+        self.release = tuple(release)
+        while len(release) > 1 and release[-1] == 0:
+            release.pop()
+        if suffix is None:
+            rank, suffix = 0, ''
+        else:
+            suffix = suffix.lower()
+            rank = PRE_RELEASES.get(suffix, 1)
+        self.key = (tuple(release), rank, suffix, int(suffix_number or 0))
+
+    def __eq__(self, other):
+        return isinstance(other, Version) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "Version(%r)" % self.text
+
+def parse_version(text):
+    """
+    Returns the Version for text, or None if it isn't one.
+    """
+    if text not in _versions:
+        try:
+            _versions[text] = Version(text)
+        except ValueError:
+            _versions[text] = None
+    return _versions[text]
+
+def extract_version(output):
+    """
+    Returns the first Version found in output, such as the output of
+    'program --version', or None.
+    """
+    for pattern in [VERSION_IN_OUTPUT, NUMBER_IN_OUTPUT]:
+        match = pattern.search(output)
+        if match is not None:
+            return parse_version(match.group(1))
+    return None
+
+OPERATORS = {
+    '==': lambda version, bound: version == bound,
+    '!=': lambda version, bound: version != bound,
+    '<': lambda version, bound: version < bound,
+    '<=': lambda version, bound: version <= bound,
+    '>': lambda version, bound: version > bound,
+    '>=': lambda version, bound: version >= bound,
+}
+
+class Requirement(object):
+    __slots__ = ('text', 'comparisons', 'results')
+
+    def __init__(self, text):
+        """
+        text = comparisons separated by commas, ValueError is raised if they don't parse
+        """
+        self.text = text
+        self.comparisons = []
+        self.results = {}
+        for clause in text.split(','):
+            match = COMPARISON.match(clause)
+            bound = match and parse_version(match.group(2))
+            if bound is None:
+                raise ValueError("Not a version requirement: %r" % text)
+            self.comparisons.append((OPERATORS[match.group(1) or '=='], bound))
+
+    def matches(self, version):
+        """
+        Returns True if version, a Version, satisfies every comparison.
+        """
+        if version not in self.results:
+            self.results[version] = all(compare(version, bound) for compare, bound in self.comparisons)
+        return self.results[version]
+
+    def __str__(self):
+        return self.text
+
+def parse_requirement(text):
+    """
+    Returns the Requirement for text, raising ValueError if it doesn't parse.
+    """
+    if text not in _requirements:
+        _requirements[text] = Requirement(text)
+    return _requirements[text]
+
+def default_requirement(version, exact=False):
+    """
+    Returns the requirement a package of the given version has when it
+    doesn't say: that version exactly, or that version or a later one with
+    the same major number, since future major versions are often not
+    compatible. Returns None if version isn't a version, such as a branch
+    name, which only the same text matches.
+    """
+    parsed = parse_version(version)
+    if parsed is None:
+        return None
+    if exact:
+        return "==%s" % version
+    return ">=%s,<%d" % (version, parsed.release[0] + 1)
@@ -0,0 +1,277 @@
+"""
+Watch mode: keeps a recipe loaded and rebuilds packages when they change.
+
+The recipe file and the source dir of each targeted package are watched,
+using inotify on Linux and polling file modification times elsewhere (or
+when inotify runs out of watches). When files change, only the packages
+they belong to and the packages depending on those are rebuilt. Changes made
+while a build is running are not picked up, since builds write into their
+own source trees.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+import builder
+import graph
+
+# seconds without further changes before a rebuild starts
+SETTLE_TIME = 0.5
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+class WatchError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return repr(self.value)
+
+class PollingWatcher(object):
+    """
+    Detects changes by comparing snapshots of file sizes and modification times.
+    """
+    def __init__(self, paths, interval=1.0):
+        self.paths = list(paths)
+        self.interval = interval
+        self.fingerprints = {}
+        self.reset()
+
+    def fingerprint(self, path):
+        result = {}
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            result[path] = (stat.st_mtime, stat.st_size)
+            return result
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                fullpath = os.path.join(dirpath, filename)
+                try:
+                    stat = os.lstat(fullpath)
+                except OSError:
+                    continue
+                result[fullpath] = (stat.st_mtime, stat.st_size)
+        return result
+
+    def reset(self):
+        """
+        Forgets about changes made so far.
+        """
+        for path in self.paths:
+            self.fingerprints[path] = self.fingerprint(path)
+
+    def poll(self, timeout):
+        """
+        Waits up to timeout seconds and returns the watched paths that changed.
+        """
+        time.sleep(min(timeout, self.interval))
+        changed = set()
+        for path in self.paths:
+            fingerprint = self.fingerprint(path)
+            if fingerprint != self.fingerprints[path]:
+                changed.add(path)
+                self.fingerprints[path] = fingerprint
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    """
+    Detects changes using the Linux inotify API, watching directories recursively.
+    """
+    def __init__(self, paths):
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or not libc_name:
+            raise WatchError("inotify is not available on this platform")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise WatchError("inotify is not available in this C library")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise WatchError(os.strerror(ctypes.get_errno()))
+        self.paths = list(paths)
+        # watch descriptor -> list of (watched root, directory, file name or
+        # None for any file in the directory)
+        self.watches = {}
+        try:
+            for path in self.paths:
+                self.add_tree(path, path)
+        except WatchError:
+            self.close()
+            raise
+
+    def add_watch(self, root, path, name=None):
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in [errno.ENOENT, errno.EACCES]:
+                return
+            raise WatchError("Unable to watch %s: %s" % (path, os.strerror(err)))
+        self.watches.setdefault(wd, []).append((root, path, name))
+
+    def add_tree(self, root, path):
+        if not os.path.isdir(path):
+            # editors often replace files rather than writing to them, so
+            # watch the directory for the file's name instead of its inode
+            self.add_watch(root, os.path.dirname(path), os.path.basename(path))
+            return
+        for dirpath, dirnames, filenames in os.walk(path):
+            self.add_watch(root, dirpath)
+
+    def reset(self):
+        while select.select([self.fd], [], [], 0)[0]:
+            self.read_events()
+
+    def read_events(self):
+        changed = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # we lost track, assume everything changed
+                changed.update(self.paths)
+                continue
+            for root, path, only_name in self.watches.get(wd, []):
+                if only_name is not None:
+                    if name == only_name:
+                        changed.add(root)
+                    continue
+                changed.add(root)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(root, os.path.join(path, name))
+        return changed
+
+    def poll(self, timeout):
+        changed = set()
+        if select.select([self.fd], [], [], timeout)[0]:
+            changed = self.read_events()
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def create_watcher(paths, interval=1.0):
+    try:
+        return InotifyWatcher(paths)
+    except WatchError, e:
+        logging.info("Not using inotify (%s), polling for changes every %s seconds." % (e.value, interval))
+        return PollingWatcher(paths, interval)
+
+def wait_for_changes(watcher, interval=1.0):
+    """
+    Blocks until something changes, then waits for the changes to settle and
+    returns every watched path that changed.
+    """
+    changed = set()
+    while not changed:
+        changed = watcher.poll(interval)
+    while True:
+        more = watcher.poll(SETTLE_TIME)
+        if not more:
+            return changed
+        changed.update(more)
+
+def watched_paths(recipe, targets):
+    """
+    Returns a dict mapping each watched path to the name of the package it
+    belongs to, or None for the recipe file.
+    """
+    import gattai
+    paths = {recipe.filename: None}
+    for dep in recipe.deps:
+        if dep['name'] in targets or "all" in targets:
+            source = gattai.Dependency(recipe, dep).source_dir()
+            if os.path.isdir(source):
+                paths[source] = dep['name']
+    return paths
+
+def run_build(recipe, targets, arguments, jobs):
+    try:
+        recipe.build_deps(targets, arguments, jobs)
+    except (builder.BuildError, SystemExit):
+        logging.error("Build failed, waiting for changes...")
+        return False
+    logging.info("Build finished, waiting for changes...")
+    return True
+
+def watch_recipe(recipe, targets=["all"], arguments=[], jobs=1, interval=1.0):
+    recipe.probe_cache = {}
+    recipe.path_cache = {}
+    run_build(recipe, targets, arguments, jobs)
+
+    paths = watched_paths(recipe, targets)
+    watcher = create_watcher(paths, interval)
+    # packages that changed while the recipe couldn't be used
+    affected = set()
+    try:
+        while True:
+            changed = wait_for_changes(watcher, interval)
+            for path in changed:
+                if paths[path] is None:
+                    logging.info("Recipe changed, reloading %s" % recipe.filename)
+                    try:
+                        affected.update(recipe.reload())
+                    except ValueError, e:
+                        logging.error("Unable to reload %s (%s), waiting for changes..." % (recipe.filename, e))
+                else:
+                    logging.info("Sources of %s changed" % paths[path])
+                    affected.add(paths[path])
+            try:
+                rebuild = recipe.build_graph().transitive_dependents(affected)
+            except graph.GraphError, e:
+                # rebuilt once the recipe is fixed
+                logging.error("Unable to order the packages of %s (%s), waiting for changes..." % (recipe.filename, e))
+                watcher.reset()
+                continue
+            affected = set()
+            if not "all" in targets:
+                rebuild.intersection_update(targets)
+
+            if rebuild:
+                for name in rebuild:
+                    # packages that changed need rebuilding even if a copy is installed
+                    recipe.probe_cache[name] = False
+                logging.info("Rebuilding %s" % ", ".join(sorted(rebuild)))
+                if run_build(recipe, list(rebuild), arguments, jobs):
+                    # probe them afresh next time, they may well be up to date
+                    for name in rebuild:
+                        del recipe.probe_cache[name]
+
+            # builds write into source trees and may have added packages, so start afresh
+            new_paths = watched_paths(recipe, targets)
+            if new_paths != paths:
+                watcher.close()
+                paths = new_paths
+                watcher = create_watcher(paths, interval)
+            else:
+                watcher.reset()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+test_artifacts.py
+
+tests sharing built packages through a local and a remote artifact cache
+
+"""
+
+import json
+import os
+import threading
+import urllib2
+
+import pytest
+
+import gattai
+from gattai import artifacts
+
+@pytest.fixture
+def server(tmpdir):
+    server = artifacts.ArtifactServer(str(tmpdir.join('server')), port=0, host='127.0.0.1')
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def server_url(server):
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+def test_cache_round_trip(tmpdir, server):
+    tree = tmpdir.mkdir('stage')
+    tree.mkdir('bin').join('aa').write('built')
+    key = 'ab' * 20
+    cache = artifacts.ArtifactCache(str(tmpdir.join('local')), server_url(server))
+    assert not cache.has(key)
+    cache.store(key, str(tree))
+    assert cache.pending_uploads() == [key]
+    cache.upload(key)
+    assert cache.pending_uploads() == []
+    assert tmpdir.join('server', key + '.tar.gz').exists()
+
+    other = artifacts.ArtifactCache(str(tmpdir.join('other')), server_url(server))
+    assert other.has(key)
+    assert other.restore('cd' * 20, str(tmpdir.join('install'))) is None
+    assert other.restore(key, str(tmpdir.join('install'))) is not None
+    assert tmpdir.join('install', 'bin', 'aa').read() == 'built'
+    assert tmpdir.join('other', key + '.tar.gz').exists()
+
+    with pytest.raises(urllib2.HTTPError):
+        urllib2.urlopen(server_url(server) + '/../secret')
+
+def test_restore_leaves_other_packages_alone(tmpdir):
+    # the artifact links lib64 to lib and has a real share/doc
+    tree = tmpdir.mkdir('stage')
+    tree.mkdir('lib').join('libaa.so').write('aa')
+    os.symlink('lib', str(tree.join('lib64')))
+    tree.mkdir('share').mkdir('doc').join('aa.txt').write('aa')
+    key = 'ab' * 20
+    cache = artifacts.ArtifactCache(str(tmpdir.join('local')))
+    cache.store(key, str(tree))
+
+    # where another package installed the opposite
+    install = tmpdir.mkdir('install')
+    install.mkdir('lib64').join('libprev64.so').write('prev')
+    install.mkdir('share').mkdir('prev-doc')
+    os.symlink('prev-doc', str(install.join('share', 'doc')))
+    assert cache.restore(key, str(install)) is not None
+
+    assert install.join('lib', 'libaa.so').read() == 'aa'
+    assert install.join('lib64', 'libprev64.so').read() == 'prev'
+    assert not install.join('lib64').islink()
+    assert install.join('share', 'doc').islink()
+    assert install.join('share', 'prev-doc', 'aa.txt').read() == 'aa'
+    assert tmpdir.join('local').listdir() == [tmpdir.join('local', key + '.tar.gz')]
+
+def test_unreachable_server(tmpdir, server, monkeypatch):
+    url = server_url(server)
+    server.shutdown()
+    server.server_close()
+    warnings = []
+    monkeypatch.setattr(artifacts.logging, 'warning', warnings.append)
+    cache = artifacts.ArtifactCache(str(tmpdir.join('local')), url)
+    assert not cache.has('ab' * 20)
+    assert cache.fetch('cd' * 20) is None
+    assert len(warnings) == 1
+
+def test_build_from_remote_cache(tmpdir, monkeypatch, server):
+    monkeypatch.chdir(tmpdir)
+    source = tmpdir.mkdir('aa-5.0')
+    source.join('configure').write('#!/bin/sh\nexit 0\n')
+    source.join('configure').chmod(0755)
+    source.join('Makefile').write('all:\n\techo built > out\n'
+                                  'install:\n\tmkdir -p $(DESTDIR)$(prefix)/bin\n\tcp out $(DESTDIR)$(prefix)/bin/aa\n')
+    install = tmpdir.join('install')
+    settings = {'scratch_dir': str(tmpdir.join('scratch')), 'install_dir': str(install),
+                'artifact_url': server_url(server)}
+    packages = [{'name': 'aa', 'version': '5.0'}]
+    json.dump({'settings': settings, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+
+    gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai'))).build_deps()
+    assert len(tmpdir.join('server').listdir('*.tar.gz')) == 1
+
+    # a fresh machine without the sources or a local cache
+    install.remove()
+    source.remove()
+    tmpdir.join('.gattai').remove()
+    recipe = gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+    assert recipe.plan().split()[1] == 'cached'
+    recipe.build_deps()
+    assert install.join('bin', 'aa').read() == 'built\n'
+
+def test_artifacts_must_match_their_digest(tmpdir, server):
+    tree = tmpdir.mkdir('stage')
+    tree.mkdir('bin').join('aa').write('built')
+    key = 'ab' * 20
+    cache = artifacts.ArtifactCache(str(tmpdir.join('local')), server_url(server))
+    cache.store(key, str(tree))
+    cache.upload(key)
+
+    # uploads without a digest are refused
+    request = urllib2.Request(server_url(server) + '/' + 'cd' * 20 + '.tar.gz', 'junk')
+    request.get_method = lambda: 'PUT'
+    with pytest.raises(urllib2.HTTPError):
+        urllib2.urlopen(request)
+    assert not tmpdir.join('server', 'cd' * 20 + '.tar.gz').exists()
+
+    tmpdir.join('server', key + '.tar.gz').write('tampered')
+    other = artifacts.ArtifactCache(str(tmpdir.join('other')), server_url(server))
+    assert other.restore(key, str(tmpdir.join('install'))) is None
+    assert not tmpdir.join('install').exists()
+    assert not tmpdir.join('other', key + '.tar.gz').exists()
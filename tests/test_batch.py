@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+"""
+test_batch.py
+
+tests building several recipes together
+
+"""
+
+import json
+
+import gattai
+
+def write_recipe(dir, name, packages, settings={}):
+    filename = str(dir.join(name))
+    json.dump({'settings': settings, 'packages': packages}, open(filename, 'w'))
+    return filename
+
+def test_shared_packages_are_built_once(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    libpng = {'name': 'libpng', 'version': '1.5.9'}
+    first = write_recipe(tmpdir, 'first.gattai', [dict(libpng), {'name': 'curl', 'version': '7.19.6'}])
+    second = write_recipe(tmpdir, 'second.gattai', [dict(libpng, depends=[]), {'name': 'icu', 'version': '3.4.1'}])
+    other = write_recipe(tmpdir, 'other.gattai', [dict(libpng)], settings={'configure_args': ['--enable-foo']})
+
+    build_graph, nodes = gattai.RecipeBatch([first, second, other]).build_graph()
+
+    names = sorted(name for recipe, name in nodes.values())
+    assert names == ['curl', 'icu', 'libpng', 'libpng']
+    curl = [node for node in nodes if node.startswith('curl-')][0]
+    icu = [node for node in nodes if node.startswith('icu-')][0]
+    assert build_graph.dependencies(curl) == build_graph.dependencies(icu)
+
+def test_run_settings_are_not_part_of_the_build(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    libpng = {'name': 'libpng', 'version': '1.5.9'}
+    first = write_recipe(tmpdir, 'first.gattai', [dict(libpng)])
+    second = write_recipe(tmpdir, 'second.gattai', [dict(libpng)],
+                          settings={'metrics_port': 9100, 'artifact_uploads': 8, 'download_jobs': 1})
+
+    build_graph, nodes = gattai.RecipeBatch([first, second]).build_graph()
+    assert len(nodes) == 1
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+test_buildlog.py
+
+tests the per-package build logs
+
+"""
+
+import gzip
+import json
+import os
+import shutil
+
+from gattai import buildlog
+
+log_dir = 'junk_logs'
+
+def setup_function(function):
+    shutil.rmtree(log_dir, ignore_errors=True)
+
+def teardown_function(function):
+    buildlog.set_current(None)
+    shutil.rmtree(log_dir, ignore_errors=True)
+
+def test_tail_is_bounded():
+    log = buildlog.PackageLog('junk', os.path.join(log_dir, 'junk.log'), tail_lines=3)
+    for i in range(10):
+        log.write('line %d\n' % i)
+    log.write('partial')
+    log.close()
+
+    assert log.tail() == ['line 7', 'line 8', 'line 9', 'partial']
+    assert open(log.path).read().count('\n') == 10
+
+def test_run_command_goes_to_log():
+    manager = buildlog.LogManager(log_dir, events_path=os.path.join(log_dir, 'events.json'), compress=True)
+    log = manager.open_package('junk')
+    assert buildlog.run_command('echo hello') == 0
+    assert buildlog.run_command('exit 3') == 3
+    manager.close_package(log, True)
+    manager.close()
+
+    assert buildlog.current() is None
+    assert 'hello' in gzip.open(log.path + '.gz').read()
+    events = [json.loads(line) for line in open(os.path.join(log_dir, 'events.json'))]
+    assert [e['event'] for e in events] == ['start', 'finish']
+    assert events[1]['success']
+
+def test_capture_command_keeps_tail():
+    status, lines = buildlog.capture_command('for i in 1 2 3 4 5; do echo line $i; done; exit 2', tail_lines=2)
+    assert status == 2
+    assert lines == ['line 4', 'line 5']
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+test_cmake.py
+
+tests building CMake projects, with a stand-in cmake that records how it
+was run
+
+"""
+
+import json
+import os
+import stat
+
+import gattai
+
+FAKE_CMAKE = """#!/bin/sh
+echo "$@" >> %(log)s
+if [ "$1" != "--build" ]; then
+    touch CMakeCache.txt
+fi
+"""
+
+def test_cmake_configures_once(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    bin_dir = tmpdir.mkdir('bin')
+    log = tmpdir.join('cmake.log')
+    cmake = bin_dir.join('cmake')
+    cmake.write(FAKE_CMAKE % {'log': log})
+    cmake.chmod(stat.S_IRWXU)
+    monkeypatch.setenv('PATH', os.pathsep.join([str(bin_dir), os.environ['PATH']]))
+
+    source = tmpdir.mkdir('cc-5.0')
+    source.join('CMakeLists.txt').write('project(cc C)\n')
+    install = tmpdir.join('install')
+    settings = {'install_dir': str(install)}
+    packages = [{'name': 'cc', 'version': '5.0', 'format': 'cmake', 'cmake_generator': 'Unix Makefiles',
+                 'cpu_weight': 3, 'include_dirs': [str(tmpdir)], 'configure_args': ['-DWITH_CC=ON']}]
+    json.dump({'settings': settings, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+
+    recipe = gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+    assert recipe.plan().splitlines()[0].split()[1] == 'full'
+    recipe.build_deps()
+    # unchanged packages are skipped unless asked not to diff the recipe
+    recipe.build_deps(diff=False)
+
+    # leave out the version checks
+    calls = [call for call in log.read().splitlines() if call != '--version']
+    configure = calls[0]
+    assert '-G Unix Makefiles' in configure
+    assert '-DCMAKE_INSTALL_PREFIX=%s' % install in configure
+    assert '-DCMAKE_C_FLAGS=-I%s' % tmpdir in configure
+    assert configure.endswith('-DWITH_CC=ON %s' % source)
+    # the second build reuses the configured build dir
+    build_dir = source.join('_build')
+    assert calls[1:] == ['--build %s -- -j3' % build_dir, '--build %s --target install -- -j3' % build_dir] * 2
+    assert build_dir.join('CMakeCache.txt').exists()
+    assert recipe.plan(diff=False).splitlines()[0].split()[1] == 'incremental'
+    assert recipe.plan().splitlines()[0].split()[1] == 'unchanged'
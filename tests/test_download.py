@@ -135,3 +135,24 @@ def test_download_source():
 
 
 
+
+def test_sources_download_in_background(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    remote = tmpdir.mkdir('remote').join('junk-5.0.tar.gz')
+    remote.write('not really a tarball')
+    recipe_file = tmpdir.join('recipe.gattai')
+    recipe_file.write('{"settings": {}, "packages": [{"name": "junk", "version": "5.0", "source": "file://%s"}]}' % remote)
+    recipe = gattai.GattaiRecipe(str(recipe_file))
+    dep = gattai.Dependency(recipe, recipe.package_props('junk'))
+
+    loop = gattai.eventloop.EventLoop()
+    finished = []
+    pool, held = gattai.start_downloads(loop, [('junk', dep)], 2, finished.append)
+    assert held == ['junk']
+    while not finished:
+        loop.run_once()
+    pool.close()
+    loop.close()
+
+    assert tmpdir.join('junk-5.0.tar.gz').read() == 'not really a tarball'
+    assert not tmpdir.join('junk-5.0.tar.gz.part').exists()
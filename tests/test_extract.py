@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+test_extract.py
+
+tests extracting source archives
+
+"""
+
+import json
+import os
+import subprocess
+import tarfile
+
+import pytest
+
+import gattai
+from gattai import extract
+
+def make_tarball(tmpdir, name, mode):
+    src = tmpdir.mkdir('src')
+    src.mkdir('pkg-1.0').mkdir('include').join('pkg.h').write('int pkg;\n')
+    src.join('pkg-1.0', 'big.dat').write('x' * (extract.INLINE_SIZE + 1))
+    os.symlink('include/pkg.h', str(src.join('pkg-1.0', 'link.h')))
+    filename = str(tmpdir.join(name))
+    tar = tarfile.open(filename, mode)
+    tar.add(str(src.join('pkg-1.0')), 'pkg-1.0')
+    tar.close()
+    return filename
+
+def test_archive_format():
+    assert extract.archive_format('icu-3.4.1.tgz') == ('tar', 'gz')
+    assert extract.archive_format('foo-1.0.tar.xz') == ('tar', 'xz')
+    assert extract.archive_format('py_gd-master.zip') == ('zip', '')
+    assert extract.archive_format('foo.git') is None
+
+@pytest.mark.parametrize('name,mode', [('pkg.tar.gz', 'w:gz'), ('pkg.tar.bz2', 'w:bz2'), ('pkg.tar', 'w')])
+def test_extract_tarball(tmpdir, monkeypatch, name, mode):
+    filename = make_tarball(tmpdir, name, mode)
+    dest = tmpdir.mkdir('dest')
+    # force the pure Python path, then use whatever decompressors are installed
+    for path in ['', os.environ['PATH']]:
+        monkeypatch.setenv('PATH', path)
+        stats = extract.extract(filename, str(dest.join(path and 'tools' or 'python')))
+        assert stats['bytes'] == extract.INLINE_SIZE + 1 + len('int pkg;\n')
+
+    for tool in ['tools', 'python']:
+        assert dest.join(tool, 'pkg-1.0', 'include', 'pkg.h').read() == 'int pkg;\n'
+        assert os.readlink(str(dest.join(tool, 'pkg-1.0', 'link.h'))) == 'include/pkg.h'
+
+def test_refuses_paths_outside_dest():
+    with pytest.raises(extract.ExtractError):
+        extract.member_path('dest', '../etc/passwd')
+
+def test_include_and_exclude(tmpdir):
+    assert extract.wanted('./pkg-1.0/src/a.c', exclude=['*/testdata'])
+    assert not extract.wanted('pkg-1.0/testdata/big.dat', exclude=['*/testdata'])
+    assert extract.wanted('pkg-1.0/include/pkg.h', include=['pkg-1.0/include'])
+    assert not extract.wanted('pkg-1.0/big.dat', include=['pkg-1.0/include'])
+
+    filename = make_tarball(tmpdir, 'pkg.tar.gz', 'w:gz')
+    dest = tmpdir.mkdir('dest')
+    extract.extract(filename, str(dest), exclude=['*.dat'])
+    assert dest.join('pkg-1.0', 'include', 'pkg.h').check()
+    assert not dest.join('pkg-1.0', 'big.dat').check()
+
+def test_partial_tree_is_replaced(tmpdir):
+    filename = make_tarball(tmpdir, 'pkg.tar.gz', 'w:gz')
+    dest = tmpdir.mkdir('dest')
+    tree = dest.mkdir('pkg-1.0')
+    tree.join('stale.o').write('')
+    assert not extract.is_intact(str(tree), filename)
+
+    extract.extract_atomically(filename, str(dest), replace=str(tree))
+    extract.write_marker(str(tree), filename)
+
+    assert sorted(os.listdir(str(dest))) == ['pkg-1.0']
+    assert not tree.join('stale.o').check()
+    assert extract.is_intact(str(tree), filename)
+    assert not extract.is_intact(str(tree), filename, exclude=['*.dat'])
+
+def test_refuses_writing_through_links(tmpdir):
+    outside = tmpdir.mkdir('outside')
+    for target in [str(outside), '../../outside']:
+        filename = str(tmpdir.join('evil.tar'))
+        tar = tarfile.open(filename, 'w')
+        link = tarfile.TarInfo('pkg-1.0/a')
+        link.type = tarfile.SYMTYPE
+        link.linkname = target
+        tar.addfile(link)
+        data = tarfile.TarInfo('pkg-1.0/a/x')
+        tar.addfile(data)
+        tar.close()
+
+        dest = tmpdir.join('dest')
+        dest.ensure(dir=True)
+        with pytest.raises(extract.ExtractError):
+            extract.extract(filename, str(dest))
+        assert outside.listdir() == []
+        dest.remove()
+
+def test_only_interrupted_trees_are_replaced(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    make_tarball(tmpdir, 'pkg-1.0.tar.gz', 'w:gz')
+    recipe_file = tmpdir.join('recipe.gattai')
+    recipe_file.write(json.dumps({'settings': {}, 'packages': [{'name': 'pkg', 'version': '1.0', 'source': 'pkg-1.0.tar.gz'}]}))
+    recipe = gattai.GattaiRecipe(str(recipe_file))
+    dep = gattai.Dependency(recipe, recipe.package_props('pkg'))
+
+    # unpacked before gattai kept markers, with local changes
+    tree = tmpdir.mkdir('pkg-1.0')
+    tree.join('edited.c').write('int edited;\n')
+    assert dep.source_exists()
+    assert tree.join('edited.c').check()
+
+    # a gattai that was killed while moving the extracted files into place
+    child = subprocess.Popen(['true'])
+    child.wait()
+    tmpdir.mkdir(extract.tmp_dir_name('pkg-1.0.tar.gz', child.pid))
+    assert dep.source_exists()
+    assert not tree.join('edited.c').check()
+    assert tree.join('include', 'pkg.h').check()
+    assert extract.has_marker(str(tree))
+    assert not [name for name in os.listdir(str(tmpdir)) if name.startswith(extract.TMP_PREFIX)]
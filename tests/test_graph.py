@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""
+test_graph.py
+
+tests the package dependency graph
+
+"""
+
+import json
+
+import pytest
+
+import gattai
+from gattai import graph
+
+def make_graph():
+    # a and b are independent, c needs both, d has no 'depends' so follows c
+    return graph.BuildGraph(['a', 'b', 'c', 'd'],
+                            {'a': None, 'b': [], 'c': ['a', 'b'], 'd': None})
+
+def test_undeclared_depends_follow_recipe_order():
+    g = make_graph()
+    assert g.dependencies('a') == []
+    assert g.dependencies('d') == ['c']
+    assert g.order == ['a', 'b', 'c', 'd']
+    assert g.transitive_dependents(['b']) == set(['b', 'c', 'd'])
+
+def test_unknown_and_circular_dependencies():
+    with pytest.raises(graph.GraphError):
+        graph.BuildGraph(['a'], {'a': ['missing']})
+    with pytest.raises(graph.GraphError):
+        graph.BuildGraph(['a', 'b'], {'a': ['b'], 'b': ['a']})
+
+def test_bad_depends_are_build_errors(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    packages = [{'name': 'aa', 'version': '1.0', 'depends': ['nope']}]
+    json.dump({'settings': {}, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+    recipe = gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+    # which bin/gattai reports without a traceback
+    with pytest.raises(gattai.BuildError):
+        recipe.plan()
+
+def test_critical_path_and_simulation():
+    g = make_graph()
+    durations = {'a': 100, 'b': 50, 'c': 30, 'd': 10}
+    assert g.critical_path(durations) == ['a', 'c', 'd']
+    assert g.simulate(durations, jobs=1) == 190
+    assert g.simulate(durations, jobs=2) == 140
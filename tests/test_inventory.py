@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+test_inventory.py
+
+tests finding installed packages without running pkg-config
+
+"""
+
+import json
+
+import gattai
+from gattai import inventory
+
+def test_parse_pc(tmpdir):
+    pc = tmpdir.join('foo.pc')
+    pc.write('# comment\nprefix=/opt/foo\nlibdir=${prefix}/lib\nmajor=2\n\n'
+             'Name: foo\nDescription: a library\nVersion: ${major}.4.1\nLibs: -L${libdir} -lfoo\n')
+    fields = inventory.parse_pc(str(pc))
+    assert fields['Version'] == '2.4.1'
+    assert fields['Libs'] == '-L/opt/foo/lib -lfoo'
+    assert inventory.read_pc_dir(str(tmpdir)) == {'foo': '2.4.1'}
+
+def test_pkg_config_search_order(tmpdir, monkeypatch):
+    first = tmpdir.mkdir('first')
+    first.join('foo.pc').write('Version: 1.5\n')
+    prefix_dir = tmpdir.mkdir('prefix').mkdir('lib').mkdir('pkgconfig')
+    prefix_dir.join('foo.pc').write('Version: 1.2\n')
+    prefix_dir.join('bar.pc').write('Version: 3.0\n')
+    monkeypatch.setenv('PKG_CONFIG_PATH', str(first))
+    monkeypatch.setenv('PKG_CONFIG_LIBDIR', str(tmpdir.join('missing')))
+
+    index = inventory.InstallIndex()
+    assert index.pkg_config_version('foo', str(tmpdir.join('prefix'))) == '1.5'
+    assert index.pkg_config_version('bar', str(tmpdir.join('prefix'))) == '3.0'
+    assert index.pkg_config_version('bar') is None
+
+def test_python_packages(tmpdir):
+    site = tmpdir.mkdir('site-packages')
+    site.mkdir('Foo_Bar-1.2.dist-info').join('METADATA').write('Metadata-Version: 2.1\nName: Foo_Bar\nVersion: 1.2\n\nbody\n')
+    site.join('baz-0.9-py2.7.egg-info').write('Name: baz\nVersion: 0.9\n')
+    site.mkdir('qux-2.0.dist-info')
+    index = inventory.InstallIndex([str(site)])
+    assert index.python_version('foo-bar') == '1.2'
+    assert index.python_version('baz') == '0.9'
+    assert index.python_version('qux') == '2.0'
+    assert index.python_version('missing') is None
+
+def test_installed_compares_versions(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv('PKG_CONFIG_LIBDIR', str(tmpdir.join('missing')))
+    pc_dir = tmpdir.mkdir('install').mkdir('lib').mkdir('pkgconfig')
+    pc_dir.join('junkfoo.pc').write('Version: 1.4.2\n')
+    settings = {'install_dir': str(tmpdir.join('install'))}
+    packages = [{'name': 'junkfoo', 'version': '1.4'}, {'name': 'junkbar', 'version': '1.0'}]
+    json.dump({'settings': settings, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+    recipe = gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+
+    dep = gattai.Dependency(recipe, recipe.package_props('junkfoo'))
+    assert dep.installed()
+    assert dep.valid_version('1.10')
+    assert not dep.valid_version('1.3.9')
+    assert not dep.valid_version('2.0')
+    assert not dep.valid_version('1.4rc1')
+    assert not gattai.Dependency(recipe, {'name': 'junkfoo', 'version': '1.2', 'version_range': '>=1.2,<1.4'}).installed()
+    assert not gattai.Dependency(recipe, recipe.package_props('junkbar')).installed()
+
+def test_installed_with_branch_version(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv('PKG_CONFIG_LIBDIR', str(tmpdir.join('missing')))
+    pc_dir = tmpdir.mkdir('install').mkdir('lib').mkdir('pkgconfig')
+    pc_dir.join('junkgit.pc').write('Version: 2.30.1\n')
+    settings = {'install_dir': str(tmpdir.join('install'))}
+    packages = [{'name': 'junkgit', 'version': 'master'}]
+    json.dump({'settings': settings, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+    recipe = gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+
+    dep = gattai.Dependency(recipe, recipe.package_props('junkgit'))
+    assert dep.version_requirement() is None
+    assert not dep.installed()
+    assert dep.valid_version('master')
+    assert recipe.plan().split()[:1] == ['junkgit-master']
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+test_lockfile.py
+
+tests locking what a recipe resolves to
+
+"""
+
+import hashlib
+import json
+
+import pytest
+
+import gattai
+
+def make_recipe(tmpdir, version='5.0'):
+    remote = tmpdir.ensure('remote', dir=True).join('junk-%s.tar.gz' % version)
+    remote.write('not really a tarball')
+    packages = [{"name": "junk", "version": version, "source": "file://%s" % remote},
+                {"name": "other", "version": "5.0"}]
+    recipe_file = tmpdir.join('recipe.gattai')
+    recipe_file.write(json.dumps({"settings": {}, "packages": packages}))
+    return gattai.GattaiRecipe(str(recipe_file)), remote
+
+def test_lock_records_packages(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    recipe, remote = make_recipe(tmpdir)
+    report = recipe.lock()
+    assert "Locked 2 packages" in report
+    assert "added junk" in report
+
+    lock = json.load(open(str(tmpdir.join('recipe.gattai.lock'))))
+    entry = lock['packages']['junk']
+    assert entry['url'] == 'file://%s' % remote
+    assert entry['archive'] == 'junk-5.0.tar.gz'
+    assert entry['sha256'] == hashlib.sha256('not really a tarball').hexdigest()
+    # not unpacked yet, so where it will be is only a guess
+    assert entry['source_dir'] is None
+    assert lock['packages']['other']['archive'] is None
+
+    # the next run trusts the lock
+    recipe.check_lock()
+    dep = gattai.Dependency(recipe, recipe.package_props('junk'))
+    assert dep.build_key() == entry['build_key']
+    assert recipe.lock().splitlines() == ["Locked 2 packages in %s" % tmpdir.join('recipe.gattai.lock')]
+
+def test_drift_is_reported(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    recipe, remote = make_recipe(tmpdir)
+    recipe.lock()
+    recipe, remote = make_recipe(tmpdir, version='6.0')
+    warnings = []
+    monkeypatch.setattr(gattai.logging, 'warning', warnings.append)
+    recipe.check_lock()
+    assert recipe.locked.keys() == ['other']
+    assert "    Changed: junk" in warnings
+
+def test_download_must_match_lock(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    recipe, remote = make_recipe(tmpdir)
+    recipe.lock()
+    recipe.check_lock()
+    tmpdir.join('junk-5.0.tar.gz').remove()
+    remote.write('something else')
+
+    dep = gattai.Dependency(recipe, recipe.package_props('junk'))
+    with pytest.raises(gattai.BuildError):
+        dep.download_file(dep.get_prop('source'))
+    assert not tmpdir.join('junk-5.0.tar.gz').exists()
+    assert not tmpdir.join('junk-5.0.tar.gz.part').exists()
+
+def test_locked_dirs_must_exist(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    recipe, remote = make_recipe(tmpdir)
+    tmpdir.mkdir('junk-5.0')
+    recipe.lock()
+    assert json.load(open(str(tmpdir.join('recipe.gattai.lock'))))['packages']['junk']['source_dir'] == str(tmpdir.join('junk-5.0'))
+
+    # the source moved to the recipe dir's junk/
+    tmpdir.join('junk-5.0').remove()
+    tmpdir.mkdir('junk')
+    recipe.check_lock()
+    dep = gattai.Dependency(recipe, recipe.package_props('junk'))
+    assert dep.source_dir() == str(tmpdir.join('junk'))
+    assert dep.build_dir() == str(tmpdir.join('junk'))
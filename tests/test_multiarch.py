@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+test_multiarch.py
+
+tests building the archs of a package as separate jobs
+
+"""
+
+import json
+import os
+import tarfile
+
+import gattai
+from gattai import graph, multiarch
+
+def test_expand():
+    build_graph = graph.BuildGraph(['aa', 'bb', 'cc'], {'aa': [], 'bb': ['aa'], 'cc': ['bb']})
+    archs = {'aa': ['x', 'y'], 'bb': ['x', 'y']}
+
+    expanded = multiarch.expand(build_graph, archs)
+    assert expanded.order == ['aa@', 'aa@x', 'aa@y', 'aa', 'bb@', 'bb@x', 'bb@y', 'bb', 'cc']
+    # installed side by side, each arch only waits for its own
+    assert expanded.dependencies('bb@x') == ['bb@', 'aa@x']
+    assert expanded.dependencies('bb') == ['bb@x', 'bb@y']
+    assert expanded.dependencies('cc') == ['bb']
+
+    expanded = multiarch.expand(build_graph, archs, merged_first=['aa'])
+    assert expanded.dependencies('bb@y') == ['bb@', 'aa']
+    assert multiarch.split_node('bb@y') == ('bb', 'y')
+    assert multiarch.split_node('bb@') == ('bb', multiarch.SOURCE)
+    assert multiarch.split_node('bb') == ('bb', None)
+
+def write_lipo(tmpdir, monkeypatch):
+    # joins the inputs instead of combining them
+    bin_dir = tmpdir.mkdir('bin')
+    bin_dir.join('lipo').write('#!/bin/sh\nshift\nfiles=""\n'
+                               'while [ $# -gt 0 ]; do\n'
+                               '  if [ "$1" = -output ]; then out=$2; shift 2; else files="$files $1"; shift; fi\n'
+                               'done\ncat $files > $out\n')
+    bin_dir.join('lipo').chmod(0755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+def test_merge_trees(tmpdir, monkeypatch):
+    write_lipo(tmpdir, monkeypatch)
+    for arch in ['x', 'y']:
+        tree = tmpdir.mkdir(arch)
+        tree.mkdir('lib').join('libaa.dylib').write('\xcf\xfa\xed\xfe' + arch, 'wb')
+        tree.join('lib', 'aa.pc').write('prefix=/usr\n')
+        os.symlink('libaa.dylib', str(tree.join('lib', 'libaa.1.dylib')))
+    dest = tmpdir.join('merged')
+
+    assert multiarch.merge_trees([str(tmpdir.join('x')), str(tmpdir.join('y'))], str(dest)) == 1
+    assert dest.join('lib', 'libaa.dylib').read('rb') == '\xcf\xfa\xed\xfex\xcf\xfa\xed\xfey'
+    assert dest.join('lib', 'aa.pc').read() == 'prefix=/usr\n'
+    assert os.readlink(str(dest.join('lib', 'libaa.1.dylib'))) == 'libaa.dylib'
+
+def write_sources(tmpdir):
+    for name in ['aa', 'bb']:
+        source = tmpdir.mkdir('%s-1.0' % name)
+        source.join('configure').write('#!/bin/sh\nfor arg in "$@"; do\n'
+                                       '  case $arg in --host=*) echo ${arg#--host=} > host;; esac\n'
+                                       'done\n')
+        source.join('configure').chmod(0755)
+        source.join('Makefile').write("all:\n\tprintf '\\317\\372\\355\\376' > out\n\tcat host >> out\n"
+                                      "install:\n\tmkdir -p $(DESTDIR)$(prefix)/bin\n"
+                                      "\tcp out $(DESTDIR)$(prefix)/bin/%s\n" % name)
+
+def write_recipe(tmpdir, arch_merge):
+    write_sources(tmpdir)
+    settings = {'install_dir': str(tmpdir.join('install')), 'archs': ['x', 'y'], 'split_archs': 'TRUE',
+                'arch_merge': arch_merge}
+    packages = [{'name': 'aa', 'version': '1.0', 'configure_args': ['--host=%(ARCH)s']},
+                {'name': 'bb', 'version': '1.0', 'depends': ['aa'], 'configure_args': ['--host=%(ARCH)s']}]
+    json.dump({'settings': settings, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+    return gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+
+def test_build_archs_side_by_side(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    recipe = write_recipe(tmpdir, 'prefix')
+    plan = [line.split()[:2] for line in recipe.plan().splitlines()[:6]]
+    assert [target for target, action in plan] == ['aa-1.0-x', 'aa-1.0-y', 'aa-1.0', 'bb-1.0-x', 'bb-1.0-y', 'bb-1.0']
+    assert plan[2][1] == 'merged'
+    recipe.build_deps(jobs=2)
+
+    install = tmpdir.join('install')
+    assert install.join('x', 'bin', 'bb').read('rb') == '\xcf\xfa\xed\xfex\n'
+    assert install.join('y', 'bin', 'aa').read('rb') == '\xcf\xfa\xed\xfey\n'
+    # nothing was built in the real source trees
+    assert not tmpdir.join('aa-1.0', 'out').exists()
+
+def test_build_archs_and_lipo(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    write_lipo(tmpdir, monkeypatch)
+    write_recipe(tmpdir, 'lipo').build_deps(jobs=2)
+
+    assert tmpdir.join('install', 'bin', 'bb').read('rb') == '\xcf\xfa\xed\xfex\n\xcf\xfa\xed\xfey\n'
+    # the builds for each arch are removed once merged
+    assert tmpdir.join('.gattai', 'archs').listdir() == []
+
+def test_archs_share_one_unpacked_source(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    write_sources(tmpdir.mkdir('remote'))
+    tar = tarfile.open(str(tmpdir.join('remote', 'aa-1.0.tar.gz')), 'w:gz')
+    tar.add(str(tmpdir.join('remote', 'aa-1.0')), 'aa-1.0')
+    tar.close()
+    archs = ['w', 'x', 'y', 'z']
+    settings = {'install_dir': str(tmpdir.join('install')), 'archs': archs, 'split_archs': 'TRUE',
+                'arch_merge': 'prefix', 'cpu_budget': 8}
+    packages = [{'name': 'aa', 'version': '1.0', 'configure_args': ['--host=%(ARCH)s'],
+                 'source': 'file://%s' % tmpdir.join('remote', 'aa-1.0.tar.gz')}]
+    json.dump({'settings': settings, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+    gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai'))).build_deps(jobs=4)
+
+    for arch in archs:
+        assert tmpdir.join('install', arch, 'bin', 'aa').read('rb') == '\xcf\xfa\xed\xfe%s\n' % arch
+    assert tmpdir.join('aa-1.0', '.gattai_extracted').exists()
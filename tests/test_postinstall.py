@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+"""
+test_postinstall.py
+
+tests running postinstall scripts in their own interpreter
+
+"""
+
+import json
+
+import pytest
+
+import gattai
+from gattai.builder import BuildError
+
+def make_dependency(tmpdir, script):
+    tmpdir.join('post.py').write(script)
+    tmpdir.join('recipe.gattai').write(json.dumps({"settings": {}, "packages": []}))
+    recipe = gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+    return gattai.Dependency(recipe, {"name": "junk", "version": "1.0", "postinstall_script": "post.py"})
+
+def test_postinstall_script_gets_substitutions(tmpdir):
+    with tmpdir.as_cwd():
+        dep = make_dependency(tmpdir, "open('out', 'w').write('%(SRCDIR)s|%(ROOTDIR)s|%(ARCH)s|100%%')\n")
+        assert dep.postinstall(str(tmpdir))
+        assert tmpdir.join('out').read() == '%s|%s||100%%' % (dep.SRCDIR, tmpdir)
+
+def test_failing_postinstall_script(tmpdir):
+    with tmpdir.as_cwd():
+        dep = make_dependency(tmpdir, "import sys\nsys.exit(3)\n")
+        with pytest.raises(BuildError):
+            dep.postinstall(str(tmpdir))
+        # clean runs skip the script
+        assert dep.postinstall(str(tmpdir), args=['clean'])
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""
+test_profiling.py
+
+tests profiling gattai's own overhead
+
+"""
+
+import os
+import subprocess
+
+import gattai
+
+from gattai import profiling
+
+def busy():
+    total = 0
+    for i in range(2000000):
+        total += i
+    return total
+
+def test_sampled_stacks_are_collapsed(tmpdir):
+    prefix = str(tmpdir.join('profile'))
+    assert profiling.profile(busy, prefix, sampler=True) == busy()
+
+    lines = tmpdir.join('profile.collapsed').read().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(' ', 1)
+    assert int(count) > 0
+    assert any('test_profiling.py:busy' in line for line in lines)
+
+def test_calls_are_counted(tmpdir):
+    exists = os.path.exists
+    execute_child = vars(subprocess.Popen)['_execute_child']
+    get_prop = vars(gattai.Dependency)['get_prop']
+    profiling.profile(lambda: os.path.exists(str(tmpdir)), str(tmpdir.join('profile')))
+    assert tmpdir.join('profile.pstats').exists()
+    assert profiling.counters['os.path.exists'] > 0
+
+    # the counted functions are back to normal afterwards
+    assert os.path.exists is exists
+    assert vars(subprocess.Popen)['_execute_child'] is execute_child
+    assert vars(gattai.Dependency)['get_prop'] is get_prop
+    count = profiling.counters['os.path.exists']
+    os.path.exists(str(tmpdir))
+    assert profiling.counters['os.path.exists'] == count
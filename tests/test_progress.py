@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+test_progress.py
+
+tests the status line and metrics shown while packages build
+
+"""
+
+import json
+import logging
+import socket
+import StringIO
+import urllib2
+
+import gattai
+from gattai import eventloop, progress
+
+def test_metrics():
+    metrics = progress.BuildMetrics(5, jobs=2, cpus=4)
+    metrics.started('a')
+    metrics.started('b')
+    metrics.finished('a', True, 'cached', cached=True)
+    metrics.finished('b', False)
+    metrics.started('c')
+    metrics.downloaded(2048)
+    assert metrics.queued() == 2
+    assert metrics.cache_hit_rate() == 1.0
+    status = metrics.status()
+    assert status.startswith("[2/5] 1 building, 2 queued, 1 failed")
+    assert "cache 100%" in status
+
+    text = metrics.prometheus()
+    assert 'gattai_packages{state="building"} 1.0' in text
+    assert 'gattai_packages{state="failed"} 1.0' in text
+    assert 'gattai_download_bytes_total 2048.0' in text
+    assert 'gattai_artifact_cache_requests_total{result="miss"} 0.0' in text
+    assert '# TYPE gattai_job_slots gauge' in text
+
+def test_status_line_is_cleared_for_messages():
+    stream = StringIO.StringIO()
+    handler = logging.StreamHandler(stream)
+    logger = logging.getLogger()
+    logger.addHandler(handler)
+    status = progress.StatusLine(stream)
+    try:
+        status.attach()
+        status.show("[1/3] 1 building, 1 queued")
+        logging.warning("a message")
+        status.detach()
+        logging.warning("another message")
+    finally:
+        logger.removeHandler(handler)
+    assert stream.getvalue() == ("\r[1/3] 1 building, 1 queued\033[K\r\033[Ka message\n"
+                                 "\r\033[Kanother message\n")
+
+def test_monitor_serves_metrics():
+    loop = eventloop.EventLoop()
+    monitor = progress.Monitor(progress.BuildMetrics(2, jobs=1), loop, port=0)
+    monitor.start()
+    try:
+        monitor.started('a')
+        url = 'http://127.0.0.1:%d/metrics' % monitor.server.server_address[1]
+        text = urllib2.urlopen(url).read()
+    finally:
+        monitor.stop()
+        loop.close()
+    assert 'gattai_packages{state="building"} 1.0' in text
+    assert 'gattai_packages{state="queued"} 1.0' in text
+
+def test_monitor_without_metrics_port():
+    taken = socket.socket()
+    taken.bind(('127.0.0.1', 0))
+    taken.listen(1)
+    loop = eventloop.EventLoop()
+    monitor = progress.Monitor(progress.BuildMetrics(1, jobs=1), loop, port=taken.getsockname()[1])
+    try:
+        monitor.start()
+        assert monitor.server is None
+        monitor.started('a')
+        monitor.finished('a', True)
+    finally:
+        monitor.stop()
+        loop.close()
+        taken.close()
+
+def test_build_with_status_line(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    settings = {'metrics_port': 0, 'status_line': 'TRUE'}
+    packages = [{'name': 'aa', 'version': '1.0', 'ignore': True}, {'name': 'bb', 'version': '1.0', 'ignore': True}]
+    json.dump({'settings': settings, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+    recipe = gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+    statuses = []
+    stop = progress.Monitor.stop
+    def record_and_stop(self):
+        statuses.append(self.metrics.status())
+        stop(self)
+    monkeypatch.setattr(progress.Monitor, 'stop', record_and_stop)
+    recipe.build_deps(jobs=2)
+    assert statuses[0].startswith("[2/2] 0 building, 0 queued")
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""
+test_props.py
+
+tests the read-only records package properties are kept in
+
+"""
+
+import json
+import StringIO
+
+import pytest
+
+import gattai
+from gattai import props
+
+def test_platform_overrides_dont_touch_recipe():
+    base = {"name": "junk", "version": "1.0", "depends": ["a"], "linux2": {"depends": ["b"]}}
+    record = props.PackageProps.resolve(base, "linux2")
+    assert record['depends'] == ["b"]
+    assert record.get('version') == "1.0"
+    assert 'name' in record and 'missing' not in record
+    assert base['depends'] == ["a"]
+    with pytest.raises(TypeError):
+        record['version'] = "2.0"
+
+    changed = record.override({"version": "2.0"})
+    assert changed['version'] == "2.0"
+    assert record['version'] == "1.0"
+    assert changed.base is record.base
+    assert sorted(changed.keys()) == sorted(base.keys())
+
+def test_keys_are_interned():
+    loaded = props.load_json(StringIO.StringIO(json.dumps([{"name": "a"}, {"name": "b"}])))
+    first, second = [dep.keys()[0] for dep in loaded]
+    assert first is second
+    assert isinstance(first, str)
+
+def test_dependency_wraps_plain_dicts(tmpdir):
+    recipe_file = tmpdir.join('recipe.gattai')
+    recipe_file.write(json.dumps({"settings": {}, "packages": []}))
+    with tmpdir.as_cwd():
+        recipe = gattai.GattaiRecipe(str(recipe_file))
+        base = {"name": "junk", "version": "5.0", gattai.sys.platform: {"version": "6.0"}}
+        dep = gattai.Dependency(recipe, base)
+        assert dep.props['version'] == "6.0"
+        assert base['version'] == "5.0"
+        assert dep.SRCDIR.endswith("junk-6.0")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+test_recipediff.py
+
+tests rebuilding only the packages a recipe edit affects
+
+"""
+
+import json
+
+import gattai
+from gattai import recipediff
+
+def test_diff_and_update(tmpdir):
+    resolved = recipediff.ResolvedRecipe(str(tmpdir.join('resolved.json')))
+    assert not resolved.exists
+    resolved.update({'aa': {'version': '1.0'}, 'bb': {'version': '2.0'}}, ['aa', 'bb'], ['aa'])
+    resolved.save()
+
+    resolved = recipediff.ResolvedRecipe(str(tmpdir.join('resolved.json')))
+    assert resolved.built('aa') and not resolved.built('bb')
+    current = {'aa': {'version': '1.1', 'configure_args': ['--x']}, 'bb': {'version': '2.0'}, 'cc': {}}
+    added, removed, changed = resolved.diff(current)
+    assert (added, removed, changed) == (['cc'], [], {'aa': ['configure_args', 'version']})
+    assert recipediff.format_diff(added, ['dd'], changed) == [
+        "    Added: cc", "    Removed: dd", "    Changed: aa (configure_args, version)"]
+
+    # packages a run didn't look at stay built only while they are unchanged
+    resolved.update(current, [], [])
+    assert not resolved.built('aa')
+
+def write_recipe(tmpdir, aa_args, settings={}):
+    packages = [{'name': 'aa', 'version': '1.0', 'configure_args': aa_args, 'install_check_cmd': 'true'},
+                {'name': 'bb', 'version': '1.0', 'depends': ['aa']},
+                {'name': 'cc', 'version': '1.0', 'depends': []}]
+    json.dump({'settings': settings, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+    return gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+
+def write_sources(tmpdir):
+    built = tmpdir.join('built.log')
+    for name in ['aa', 'bb', 'cc']:
+        source = tmpdir.mkdir('%s-1.0' % name)
+        source.join('configure').write('#!/bin/sh\nexit 0\n')
+        source.join('configure').chmod(0755)
+        source.join('Makefile').write('all:\n\techo %s >> %s\ninstall:\n\ttrue\n' % (name, built))
+    return built
+
+def test_only_changes_are_rebuilt(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    built = write_sources(tmpdir)
+
+    write_recipe(tmpdir, []).build_deps()
+    # aa counts as installed
+    assert built.read().split() == ['bb', 'cc']
+
+    built.remove()
+    messages = []
+    monkeypatch.setattr(gattai.logging, 'info', messages.append)
+    recipe = write_recipe(tmpdir, ['--enable-x'])
+    assert [line.split()[1] for line in recipe.plan().splitlines()[:3]] == ['incremental', 'incremental', 'unchanged']
+    recipe.build_deps()
+    # the changed package is rebuilt even though it is installed, along with what depends on it
+    assert built.read().split() == ['aa', 'bb']
+    assert "    Changed: aa (configure_args)" in messages
+
+    built.remove()
+    write_recipe(tmpdir, ['--enable-x']).build_deps()
+    assert not built.exists()
+
+def test_run_settings_are_not_changes(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    built = write_sources(tmpdir)
+    write_recipe(tmpdir, []).build_deps()
+    built.remove()
+
+    settings = {'status_line': 'FALSE', 'download_jobs': 1, 'log_tail_lines': 5}
+    recipe = write_recipe(tmpdir, [], settings)
+    assert [line.split()[1] for line in recipe.plan().splitlines()[:3]] == ['unchanged'] * 3
+    recipe.build_deps()
+    assert not built.exists()
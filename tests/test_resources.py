@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+"""
+test_resources.py
+
+tests the CPU and memory budgets of parallel builds
+
+"""
+
+import subprocess
+import sys
+
+from gattai import resources
+
+def test_available_memory(tmpdir):
+    meminfo = tmpdir.join('meminfo')
+    meminfo.write('MemTotal:       16384000 kB\nMemFree:         1024000 kB\nMemAvailable:    8192000 kB\n')
+    assert resources.available_memory_mb(str(meminfo)) == 8000
+
+    meminfo.write('MemTotal:       16384000 kB\nMemFree:         1024000 kB\n')
+    assert resources.available_memory_mb(str(meminfo)) == 16000
+    assert resources.available_memory_mb(str(tmpdir.join('missing'))) is None
+
+def test_budget_admits_oversized_work_alone():
+    budget = resources.Budget(cpus=4, mem_mb=1000)
+    assert budget.fits(8, 4000)
+    budget.acquire(8, 4000)
+    assert not budget.fits(1, 0)
+    budget.release(8, 4000)
+    budget.acquire(2, 600)
+    assert budget.fits(2, 400)
+    assert not budget.fits(2, 500)
+    assert not budget.fits(3, 0)
+
+def test_peak_memory_includes_children():
+    with resources.PeakMemory(interval=0.05) as peak:
+        # hold on to about 50 MB for a moment
+        subprocess.check_call([sys.executable, '-c', 'import time; data = "x" * (50 * 1024 * 1024); time.sleep(0.5)'])
+    assert peak.peak_mb >= 50
+
+def test_cpu_times(tmpdir):
+    stat = tmpdir.join('stat')
+    stat.write('cpu  100 5 50 800 20 3 2 10 7 0\ncpu0 50 2 25 400 10 1 1 5 3 0\n')
+    assert resources.cpu_times(str(stat)) == (170, 990)
+    assert resources.cpu_times(str(tmpdir.join('missing'))) is None
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""
+test_resume.py
+
+tests isolating failed packages and resuming failed runs
+
+"""
+
+import json
+
+import pytest
+
+import gattai
+
+def make_package(dir, name):
+    source = dir.join('%s-5.0' % name).ensure(dir=True)
+    source.join('configure').write('#!/bin/sh\nexit 0\n')
+    source.join('configure').chmod(0755)
+    source.join('Makefile').write('all:\n\techo %s >> ../built.txt\ninstall:\n' % name)
+
+def write_recipe(dir, fail):
+    for name in ['aa', 'bb', 'cc']:
+        make_package(dir, name)
+    aa = {'name': 'aa', 'version': '5.0', 'depends': []}
+    if fail:
+        aa['prebuild_cmds'] = ['false']
+    packages = [aa,
+                {'name': 'bb', 'version': '5.0', 'depends': []},
+                {'name': 'cc', 'version': '5.0', 'depends': ['aa']}]
+    filename = str(dir.join('recipe.gattai'))
+    json.dump({'settings': {}, 'packages': packages}, open(filename, 'w'))
+    return filename
+
+def built(dir):
+    if not dir.join('built.txt').exists():
+        return []
+    return sorted(dir.join('built.txt').read().split())
+
+def test_keep_going_then_resume(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    recipe = gattai.GattaiRecipe(write_recipe(tmpdir, fail=True))
+    with pytest.raises(gattai.BuildError):
+        recipe.build_deps(keep_going=True)
+    # bb doesn't need aa, so it was still built
+    assert built(tmpdir) == ['bb']
+    assert recipe.run_state().packages == {'aa': 'failed', 'bb': 'done', 'cc': 'pending'}
+
+    tmpdir.join('built.txt').remove()
+    recipe = gattai.GattaiRecipe(write_recipe(tmpdir, fail=False))
+    recipe.build_deps(resume=True)
+    assert built(tmpdir) == ['aa', 'cc']
+    assert recipe.run_state().unfinished(['aa', 'bb', 'cc']) == []
+
+def test_first_failure_stops_the_run(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    recipe = gattai.GattaiRecipe(write_recipe(tmpdir, fail=True))
+    with pytest.raises(gattai.BuildError):
+        recipe.build_deps()
+    assert built(tmpdir) == []
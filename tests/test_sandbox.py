@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+test_sandbox.py
+
+tests building packages in a scratch directory
+
+"""
+
+import json
+import os
+
+from gattai import sandbox
+import gattai
+
+def test_sync_tree_copies_changes_only(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('a.c').write('int a;')
+    src.mkdir('sub').join('b.c').write('int b;')
+    os.symlink('a.c', str(src.join('link.c')))
+    dest = tmpdir.join('dest')
+
+    assert sandbox.sync_tree(str(src), str(dest)) == 3
+    assert dest.join('sub', 'b.c').read() == 'int b;'
+    assert os.readlink(str(dest.join('link.c'))) == 'a.c'
+    dest.join('a.o').write('built')
+    assert sandbox.sync_tree(str(src), str(dest)) == 0
+
+    src.join('a.c').write('int aa;')
+    src.join('a.c').setmtime(src.join('a.c').mtime() + 10)
+    assert sandbox.sync_tree(str(src), str(dest)) == 1
+    assert dest.join('a.c').read() == 'int aa;'
+    assert dest.join('a.o').exists()
+
+def test_build_in_scratch_dir(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    source = tmpdir.mkdir('aa-5.0')
+    source.join('configure').write('#!/bin/sh\nexit 0\n')
+    source.join('configure').chmod(0755)
+    source.join('Makefile').write('all:\n\techo built > out\n'
+                                  'install:\n\tmkdir -p $(DESTDIR)$(prefix)/bin\n\tcp out $(DESTDIR)$(prefix)/bin/aa\n')
+    scratch = tmpdir.join('scratch')
+    install = tmpdir.join('install')
+    settings = {'scratch_dir': str(scratch), 'install_dir': str(install)}
+    packages = [{'name': 'aa', 'version': '5.0'}]
+    json.dump({'settings': settings, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+
+    gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai'))).build_deps()
+
+    assert install.join('bin', 'aa').read() == 'built\n'
+    # nothing was built in the real source tree, and the sandbox is gone
+    assert not source.join('out').exists()
+    assert scratch.listdir() == []
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+test_scheduler.py
+
+tests the order packages are built in
+
+"""
+
+import time
+
+from gattai import eventloop, graph, resources, scheduler
+
+def make_graph():
+    # three independent packages, and d which needs c
+    return graph.BuildGraph(['a', 'b', 'c', 'd'],
+                            {'a': [], 'b': [], 'c': [], 'd': ['c']})
+
+def test_longest_remaining_path_first():
+    durations = {'a': 10, 'b': 30, 'c': 5, 'd': 40}
+    started = []
+    def job(name):
+        started.append(name)
+        return True, None
+
+    scheduler.Scheduler(make_graph(), durations).run(['a', 'b', 'c', 'd'], job, lambda name, result: True)
+
+    assert started == ['c', 'd', 'b', 'a']
+
+def test_failure_stops_dependents():
+    finished = {}
+    def job(name):
+        return name != 'c', None
+    def on_finish(name, result):
+        finished[name] = result[0]
+
+    scheduler.Scheduler(make_graph(), {}, jobs=2).run(['a', 'b', 'c', 'd'], job, on_finish)
+
+    assert finished == {'a': True, 'b': True, 'c': False}
+
+def test_held_packages_wait_for_release():
+    loop = eventloop.EventLoop()
+    pool = eventloop.WorkerPool(loop, 2)
+    build_scheduler = scheduler.Scheduler(make_graph(), {}, loop=loop)
+    started = []
+    def job(name):
+        started.append(name)
+        return True, None
+    pool.submit(time.sleep, lambda result, error: build_scheduler.release('a'), 0.2)
+
+    build_scheduler.run(['a', 'b', 'c', 'd'], job, lambda name, result: True, held=['a'])
+    pool.close()
+    loop.close()
+
+    assert started == ['b', 'c', 'd', 'a']
+
+def test_timers_wake_the_loop():
+    loop = eventloop.EventLoop()
+    calls = []
+    loop.call_later(0.2, calls.append, 'late')
+    loop.call_later(0.05, calls.append, 'early')
+    start = time.time()
+    while len(calls) < 2:
+        loop.run_once()
+    loop.close()
+    assert calls == ['early', 'late']
+    assert time.time() - start >= 0.2
+
+class RecordingBudget(resources.Budget):
+    def __init__(self, cpus, mem_mb):
+        resources.Budget.__init__(self, cpus, mem_mb)
+        self.usage = []
+
+    def acquire(self, cpus, mem_mb):
+        resources.Budget.acquire(self, cpus, mem_mb)
+        self.usage.append((self.used_cpus, self.used_mem_mb))
+
+def test_packages_only_start_within_budget():
+    # a and b each need most of the memory, c and d are light
+    weights = {'a': (1, 600), 'b': (1, 600), 'c': (1, 100), 'd': (1, 100)}
+    budget = RecordingBudget(cpus=4, mem_mb=1000)
+    finished = []
+    def job(name):
+        time.sleep(0.1)
+        return True, None
+
+    build_scheduler = scheduler.Scheduler(make_graph(), {}, jobs=4, weights=weights, budget=budget)
+    build_scheduler.run(['a', 'b', 'c', 'd'], job, lambda name, result: finished.append(name))
+
+    assert sorted(finished) == ['a', 'b', 'c', 'd']
+    assert max(mem_mb for cpus, mem_mb in budget.usage) <= 1000
+    # the light packages still ran next to a heavy one
+    assert max(cpus for cpus, mem_mb in budget.usage) >= 2
+    assert (budget.used_cpus, budget.used_mem_mb) == (0, 0)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+test_toolchain.py
+
+tests finding builder programs without running which
+
+"""
+
+import json
+import os
+import stat
+
+import gattai
+from gattai import builder, history, toolchain
+
+def make_program(dir, name, version):
+    program = dir.join(name)
+    program.write("#!/bin/sh\necho 'GNU Make %s'\n" % version)
+    program.chmod(stat.S_IRWXU)
+    return program
+
+def test_search_path(tmpdir):
+    bin_dir = tmpdir.mkdir('bin')
+    program = make_program(bin_dir, 'make', '4.2')
+    bin_dir.join('not-executable').write('')
+    path = os.pathsep.join([str(tmpdir.join('missing')), str(bin_dir)])
+    assert toolchain.search_path('make', path) == str(program)
+    assert toolchain.search_path('not-executable', path) is None
+    assert toolchain.search_path('cmake', path) is None
+
+def test_cache_is_keyed_by_path_dirs(tmpdir):
+    bin_dir = tmpdir.mkdir('bin')
+    make_program(bin_dir, 'make', '4.2')
+    cache = str(tmpdir.join('toolchain.json'))
+    tools = toolchain.Toolchain(str(bin_dir), cache)
+    assert tools.versions(['make', 'cmake']) == {'make': '4.2'}
+
+    # the next run trusts the cache, even for programs it didn't find
+    cached = toolchain.Toolchain(str(bin_dir), cache)
+    assert cached.tools['cmake']['path'] is None
+    assert cached.tools['make']['version'] == '4.2'
+
+    # a program added to a dir on PATH changes the dir, and the cache with it
+    make_program(bin_dir, 'cmake', '3.10.2')
+    os.utime(str(bin_dir), (0, 0))
+    fresh = toolchain.Toolchain(str(bin_dir), cache)
+    assert fresh.tools == {}
+    assert fresh.version('cmake') == '3.10.2'
+
+def test_available_builders_use_path(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir('bin')
+    make_program(bin_dir, 'make', '4.2')
+    monkeypatch.setenv('PATH', str(bin_dir))
+    available = builder.getAvailableBuilders()
+    assert available == {'GNUMake': builder.GNUMakeBuilder, 'autoconf': builder.AutoconfBuilder}
+    assert builder.AutoconfBuilder().isAvailable()
+    assert not builder.XcodeBuilder().isAvailable()
+
+def test_cache_write_failures_dont_fail(tmpdir):
+    bin_dir = tmpdir.mkdir('bin')
+    make_program(bin_dir, 'make', '4.2')
+    # a dir where the cache file should be can't be replaced
+    cache = tmpdir.mkdir('toolchain.json')
+    tools = toolchain.Toolchain(str(bin_dir), str(cache))
+    assert tools.version('make') == '4.2'
+    assert tools.find('cmake') is None
+    assert sorted(tmpdir.listdir()) == [bin_dir, cache]
+    assert cache.listdir() == []
+
+def test_cache_is_written_once_per_batch(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir('bin')
+    make_program(bin_dir, 'make', '4.2')
+    make_program(bin_dir, 'ninja', '1.8.2')
+    writes = []
+    save_json = history.save_json
+    def counting_save_json(*args):
+        writes.append(args[0])
+        save_json(*args)
+    monkeypatch.setattr(history, 'save_json', counting_save_json)
+    tools = toolchain.Toolchain(str(bin_dir), str(tmpdir.join('toolchain.json')))
+    assert tools.versions(['make', 'cmake', 'ninja']) == {'make': '4.2', 'ninja': '1.8.2'}
+    assert len(writes) == 1
+    # nothing new was found
+    tools.versions(['make', 'ninja'])
+    assert len(writes) == 1
+
+def test_build_keys_use_the_package_path(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    make_program(tmpdir.mkdir('bin'), 'make', '3.81')
+    make_program(tmpdir.mkdir('newer'), 'make', '4.2')
+    monkeypatch.setenv('PATH', str(tmpdir.join('bin')))
+    packages = [{'name': 'aa', 'version': '1.0', 'format': 'gnumake',
+                 'env_vars': {'PATH': '%s:$PATH' % tmpdir.join('newer')}},
+                {'name': 'bb', 'version': '1.0', 'format': 'gnumake'}]
+    json.dump({'settings': {}, 'packages': packages}, open(str(tmpdir.join('recipe.gattai')), 'w'))
+    recipe = gattai.GattaiRecipe(str(tmpdir.join('recipe.gattai')))
+
+    aa = gattai.Dependency(recipe, recipe.package_props('aa'))
+    assert aa.tool_versions() == {'make': '4.2'}
+    assert gattai.Dependency(recipe, recipe.package_props('bb')).tool_versions() == {'make': '3.81'}
+    # the same key while build() has the package's env_vars set
+    key = aa.build_key()
+    aa.env = aa.env_values()
+    monkeypatch.setenv('PATH', str(aa.env['PATH']))
+    assert aa.tool_versions() == {'make': '4.2'}
+    assert aa.build_key() == key
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+test_vcs.py
+
+tests fetching sources from local git repositories
+
+"""
+
+import os
+import subprocess
+
+import pytest
+
+from gattai import vcs
+
+def git(repo, *args):
+    subprocess.check_call(['git', '-c', 'user.name=gattai', '-c', 'user.email=gattai@localhost'] + list(args),
+                          cwd=str(repo))
+
+def make_repo(tmpdir):
+    repo = tmpdir.mkdir('aa')
+    git(repo, 'init', '-q')
+    repo.join('README').write('aa\n')
+    repo.mkdir('src').join('aa.c').write('int main() { return 0; }\n')
+    repo.mkdir('docs').join('index.txt').write('docs\n')
+    git(repo, 'add', '.')
+    git(repo, 'commit', '-q', '-m', 'first')
+    git(repo, 'tag', 'v1.0')
+    return repo
+
+def test_fetch_through_mirror(tmpdir):
+    repo = make_repo(tmpdir)
+    url = 'file://%s' % repo
+    mirror_dir = str(tmpdir.join('mirrors'))
+
+    dest = tmpdir.join('aa-1.0')
+    vcs.fetch(url, str(dest), ref='v1.0', sparse_paths=['/src/'], mirror_dir=mirror_dir)
+    assert dest.join('src', 'aa.c').exists()
+    assert not dest.join('docs').exists()
+    assert os.listdir(mirror_dir) == [os.path.basename(vcs.mirror_path(mirror_dir, url))]
+
+    # the next fetch goes through the same mirror
+    repo.join('README').write('aa 2\n')
+    git(repo, 'commit', '-q', '-a', '-m', 'second')
+    dest = tmpdir.join('aa-2.0')
+    vcs.fetch(url, str(dest), mirror_dir=mirror_dir)
+    assert dest.join('README').read() == 'aa 2\n'
+    assert dest.join('docs', 'index.txt').exists()
+    assert len(os.listdir(mirror_dir)) == 1
+
+def test_fetch_directly(tmpdir):
+    repo = make_repo(tmpdir)
+    dest = tmpdir.join('aa-1.0')
+    vcs.fetch('file://%s' % repo, str(dest), ref='v1.0', sparse_paths=['/docs/'])
+    assert dest.join('docs', 'index.txt').exists()
+    assert not dest.join('src').exists()
+
+def test_failed_fetches_leave_nothing(tmpdir):
+    repo = make_repo(tmpdir)
+    for mirror_dir in [None, str(tmpdir.join('mirrors'))]:
+        dest = tmpdir.join('aa-1.0')
+        with pytest.raises(vcs.FetchError):
+            vcs.fetch('file://%s' % repo, str(dest), ref='no-such-ref', mirror_dir=mirror_dir)
+        assert not dest.exists()
+        assert not tmpdir.join('aa-1.0.tmp').exists()
+
+def test_unresolved_refs_are_fetch_errors(tmpdir, monkeypatch):
+    # a mirror the fetch left nothing in
+    monkeypatch.setattr(vcs, 'run_git', lambda args, cwd=None: None)
+    with pytest.raises(vcs.FetchError):
+        vcs.update_mirror('file:///nowhere', str(tmpdir.join('mirror.git')), 'HEAD', 1)
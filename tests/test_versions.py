@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""
+test_versions.py
+
+tests parsing and comparing package versions
+
+"""
+
+import pytest
+
+from gattai import versions
+
+def test_version_order():
+    order = ['1.4.dev1', '1.4a1', '1.4b2', '1.4rc1', '1.4', '1.4.post1', '1.10']
+    parsed = [versions.parse_version(text) for text in order]
+    assert parsed == sorted(parsed)
+    assert versions.parse_version('1.4') == versions.parse_version('1.4.0')
+    assert versions.parse_version('1.0.2k') > versions.parse_version('1.0.2')
+    assert versions.parse_version('unknown') is None
+
+def test_extract_version():
+    outputs = {
+        'GNU Make 4.2.1\nBuilt for x86_64-pc-linux-gnu\n': '4.2.1',
+        'cmake version 3.10.2\n\nCMake suite maintained by Kitware\n': '3.10.2',
+        'OpenSSL 1.0.2k-fips  26 Jan 2017\n': '1.0.2k',
+        'zstd command line interface 64-bits v1.4.4\n': '1.4.4',
+        '1.5.0': '1.5.0',
+        'release 8\n': '8',
+    }
+    for output, expected in outputs.items():
+        assert versions.extract_version(output).text == expected
+    assert versions.extract_version('no version here') is None
+
+def test_requirements():
+    requirement = versions.parse_requirement('>=1.5, <2')
+    assert requirement.matches(versions.parse_version('1.5'))
+    assert requirement.matches(versions.parse_version('1.10.3'))
+    assert not requirement.matches(versions.parse_version('1.4.9'))
+    assert not requirement.matches(versions.parse_version('2.0'))
+    assert versions.parse_requirement('>=1.5, <2') is requirement
+
+    assert versions.parse_requirement('1.4').matches(versions.parse_version('1.4.0'))
+    assert versions.parse_requirement('!=1.4').matches(versions.parse_version('1.4.1'))
+    assert versions.default_requirement('1.4') == '>=1.4,<2'
+    assert versions.default_requirement('1.4', exact=True) == '==1.4'
+    assert versions.default_requirement('master') is None
+    with pytest.raises(ValueError):
+        versions.parse_requirement('>=one')
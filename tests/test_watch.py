@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+test_watch.py
+
+tests detecting changes to package sources
+
+"""
+
+import os
+import shutil
+
+from gattai import graph, watch
+
+src_dir = 'junk_src'
+
+def setup_function(function):
+    shutil.rmtree(src_dir, ignore_errors=True)
+    os.mkdir(src_dir)
+    open(os.path.join(src_dir, 'a.c'), 'w').write('int a;')
+
+def teardown_function(function):
+    shutil.rmtree(src_dir, ignore_errors=True)
+
+def check_watcher(watcher):
+    try:
+        assert watcher.poll(0.1) == set()
+        open(os.path.join(src_dir, 'a.c'), 'a').write('int b;')
+        assert watch.wait_for_changes(watcher, 0.1) == set([src_dir])
+        # changes made before a reset are forgotten
+        os.mkdir(os.path.join(src_dir, 'sub'))
+        watcher.reset()
+        assert watcher.poll(0.1) == set()
+    finally:
+        watcher.close()
+
+def test_polling_watcher():
+    check_watcher(watch.PollingWatcher([src_dir], interval=0.1))
+
+def test_default_watcher():
+    check_watcher(watch.create_watcher([src_dir], interval=0.1))
+
+class FakeWatcher(object):
+    def reset(self):
+        pass
+
+    def close(self):
+        pass
+
+class FakeRecipe(object):
+    filename = 'recipe.gattai'
+    deps = []
+
+    def __init__(self, reloads):
+        # each the packages a reload changes, optionally with their new
+        # depends, or the exception it raises
+        self.reloads = reloads
+        self.depends = {'aa': [], 'bb': ['aa']}
+
+    def reload(self):
+        result = self.reloads.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        if isinstance(result, tuple):
+            result, self.depends = result
+        return result
+
+    def build_graph(self):
+        return graph.BuildGraph(['aa', 'bb'], self.depends)
+
+def test_watch_recipe_survives_bad_recipes(monkeypatch):
+    recipe = FakeRecipe([ValueError('No JSON object could be decoded'), set(['aa']), set(['bb'])])
+    changes = [set([recipe.filename])] * 3
+    def wait_for_changes(watcher, interval):
+        if not changes:
+            raise KeyboardInterrupt()
+        return changes.pop()
+    builds = []
+    def run_build(recipe, targets, arguments, jobs):
+        builds.append((sorted(targets), dict(recipe.probe_cache)))
+        # the last rebuild fails
+        return len(builds) < 3
+    monkeypatch.setattr(watch, 'create_watcher', lambda paths, interval: FakeWatcher())
+    monkeypatch.setattr(watch, 'wait_for_changes', wait_for_changes)
+    monkeypatch.setattr(watch, 'run_build', run_build)
+    watch.watch_recipe(recipe)
+
+    assert builds == [(['all'], {}),
+                      (['aa', 'bb'], {'aa': False, 'bb': False}),
+                      (['bb'], {'bb': False})]
+    # only the failed rebuild is still forced
+    assert recipe.probe_cache == {'bb': False}
+
+def test_watch_recipe_survives_bad_depends(monkeypatch):
+    recipe = FakeRecipe([(set(['aa']), {'aa': ['nope'], 'bb': ['aa']}),
+                         (set(['bb']), {'aa': [], 'bb': []})])
+    changes = [set([recipe.filename])] * 2
+    def wait_for_changes(watcher, interval):
+        if not changes:
+            raise KeyboardInterrupt()
+        return changes.pop()
+    builds = []
+    def run_build(recipe, targets, arguments, jobs):
+        builds.append(sorted(targets))
+        return True
+    monkeypatch.setattr(watch, 'create_watcher', lambda paths, interval: FakeWatcher())
+    monkeypatch.setattr(watch, 'wait_for_changes', wait_for_changes)
+    monkeypatch.setattr(watch, 'run_build', run_build)
+    watch.watch_recipe(recipe)
+
+    # what changed while the recipe was broken is rebuilt once it's fixed
+    assert builds == [['all'], ['aa', 'bb']]